@@ -4,6 +4,7 @@ S.Tomin. XFEL/DESY. 2017
 """
 from ocelot import *
 from ocelot.adaptors.astra2ocelot import *
+from ocelot.cpbd.async_io import save_particle_array_async, savez_compressed_async, flush_writes
 import numpy as np
 
 class SectionTrack:
@@ -62,6 +63,8 @@ class SectionTrack:
 
     def read_beam_file(self):
 
+        # the input file can be the output of the previous section which is still being written
+        flush_writes()
         particles = None
         #print(self.input_beam_file)
         extension = self.input_beam_file.split(".")[-1]
@@ -85,7 +88,8 @@ class SectionTrack:
 
     def save_beam_file(self, particles):
 
-        save_particle_array(self.output_beam_file, particles)
+        # the file is written in the background during the tracking of the next section
+        save_particle_array_async(self.output_beam_file, particles)
 
     def save_twiss_file(self, twiss_list):
         if self.tws_file == None:
@@ -100,13 +104,14 @@ class SectionTrack:
         s = np.array([tw.s for tw in twiss_list])
         E = np.array([tw.E for tw in twiss_list])
 
-        np.savez_compressed(tws_file_name, beta_x=bx, beta_y=by, alpha_x=ax, alpha_y=ay, E=E, s=s)
+        savez_compressed_async(tws_file_name, beta_x=bx, beta_y=by, alpha_x=ax, alpha_y=ay, E=E, s=s)
 
     def load_twiss_file(self):
 
         #with np.load(self.tws_file) as data:
         #    #for key in data.keys():
         #    #    p_array.__dict__[key] = data[key]
+        flush_writes()
         return np.load(self.tws_file)
 
     def tracking(self, particles=None):
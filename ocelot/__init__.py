@@ -7,6 +7,9 @@ __version__ = '18.02.2'
 
 __all__ = ['Twiss', 'twiss', "Beam", "Particle", "get_current", "get_envelope",  # beam
             "ellipse_from_twiss", "ParticleArray", "save_particle_array", "load_particle_array",   # beam
+            "beam_moments", "SliceTable", "slice_table",  # beam
+            "generate_parray", "gauss_6d",  # beam
+            "ParticleArrayBatch", "particle_array_batch",  # beam
            'fodo_parameters', 'lattice_transfer_map', 'TransferMap', 'gauss_from_twiss',  # optics
            "get_map", "MethodTM", "SecondTM", "KickTM", "CavityTM", "UndulatorTestTM",  # optics
            'Element', 'Multipole', 'Quadrupole', 'RBend', "Matrix", "UnknownElement",  # elements
@@ -16,12 +19,21 @@ __all__ = ['Twiss', 'twiss', "Beam", "Particle", "get_current", "get_envelope",
            "match", "match_tunes",  # match
            "Navigator", "tracking_step", "create_track_list", "track_nturns", "freq_analysis",  # track
             "contour_da", "track_nturns_mpi", "nearest_particle", "stable_particles",  # track
-            "spectrum", "track",  # track
+            "spectrum", "track", "track_batch",  # track
+            "TrackCheckpoint",  # checkpoint
+            "TwissSampler",  # diagnostics
+           "track_distributed",  # distributed
+           "create_mapped_particle_array", "open_mapped_particle_array", "npz_to_mapped",  # beam_mmap
+           "get_envelope_chunked", "track_chunked",  # beam_mmap
+           "save_particle_array_bin", "load_particle_array_bin", "read_particle_columns",  # beam_mmap
+           "LongitudinalTracker",  # long_track
+           "merge_particles", "split_particles", "resample_particle_array", "moments_report",  # resample
+           "track_moments", "parray_moments",  # moment_track
            "pi", "m_e_eV", "m_e_MeV", "m_e_GeV",  # globals
            "compensate_chromaticity",  # chromaticity
            "EbeamParams",  # e_beam_params
            "write_lattice",  # io
-           "CSR", "SpaceCharge", "Wake", "WakeTable", "WakeKick", "BeamTransform",
+           "CSR", "SpaceCharge", "Wake", "WakeTable", "WakeKick", "ResistiveWallWake", "BeamTransform",
            "EmptyProc",
            "MagneticLattice",
            ]
@@ -41,6 +53,13 @@ from ocelot.cpbd.sc import *
 from ocelot.cpbd.csr import *
 from ocelot.cpbd.wake3D import *
 from ocelot.cpbd.physics_proc import *
+from ocelot.cpbd.distributed import *
+from ocelot.cpbd.beam_mmap import *
+from ocelot.cpbd.checkpoint import *
+from ocelot.cpbd.diagnostics import *
+from ocelot.cpbd.long_track import *
+from ocelot.cpbd.resample import *
+from ocelot.cpbd.moment_track import *
 print('initializing ocelot...')
 logger = Logger()
 #xrange=range
@@ -1,6 +1,6 @@
 
 __all__ = ["read_lattice_elegant", "read_twi_file",
-           "astraBeam2particleArray", "particleArray2astraBeam",
+           "astraBeam2particleArray", "particleArray2astraBeam", "astraBeam2binary",
            ]
 
 from ocelot.adaptors.elegant2ocelot import *
@@ -1,6 +1,8 @@
 # from numpy.core.umath import sqrt
 from ocelot.common.globals import m_e_eV
 from ocelot.cpbd.beam import *
+from ocelot.cpbd.beam_mmap import BinaryBeamWriter
+from ocelot.common.text_io import read_text_columns, iter_text_chunks, format_e, CHUNK_BYTES
 import numpy as np
 
 
@@ -147,80 +149,131 @@ def exact_xxstg_2_xp_de(xxstg, gamref):
     return xp
 
 
+def astra_reference(P, s_ref=-1, Eref=-1):
+    """
+    reference of the ASTRA distribution, the first particle of the file is the reference particle
+
+    :param P: array (n, 10) - the first rows of the ASTRA file
+    :param s_ref: position of the reference particle [m], if negative - the position of the first particle
+    :param Eref: reference energy [GeV], if negative - the energy of the first particle
+    :return: dict: "s_ref", "Pref" [eV/c], "s0", "P0" - position and momentum of the first particle if the
+             particles are shifted to s_ref and Eref, otherwise None
+    """
+    ref = {"s_ref": s_ref, "Pref": None, "s0": None, "P0": None}
+    if s_ref < 0:
+        ref["s_ref"] = P[0, 2]
+    else:
+        ref["s0"] = P[0, 2]
+    if Eref < 0:
+        ref["Pref"] = P[0, 5]
+    else:
+        ref["Pref"] = np.sqrt(Eref ** 2 / m_e_GeV ** 2 - 1) * m_e_eV
+        ref["P0"] = P[0, 5]
+    return ref
+
+
+def astra_chunk2xxstg(P, ref, first=False):
+    """
+    ASTRA particles to ocelot coordinates, the array P is changed
+
+    :param P: array (k, 10) - rows of the ASTRA file
+    :param ref: dict - astra_reference()
+    :param first: True if P starts with the reference particle
+    :return: xxstg - array (k, 6), charge_array - array (k) in [C]
+    """
+    charge_array = -P[:, 7] * 1e-9  # charge in nC -> in C
+    xp = P[:, :6]
+    if first:
+        xp[0, 2] = 0.
+        xp[0, 5] = 0.
+    if ref["s0"] is not None:
+        xp[:, 2] = xp[:, 2] + ref["s0"] - ref["s_ref"]
+    if ref["P0"] is not None:
+        xp[:, 5] = xp[:, 5] + ref["P0"] - ref["Pref"]
+    gamref = np.sqrt((ref["Pref"] / m_e_eV) ** 2 + 1)
+    return exact_xp_2_xxstg_mad(xp, gamref), charge_array
+
+
 def astraBeam2particleArray(filename, s_ref=-1, Eref=-1):
     """
     function convert Astra beam distribution to Ocelot format - ParticleArray
     :type filename: str
     :return: ParticleArray
     """
-    P0 = np.loadtxt(filename)
-    charge_array = -P0[:, 7] * 1e-9  # charge in nC -> in C
+    P0 = read_text_columns(filename)
+    ref = astra_reference(P0, s_ref=s_ref, Eref=Eref)
+    xxstg, charge_array = astra_chunk2xxstg(P0, ref, first=True)
     print("Astra to Ocelot: charge = ", sum(charge_array))
     print("Astra to Ocelot: particles number = ", len(charge_array))
-    
-    xp = P0[:, :6]
-
-    if s_ref<0:
-        s_ref = xp[0, 2]
-        xp[0, 2] = 0.
-    else:
-        s0 = xp[0, 2]
-        xp[0, 2]=0.
-        xp[:,2]=xp[:,2]+s0-s_ref
-   
-    if Eref<0:
-        Pref = xp[0, 5]
-        xp[0, 5] = 0.
-    else:
-        Pref = np.sqrt(Eref ** 2 / m_e_GeV ** 2 - 1) * m_e_eV
-        P0 = xp[0, 5]
-        xp[0, 5] = 0.
-        xp[:,5] = xp[:,5] + P0 - Pref
-
-    #    print(xp[1:, 2])
-    #    plot(xp[1:, 2], xp[1:, 5]/Pref, "b.")
-    #    show()
-    gamref = np.sqrt((Pref / m_e_eV) ** 2 + 1)
-    xxstg = exact_xp_2_xxstg_mad(xp, gamref)
 
     p_array = ParticleArray(len(charge_array))
-    p_array.s = s_ref
-    p_array.E = np.sqrt((Pref / m_e_eV) ** 2 + 1) * m_e_GeV
+    p_array.s = ref["s_ref"]
+    p_array.E = np.sqrt((ref["Pref"] / m_e_eV) ** 2 + 1) * m_e_GeV
     print("Astra to Ocelot: energy = ", p_array.E)
     print("Astra to Ocelot: s pos = ", p_array.s)
-    p_array.rparticles[0] = xxstg[:, 0]
-    p_array.rparticles[1] = xxstg[:, 1]
-    p_array.rparticles[2] = xxstg[:, 2]
-    p_array.rparticles[3] = xxstg[:, 3]
-    p_array.rparticles[4] = xxstg[:, 4]
-    p_array.rparticles[5] = xxstg[:, 5]
+    p_array.rparticles[:] = xxstg.T
     p_array.q_array = charge_array
     return p_array
 
 
-def particleArray2astraBeam(p_array, filename="tytest.ast"):
+def astraBeam2binary(filename, bin_file, s_ref=-1, Eref=-1, chunk_bytes=CHUNK_BYTES):
+    """
+    streaming conversion of Astra beam distribution to the native binary beam file (see ocelot.cpbd.beam_mmap),
+    the file is read by chunks, the whole distribution is never kept in memory.
+    load_particle_array(bin_file) gives the same ParticleArray as astraBeam2particleArray(filename)
+
+    :param filename: Astra file name
+    :param bin_file: binary file name, usually *.ocb
+    :param s_ref: position of the reference particle [m], if negative - the position of the first particle
+    :param Eref: reference energy [GeV], if negative - the energy of the first particle
+    :param chunk_bytes: size of the text chunk
+    :return: number of particles
+    """
+    writer = None
+    try:
+        for P in iter_text_chunks(filename, chunk_bytes=chunk_bytes):
+            first = writer is None
+            if first:
+                ref = astra_reference(P, s_ref=s_ref, Eref=Eref)
+                E = np.sqrt((ref["Pref"] / m_e_eV) ** 2 + 1) * m_e_GeV
+                writer = BinaryBeamWriter(bin_file, E=E, s=ref["s_ref"])
+            xxstg, charge_array = astra_chunk2xxstg(P, ref, first=first)
+            writer.write(xxstg.T, charge_array)
+    finally:
+        if writer is not None:
+            writer.close()
+    return 0 if writer is None else writer.n
+
+
+def particleArray2astraBeam(p_array, filename="tytest.ast", chunk_size=100000):
     """
     function convert  Ocelot's ParticleArray to Astra beam distribution and save to "filename".
+    The particles are converted and written by chunks (memory-mapped ParticleArray is not loaded to memory)
     :param p_array:
     :param filename:
+    :param chunk_size: number of particles in the chunk
     :return:
     """
     gamref = p_array.E / m_e_GeV
     s0 = p_array.s
-    P = p_array.rparticles.view()
-    Np = int(P.size / 6)
-    xp = exact_xxstg_2_xp_mad(P, gamref)
     Pref = np.sqrt(p_array.E ** 2 / m_e_GeV ** 2 - 1) * m_e_eV
-    xp[:, 5] = xp[:, 5] + Pref
-    xp[:, 2] = xp[:, 2] + s0
-    xp[1:Np, 5] = xp[1:Np, 5] - xp[0, 5]
-    xp[1:Np, 2] = xp[1:Np, 2] - xp[0, 2]
-
-    charge_array = -p_array.q_array.reshape(len(p_array.q_array), 1) * 1e+9  # charge in C -> in nC
-    flag = np.zeros((len(charge_array), 1))
-    astra = np.append(xp, flag, axis=1)
-    astra = np.append(astra, charge_array, axis=1)
-    astra = np.append(astra, flag, axis=1)
-    astra = np.append(astra, flag, axis=1)
+    Np = p_array.rparticles.shape[1]
     print("SAVE")
-    np.savetxt(filename, astra, fmt='%.7e')
\ No newline at end of file
+    with open(filename, "wb") as f:
+        for i0 in range(0, Np, chunk_size):
+            i1 = min(i0 + chunk_size, Np)
+            xp = exact_xxstg_2_xp_mad(np.asarray(p_array.rparticles[:, i0:i1]), gamref)
+            xp[:, 5] = xp[:, 5] + Pref
+            xp[:, 2] = xp[:, 2] + s0
+            if i0 == 0:
+                ref = np.copy(xp[0])
+                xp[1:, 5] = xp[1:, 5] - ref[5]
+                xp[1:, 2] = xp[1:, 2] - ref[2]
+            else:
+                xp[:, 5] = xp[:, 5] - ref[5]
+                xp[:, 2] = xp[:, 2] - ref[2]
+
+            astra = np.zeros((i1 - i0, 10))
+            astra[:, :6] = xp
+            astra[:, 7] = -p_array.q_array[i0:i1] * 1e+9  # charge in C -> in nC
+            f.write(format_e(astra, precision=7))
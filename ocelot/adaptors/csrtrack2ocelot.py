@@ -2,6 +2,8 @@
 import numpy as np
 from ocelot.common.globals import *
 from ocelot.cpbd.beam import ParticleArray
+from ocelot.cpbd.beam_mmap import BinaryBeamWriter
+from ocelot.common.text_io import read_text_columns, iter_text_chunks, CHUNK_BYTES
 from scipy import interpolate
 
 
@@ -50,7 +52,7 @@ def SaveAstraParticles(outfile, PD, Q, findref=False, z0=None):
 
 
 def load_Astra_particles(filename):
-    PD = np.loadtxt(filename)
+    PD = read_text_columns(filename)
     n = len(PD[:, 0])
     Q = np.abs(np.sum(PD[:,7]))
     PD[1:n, 2] = PD[1:n, 2] + PD[0, 2]
@@ -58,54 +60,97 @@ def load_Astra_particles(filename):
     PD1 = PD[:, 0:6]
     return PD1, Q
 
-def csrtrackBeam2particleArray(filename, orient="H"):
+def csrtrack_coordinates(PD, orient="H"):
     #H z x y pz px py -> x y z px py pz
     #V z y x pz py px -> x y -z px py -pz
-    PD = np.loadtxt(filename)
-    #PD = load(infile)
-    n = np.shape(PD)[0] - 1 #length(PD(:,1))- 1
-    #print(n)
-    PD1 = np.zeros((n, 6))
-    Q = np.sum(PD[1:, 6])*1e9
-    t0 = PD[0, 0]
+    PD1 = np.zeros((len(PD), 6))
     if orient=='H':
-       PD1[:, 1-1] = PD[1:, 2-1]
-       PD1[:, 2-1] = PD[1:, 3-1]
-       PD1[:, 3-1] = PD[1:, 1-1]
-       PD1[:, 4-1] = PD[1:, 5-1]
-       PD1[:, 5-1] = PD[1:, 6-1]
-       PD1[:, 6-1] = PD[1:, 4-1]
+       PD1[:, 1-1] = PD[:, 2-1]
+       PD1[:, 2-1] = PD[:, 3-1]
+       PD1[:, 3-1] = PD[:, 1-1]
+       PD1[:, 4-1] = PD[:, 5-1]
+       PD1[:, 5-1] = PD[:, 6-1]
+       PD1[:, 6-1] = PD[:, 4-1]
     else:
-       PD1[:, 1-1] = -PD[1:, 3-1]
-       PD1[:, 2-1] =  PD[1:, 2-1]
-       PD1[:, 3-1] =  PD[1:, 1-1]
-       PD1[:, 4-1] = -PD[1:, 6-1]
-       PD1[:, 5-1] =  PD[1:, 5-1]
-       PD1[:, 6-1] =  PD[1:, 4-1]
-    #print("CSR", PD1[0, :])
-    for i in range(6):
-        PD1[1:n, i] = PD1[1:n, i] + PD1[0, i]
-
-    p_ref = np.sqrt(PD1[0, 3]**2 + PD1[0, 4]**2 + PD1[0, 5]**2)
-    px = PD1[:, 3]/ p_ref
-    py = PD1[:, 4] / p_ref
-    Eref = np.sqrt(m_e_eV ** 2 + p_ref ** 2)
-    pe = (np.sqrt(m_e_eV**2 + (PD1[:, 3]**2 + PD1[:, 4]**2 + PD1[:, 5]**2)) - Eref) / p_ref
-
-    p_array = ParticleArray(n)
-    p_array.rparticles[0] = PD1[:, 0] -    0*PD1[0, 0]
-    p_array.rparticles[2] = PD1[:, 1] -   0*PD1[0, 1]
-    p_array.rparticles[4] = -(PD1[:, 2] - PD1[0, 2])
-    p_array.rparticles[1] = px[:]
-    p_array.rparticles[3] = py[:]
-    p_array.rparticles[5] = pe[:]
+       PD1[:, 1-1] = -PD[:, 3-1]
+       PD1[:, 2-1] =  PD[:, 2-1]
+       PD1[:, 3-1] =  PD[:, 1-1]
+       PD1[:, 4-1] = -PD[:, 6-1]
+       PD1[:, 5-1] =  PD[:, 5-1]
+       PD1[:, 6-1] =  PD[:, 4-1]
+    return PD1
+
+
+def csrtrack_reference(ref):
+    # momentum and energy [eV] of the reference particle
+    p_ref = np.sqrt(ref[3]**2 + ref[4]**2 + ref[5]**2)
+    return p_ref, np.sqrt(m_e_eV ** 2 + p_ref ** 2)
+
+
+def csrtrack_rparticles(PD1, ref):
+    """
+    ocelot coordinates of CSRtrack particles
+
+    :param PD1: array (k, 6) - absolute x y z px py pz of the particles
+    :param ref: array (6) - the reference particle (the first particle of the file)
+    :return: array (6, k)
+    """
+    p_ref, Eref = csrtrack_reference(ref)
+    rparticles = np.zeros((6, len(PD1)))
+    rparticles[0] = PD1[:, 0]
+    rparticles[2] = PD1[:, 1]
+    rparticles[4] = -(PD1[:, 2] - ref[2])
+    rparticles[1] = PD1[:, 3] / p_ref
+    rparticles[3] = PD1[:, 4] / p_ref
+    rparticles[5] = (np.sqrt(m_e_eV**2 + (PD1[:, 3]**2 + PD1[:, 4]**2 + PD1[:, 5]**2)) - Eref) / p_ref
+    return rparticles
 
 
+def csrtrackBeam2particleArray(filename, orient="H"):
+    # the first line is the time, the first particle is the reference particle, the next particles are relative to it
+    PD = read_text_columns(filename)
+    PD1 = csrtrack_coordinates(PD[1:], orient=orient)
+    ref = PD1[0]
+    PD1[1:] = PD1[1:] + ref
+
+    p_array = ParticleArray(len(PD1))
+    p_array.rparticles[:] = csrtrack_rparticles(PD1, ref)
     p_array.q_array[:] = PD[1:, 6]
-    p_array.s = PD1[0, 2]
-    p_array.E = Eref*1e-9
+    p_array.s = ref[2]
+    p_array.E = csrtrack_reference(ref)[1] * 1e-9
     return p_array
 
+
+def csrtrackBeam2binary(filename, bin_file, orient="H", chunk_bytes=CHUNK_BYTES):
+    """
+    streaming conversion of CSRtrack beam distribution to the native binary beam file (see ocelot.cpbd.beam_mmap),
+    the file is read by chunks, the whole distribution is never kept in memory.
+    load_particle_array(bin_file) gives the same ParticleArray as csrtrackBeam2particleArray(filename, orient)
+
+    :param filename: CSRtrack file name
+    :param bin_file: binary file name, usually *.ocb
+    :param orient: "H" or "V"
+    :param chunk_bytes: size of the text chunk
+    :return: number of particles
+    """
+    writer = None
+    try:
+        for PD in iter_text_chunks(filename, chunk_bytes=chunk_bytes):
+            if writer is None:
+                PD = PD[1:]
+                PD1 = csrtrack_coordinates(PD, orient=orient)
+                ref = np.copy(PD1[0])
+                PD1[1:] = PD1[1:] + ref
+                E = csrtrack_reference(ref)[1] * 1e-9
+                writer = BinaryBeamWriter(bin_file, E=E, s=ref[2])
+            else:
+                PD1 = csrtrack_coordinates(PD, orient=orient) + ref
+            writer.write(csrtrack_rparticles(PD1, ref), PD[:, 6])
+    finally:
+        if writer is not None:
+            writer.close()
+    return 0 if writer is None else writer.n
+
 #def xyz2ParticleArray():
 
 
@@ -0,0 +1,150 @@
+"""
+Fast reading and writing of numeric text files (columns separated by whitespace), e.g. ASTRA and CSRtrack particle
+files. The files are processed by chunks, the text of the whole file is never kept in memory.
+
+Reading: the chunks are parsed by the C parser of np.loadtxt (numpy >= 1.23) or of np.fromstring (older numpy, where
+np.loadtxt is pure python). The values are identical to np.loadtxt.
+Writing: the "%.<precision>e" formatting is vectorized, the text is identical to np.savetxt(fmt="%.<precision>e").
+"""
+
+import io
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_BYTES = 1 << 25      # size of the text chunk
+C_LOADTXT = np.lib.NumpyVersion(np.__version__) >= "1.23.0"
+
+
+def iter_text_chunks(filename, chunk_bytes=CHUNK_BYTES, skiprows=0):
+    """
+    iterator over the chunks of the numeric text file
+
+    :param filename: file name
+    :param chunk_bytes: size of the text chunk
+    :param skiprows: number of the header lines
+    :return: iterator of arrays (rows, columns)
+    """
+    with open(filename, "rb") as f:
+        for i in range(skiprows):
+            f.readline()
+        first = f.readline()
+        while first and not first.strip():
+            first = f.readline()
+        n_cols = len(first.split())
+        # the incomplete last line of the chunk is moved to the next chunk
+        text = first
+        while True:
+            block = f.read(chunk_bytes)
+            text = text + block
+            if not block:
+                if text.strip():
+                    yield parse_text(text, n_cols)
+                return
+            k = text.rfind(b"\n")
+            if k < 0:
+                continue
+            yield parse_text(text[:k + 1], n_cols)
+            text = text[k + 1:]
+
+
+def parse_text(text, n_cols):
+    """
+    parse the block of complete lines
+
+    :param text: bytes
+    :param n_cols: number of columns
+    :return: array (rows, n_cols)
+    """
+    if C_LOADTXT:
+        return np.loadtxt(io.BytesIO(text), ndmin=2)
+    values = np.fromstring(text, sep=" ")
+    if n_cols == 0 or values.size % n_cols != 0:
+        raise ValueError("parse_text: the text block is not a table of " + str(n_cols) + " columns")
+    return values.reshape(-1, n_cols)
+
+
+def read_text_columns(filename, chunk_bytes=CHUNK_BYTES, skiprows=0):
+    """
+    np.loadtxt() for the numeric text files, the same array
+
+    :param filename: file name
+    :param chunk_bytes: size of the text chunk
+    :param skiprows: number of the header lines
+    :return: array (rows, columns)
+    """
+    chunks = list(iter_text_chunks(filename, chunk_bytes=chunk_bytes, skiprows=skiprows))
+    if len(chunks) == 1:
+        return chunks[0]
+    return np.concatenate(chunks)
+
+
+def format_e(A, precision=7):
+    """
+    text of the table A as np.savetxt(fmt="%.<precision>e") writes it
+
+    :param A: array (rows, columns)
+    :param precision: number of the digits after the point
+    :return: bytes
+    """
+    A = np.asarray(A, dtype=np.float64)
+    rows, cols = A.shape
+    if not np.all(np.isfinite(A)):
+        row = " ".join(["%." + str(precision) + "e"] * cols) + "\n"
+        return ((row * rows) % tuple(A.ravel())).encode("ascii")
+    x = A.ravel()
+    nd = precision + 1
+    a = np.abs(x)
+    nz = a > 0
+    # the extreme values (scaling by 10^precision would overflow) are formatted by the python
+    fast = nz & (a > 1e-280) & (a < 1e280)
+    e = np.zeros(x.size, dtype=np.int64)
+    e[fast] = np.floor(np.log10(a[fast])).astype(np.int64)
+    # mantissa digits as integer, the value can be out of [10^precision, 10^nd) if log10 is inaccurate
+    scaled = np.zeros(x.size)
+    scaled[fast] = a[fast] * 10. ** (precision - e[fast]).astype(np.float64)
+    M = np.rint(scaled).astype(np.int64)
+    frac = scaled - np.floor(scaled)
+    # round half cases and the cases near the power of 10 are formatted by the python (C printf)
+    check = (nz & ~fast) | (fast & ((np.abs(frac - 0.5) < 1e-5) | (M < 10 ** precision) | (M >= 10 ** nd) |
+                                    (scaled < 10 ** precision) | (scaled >= 10 ** nd - 0.5)))
+    for i in np.flatnonzero(check):
+        s = ("%." + str(precision) + "e") % a[i]
+        mant, ex = s.split("e")
+        M[i] = int(mant.replace(".", ""))
+        e[i] = int(ex)
+    # layout of the field: sign, digit, ".", precision digits, "e", exponent sign, 3 exponent digits, separator
+    W = nd + 8
+    out = np.zeros((x.size, W), dtype=np.uint8)     # zeros are removed at the end
+    out[:, 0] = np.where(np.signbit(x), ord("-"), 0)
+    for k in range(nd - 1, -1, -1):
+        out[:, 1 + k + (k > 0)] = ord("0") + M % 10
+        M //= 10
+    out[:, 2] = ord(".")
+    out[:, nd + 2] = ord("e")
+    out[:, nd + 3] = np.where(e < 0, ord("-"), ord("+"))
+    ea = np.abs(e)
+    out[:, nd + 4] = np.where(ea >= 100, ord("0") + ea // 100, 0)
+    out[:, nd + 5] = ord("0") + (ea // 10) % 10
+    out[:, nd + 6] = ord("0") + ea % 10
+    out = out.reshape(rows, cols, W)
+    out[:, :, W - 1] = ord(" ")
+    out[:, -1, W - 1] = ord("\n")
+    out = out.ravel()
+    return out[out != 0].tobytes()
+
+
+def write_text_columns(filename, A, precision=7, chunk_rows=100000):
+    """
+    np.savetxt(filename, A, fmt="%.<precision>e"), the same file
+
+    :param filename: file name
+    :param A: array (rows, columns)
+    :param precision: number of the digits after the point
+    :param chunk_rows: number of the rows which are formatted at once
+    :return: None
+    """
+    with open(filename, "wb") as f:
+        for i0 in range(0, len(A), chunk_rows):
+            f.write(format_e(A[i0:i0 + chunk_rows], precision=precision))
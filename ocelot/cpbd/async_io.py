@@ -0,0 +1,115 @@
+"""
+Asynchronous writing of the tracking outputs (beam files, twiss files).
+
+The arrays are copied at the moment of the request and are written by the background thread, so the tracking
+continues during the compression and the writing. The queue is bounded: if the writer is behind by maxsize files,
+the next request waits (backpressure) instead of accumulating copies of the beam in memory.
+track() flushes the writer at the end, all pending files are also written at the exit of the interpreter.
+"""
+
+import atexit
+import threading
+import queue
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncWriter:
+    """
+    background writer with the bounded queue of the write jobs
+    """
+    def __init__(self, maxsize=4):
+        """
+        :param maxsize: maximal number of the pending jobs
+        """
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = None
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        add the job func(*args, **kwargs) to the queue, waits if the queue is full.
+        The arguments must not be changed after the submission (pass copies).
+
+        :return: None
+        """
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._worker)
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put((func, args, kwargs))
+
+    def _worker(self):
+        while True:
+            func, args, kwargs = self.queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.error("AsyncWriter: " + str(e))
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        wait until all submitted jobs are done, the first error of the jobs is raised
+
+        :return: None
+        """
+        self.queue.join()
+        if len(self.errors) > 0:
+            error = self.errors[0]
+            self.errors = []
+            raise error
+
+
+async_writer = AsyncWriter()
+atexit.register(async_writer.flush)
+
+
+def savez_compressed_async(filename, writer=None, **arrays):
+    """
+    np.savez_compressed() in the background thread, the arrays are copied
+
+    :param filename: file name
+    :param writer: AsyncWriter, if None the default async_writer is used
+    :param arrays: arrays to save
+    :return: None
+    """
+    writer = async_writer if writer is None else writer
+    arrays = dict([(key, np.copy(val)) for key, val in arrays.items()])
+    writer.submit(np.savez_compressed, filename, **arrays)
+
+
+def save_particle_array_async(filename, p_array, writer=None):
+    """
+    save_particle_array() in the background thread, the format is chosen by save_particle_array()
+    (e.g. *.ocb - native binary format), the arrays of the remaining particles are copied
+
+    :param filename: file name
+    :param p_array: ParticleArray
+    :param writer: AsyncWriter, if None the default async_writer is used
+    :return: None
+    """
+    from ocelot.cpbd.beam import ParticleArray, save_particle_array
+    writer = async_writer if writer is None else writer
+    p_array = p_array.without_lost()
+    p_copy = ParticleArray()
+    p_copy.rparticles = np.copy(p_array.rparticles)
+    p_copy.q_array = np.copy(p_array.q_array)
+    p_copy.E = p_array.E
+    p_copy.s = p_array.s
+    writer.submit(save_particle_array, filename, p_copy)
+
+
+def flush_writes():
+    """
+    wait until all files of the default async_writer are written
+
+    :return: None
+    """
+    async_writer.flush()
@@ -1,6 +1,7 @@
 '''
 definition of particles, beams and trajectories
 '''
+import os
 import numpy as np
 from numpy import sqrt, cos, sin, std, mean
 from ocelot.common.globals import *
@@ -11,6 +12,8 @@ from copy import deepcopy
 #import pickle
 from scipy import interpolate
 from scipy.signal import savgol_filter
+from scipy.ndimage import gaussian_filter1d
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 logger = logging.getLogger(__name__)
@@ -298,16 +301,7 @@ class BeamArray(Beam):
 
     def params(self):
         l = self.len()
-        attrs=[]
-        for attr in dir(self):
-            if attr.startswith('__') or attr in self.properties:
-                continue
-            # if callable(getattr(self,attr)):
-                # print('check')
-                # continue
-            if np.size(getattr(self,attr)) == l:
-                attrs.append(attr)
-        return attrs
+        return [attr for attr, value in self.__dict__.items() if np.size(value) == l]
 
     def sort(self):
         inds = self.s.argsort()
@@ -321,9 +315,8 @@ class BeamArray(Beam):
         if (np.abs(dsarr-dsm)/dsm > 1/1000).any():
             s_new = np.linspace(np.amin(self.s), np.amax(self.s), self.len())
             for attr in self.params():
-                if attr is 's':
+                if attr == 's':
                     continue
-                print(attr)
                 val = getattr(self,attr)
                 val = np.interp(s_new, self.s, val)
             #    val = convolve(val,spike,mode='same')
@@ -339,12 +332,9 @@ class BeamArray(Beam):
         if not sn%2:
             sn += 1
 
-        for attr in self.params():
-            if attr is 's':
-                continue
-            val = getattr(self,attr)
-            val = savgol_filter(val,sn,2,mode='nearest')
-        #    val = convolve(val,spike,mode='same')
+        attrs = [attr for attr in self.params() if attr != 's']
+        vals = savgol_filter(np.array([getattr(self, attr) for attr in attrs], dtype=float), sn, 2, mode='nearest')
+        for attr, val in zip(attrs, vals):
             setattr(self,attr,val)
 
     def get_s(self, s):
@@ -360,10 +350,7 @@ class BeamArray(Beam):
         else:
             beam_slice = deepcopy(self)
 
-        for attr in dir(self):
-            if attr.startswith('__') or callable(getattr(self,attr)):
-                continue
-            value = getattr(self,attr)
+        for attr, value in self.__dict__.items():
             if np.size(value) == l:
                 setattr(beam_slice,attr,value[index])
             else:
@@ -373,11 +360,7 @@ class BeamArray(Beam):
     def __delitem__(self,index):
         l = self.len()
         for attr in self.params():
-            if attr.startswith('__') or callable(getattr(self, attr)):
-                continue
-            value = getattr(self, attr)
-            if np.size(value) == l:
-                setattr(self, attr, np.delete(value, index))
+            setattr(self, attr, np.delete(getattr(self, attr), index))
 
     def pk(self):
         return self[self.idx_max()]
@@ -426,27 +409,129 @@ class ParticleArray:
     array of particles of fixed size; for optimized performance
     (x, x' = px/p0),(y, y' = py/p0),(ds = c*tau, p = dE/(p0*c))
     p0 - momentum
+    Lost particles are masked (see mark_lost()) and are removed from the arrays only when their fraction
+    exceeds compact_fraction.
     """
+    compact_fraction = 0.25           # fraction of the lost particles which triggers compact()
+
     def __init__(self, n=0):
         #self.particles = zeros(n*6)
         self.rparticles = np.zeros((6, n))#np.transpose(np.zeros(int(n), 6))
         self.q_array = np.zeros(n)    # charge
         self.s = 0.0
         self.E = 0.0
-
-    def rm_tails(self, xlim, ylim, px_lim, py_lim):
+        self.lprofile = None          # LongitudinalProfile, see ParticleArray.longitudinal_profile()
+        self.profile_version = 0      # is increased by invalidate_profile(), the cached profile is valid for it
+        self.comm = None              # communicator of the distributed tracking, see ocelot.cpbd.distributed
+        self.lost = None              # None or bool array (n) - mask of the lost particles
+        self.ids = None               # None or int array (n) - initial indices of the particles (after compact())
+        self.losses = []              # records of the lost particles, see lost_particles()
+
+    def rm_tails(self, xlim, ylim, px_lim, py_lim, turn=-1):
         """
-        comment behaviour and possibly move out of class
+        mark the particles outside of the limits (or with nan coordinates) as lost, see mark_lost()
+
+        :return: indices of the newly lost particles
         """
         x = abs(self.x())
         px = abs(self.px())
         y = abs(self.y())
         py = abs(self.py())
-        ind_angles = np.append(np.argwhere(px > px_lim), np.argwhere(py > py_lim))
-        p_idxs = np.unique(np.append(np.argwhere(x > xlim), np.append(np.argwhere(y > ylim), np.append(np.argwhere(x != x), np.append(np.argwhere(y!= y), ind_angles)) )))
-        #e_idxs = [append([], x) for x in array([6*p_idxs, 6*p_idxs+1, 6*p_idxs+2, 6*p_idxs+3, 6*p_idxs+4, 6*p_idxs+5])]
-        self.rparticles = np.delete(self.rparticles, p_idxs, axis=1)
-        return p_idxs
+        mask = (x > xlim) | (y > ylim) | (px > px_lim) | (py > py_lim) | (x != x) | (y != y)
+        return self.mark_lost(mask, turn=turn)
+
+    def mark_lost(self, mask, turn=-1):
+        """
+        mark the particles as lost. The initial indices, the coordinates and the charges at the loss, s and the turn
+        are recorded (see lost_particles()). The charges of the lost particles are set to zero, the coordinates are
+        kept: the transfer maps are applied to them as to the others (the coordinates can diverge).
+        get_envelope(), the longitudinal profile and the slice diagnostics ignore them (see without_lost()).
+        The arrays are compacted if the fraction of the lost particles exceeds compact_fraction.
+
+        :param mask: bool array (n) or indices of the particles
+        :param turn: turn number
+        :return: indices of the newly lost particles (before the compaction)
+        """
+        n = self.rparticles.shape[1]
+        if self.lost is None:
+            self.lost = np.zeros(n, dtype=bool)
+        if self.ids is None:
+            self.ids = np.arange(n)
+        new = np.zeros(n, dtype=bool)
+        new[mask] = True
+        new &= ~self.lost
+        idx = np.flatnonzero(new)
+        if len(idx) > 0:
+            # the beams without charges (e.g. ParticleArray(), rparticles set by hand) have the empty q_array
+            charged = len(self.q_array) == n
+            q = self.q_array[idx] if charged else np.ones(len(idx)) * np.nan
+            self.losses.append((self.ids[idx], np.ones(len(idx)) * self.s, np.ones(len(idx), dtype=int) * turn,
+                                self.rparticles[:, idx], q))
+            self.lost[idx] = True
+            if charged:
+                self.q_array[idx] = 0.
+            self.invalidate_profile()
+        if np.count_nonzero(self.lost) > self.compact_fraction * n:
+            self.compact()
+        return idx
+
+    def compact(self):
+        """
+        remove the lost particles from the arrays, ids keeps the initial indices of the remaining particles
+
+        :return: None
+        """
+        if self.lost is None:
+            return
+        alive = ~self.lost
+        if len(self.q_array) == len(alive):
+            self.q_array = self.q_array[alive]
+        self.rparticles = self.rparticles[:, alive]
+        self.ids = self.ids[alive]
+        self.lost = None
+        self.invalidate_profile()
+
+    def alive_indices(self):
+        """
+        :return: indices of the particles which are not lost
+        """
+        if self.lost is None:
+            return np.arange(self.rparticles.shape[1])
+        return np.flatnonzero(~self.lost)
+
+    def without_lost(self):
+        """
+        the beam without the lost particles for the diagnostics, the ParticleArray itself is not changed
+
+        :return: self if no particle is lost, otherwise new ParticleArray with the copies of the remaining particles
+        """
+        if self.lost is None or not np.any(self.lost):
+            return self
+        alive = ~self.lost
+        p_array = ParticleArray()
+        p_array.rparticles = self.rparticles[:, alive]
+        if len(self.q_array) == len(alive):
+            p_array.q_array = self.q_array[alive]
+        p_array.ids = None if self.ids is None else self.ids[alive]
+        p_array.E = self.E
+        p_array.s = self.s
+        return p_array
+
+    def lost_particles(self):
+        """
+        record of the lost particles
+
+        :return: dict: "ids" - initial indices, "s" - position of the loss, "turn" - turn of the loss,
+                 "rparticles" - array (6, n_lost) of the coordinates at the loss, "q" - charges of the particles
+                 (NaN for the records of the old checkpoints)
+        """
+        if len(self.losses) == 0:
+            return {"ids": np.zeros(0, dtype=int), "s": np.zeros(0), "turn": np.zeros(0, dtype=int),
+                    "rparticles": np.zeros((6, 0)), "q": np.zeros(0)}
+        q = [rec[4] if len(rec) > 4 else np.ones(len(rec[0])) * np.nan for rec in self.losses]
+        ids, s, turn, rparticles = list(zip(*[rec[:4] for rec in self.losses]))
+        return {"ids": np.concatenate(ids), "s": np.concatenate(s), "turn": np.concatenate(turn),
+                "rparticles": np.concatenate(rparticles, axis=1), "q": np.concatenate(q)}
 
     def __getitem__(self, idx):
         return Particle(x=self.rparticles[0, idx], px=self.rparticles[1, idx],
@@ -465,6 +550,7 @@ class ParticleArray:
 
     def list2array(self, p_list):
         self.rparticles = np.zeros((6, len(p_list)))
+        self.q_array = np.zeros(len(p_list))
         for i, p in enumerate(p_list):
             self[i] = p
         self.s = p_list[0].s
@@ -506,14 +592,307 @@ class ParticleArray:
     @t.setter
     def t(self,value):
         self.rparticles[4] = value
+        self.invalidate_profile()
+
+    def longitudinal_profile(self):
+        """
+        Longitudinal profile of the beam which is shared between the collective effects (CSR, Wake, ...)
+        during one step. The profile is calculated lazily and is recalculated if rparticles or q_array were
+        replaced or invalidate_profile() was called. Every in-place change of x, y, tau or the charges has to call
+        invalidate_profile(): the transfer maps, mark_lost(), compact() and the physics processes which move
+        the particles (e.g. SmoothBeam) do it.
+        In the distributed tracking (ParticleArray.comm is not None) the grids and the currents of the profile
+        are calculated for the whole beam.
+
+        :return: LongitudinalProfile
+        """
+        lp = self.lprofile
+        if (lp is None or lp.version != self.profile_version or lp.rparticles is not self.rparticles or
+                lp.q_array is not self.q_array):
+            lp = LongitudinalProfile(self.tau(), self.q_array, x=self.x(), y=self.y(), comm=self.comm, lost=self.lost)
+            lp.rparticles = self.rparticles
+            lp.version = self.profile_version
+            self.lprofile = lp
+        return lp
+
+    def invalidate_profile(self):
+        """
+        the method has to be called after every in-place change of x, y, tau or q_array
+
+        :return: None
+        """
+        self.lprofile = None
+        self.profile_version += 1
+
+
+class ParticleArrayBatch:
+    """
+    ensemble of M beams (members) with N particles each, e.g. copies of one beam for jitter and tolerance studies
+    rparticles - array (6, M, N), the coordinates of all members can be reshaped to (6, M*N) without copying
+    q_array - array (M, N) charges
+    E - array (M) reference energies of the members
+    """
+    def __init__(self, n=0, m=0):
+        self.rparticles = np.zeros((6, m, n))
+        self.q_array = np.zeros((m, n))
+        self.E = np.zeros(m)
+        self.s = 0.0
+
+    def n_members(self):
+        return self.rparticles.shape[1]
+
+    def n_particles(self):
+        return self.rparticles.shape[2]
+
+    def member(self, m):
+        """
+        ParticleArray of the member m (copy)
+
+        :param m: index of the member
+        :return: ParticleArray
+        """
+        p_array = ParticleArray()
+        p_array.rparticles = np.copy(self.rparticles[:, m, :])
+        p_array.q_array = np.copy(self.q_array[m])
+        p_array.E = self.E[m]
+        p_array.s = self.s
+        return p_array
+
+    def member_view(self, m):
+        """
+        ParticleArray of the member m without copying, the coordinates and the charges are the views of the batch
+        arrays: it can be read (e.g. by get_envelope()), the changes of the values are the changes of the batch
+
+        :param m: index of the member
+        :return: ParticleArray
+        """
+        p_array = ParticleArray()
+        p_array.rparticles = self.rparticles[:, m, :]
+        p_array.q_array = self.q_array[m]
+        p_array.E = self.E[m]
+        p_array.s = self.s
+        return p_array
+
+    def set_member(self, m, p_array):
+        """
+        copy the coordinates, the charges and the energy of the ParticleArray to the member m
+
+        :param m: index of the member
+        :param p_array: ParticleArray with the same number of particles
+        :return: None
+        """
+        self.rparticles[:, m, :] = p_array.rparticles
+        self.q_array[m] = p_array.q_array
+        self.E[m] = p_array.E
+
+
+def particle_array_batch(p_array, m=1):
+    """
+    batch of m copies of the beam, or of the list of beams with the same number of particles
+
+    :param p_array: ParticleArray or list of ParticleArray
+    :param m: number of the copies if p_array is ParticleArray
+    :return: ParticleArrayBatch
+    """
+    p_arrays = p_array if isinstance(p_array, (list, tuple)) else [p_array] * m
+    batch = ParticleArrayBatch(n=p_arrays[0].rparticles.shape[1], m=len(p_arrays))
+    for i, p in enumerate(p_arrays):
+        batch.set_member(i, p)
+    batch.s = p_arrays[0].s
+    return batch
+
+
+def triang_filter(x, filter_order):
+    Ns = x.shape[0]
+    for i in range(filter_order):
+        x[1:Ns] = (x[1:Ns] + x[0:Ns-1])*0.5
+        x[0:Ns-1] = (x[1:Ns] + x[0:Ns-1])*0.5
+    return x
+
+
+class LongitudinalProfile:
+    """
+    Longitudinal profile of the beam: sort order of the particles, indices of the particles on the
+    equidistant longitudinal grids and generalized (moment) currents on these grids.
+    Everything is calculated on request and is cached.
+
+    moments of the currents:
+        "00" - q, "10" - q*x, "01" - q*y, "11" - q*x*y, "20_02" - q*(x^2 - y^2)
+    """
+    def __init__(self, tau, q_array, x=None, y=None, comm=None, lost=None):
+        """
+        :param tau: longitudinal coordinates of the particles
+        :param q_array: charges of the particles
+        :param x: horizontal coordinates, are needed for the moments "10", "11", "20_02"
+        :param y: vertical coordinates, are needed for the moments "01", "11", "20_02"
+        :param comm: communicator (mpi4py or ocelot.cpbd.distributed.PipeComm) if the particles are distributed
+                     between processes. The grids and the currents are calculated for the particles of all processes,
+                     sort_indx is local.
+        :param lost: None or bool array - the lost particles, they are outside of the grids and
+                     have no charge, the interpolated values at them are the values at the first grid point
+        """
+        self.tau = tau
+        self.q_array = q_array
+        self.x = x
+        self.y = y
+        self.comm = comm
+        self.lost = lost if lost is not None and np.any(lost) else None
+        self.rparticles = None      # arrays of the ParticleArray and its profile_version, see
+        self.version = None         # ParticleArray.longitudinal_profile()
+        self._sort_indx = None
+        self._grids = {}
+        self._currents = {}
+
+    @property
+    def sort_indx(self):
+        """
+        indices which sort the particles in tau
+        """
+        if self._sort_indx is None:
+            self._sort_indx = np.argsort(self.tau)
+        return self._sort_indx
+
+    def grid(self, n_points, filter_order):
+        """
+        equidistant grid with n_points between min(tau) and max(tau) and filter_order/2 points on the both sides
+
+        :param n_points: number of sampling points
+        :param filter_order: filter order
+        :return: s, ds, i0, di0 - grid, grid step, indices of the left grid points and
+                 relative distances of the particles to them
+        """
+        key = (n_points, filter_order)
+        if key not in self._grids:
+            tau = self.tau if self.lost is None else self.tau[~self.lost]
+            s0 = np.min(tau) if len(tau) > 0 else 0.
+            s1 = np.max(tau) if len(tau) > 0 else 0.
+            if self.comm is not None:
+                bounds = np.array(self.comm.allgather((s0, s1)))
+                s0 = np.min(bounds[:, 0])
+                s1 = np.max(bounds[:, 1])
+            NF2 = int(np.floor(filter_order / 2.))
+            n_points = n_points + 2 * NF2
+            ds = (s1 - s0) / (n_points - 2 - 2 * NF2)
+            s = s0 + np.arange(-NF2, n_points - NF2) * ds
+            Ip = (self.tau - s0) / ds
+            if self.lost is not None:
+                Ip[self.lost] = 0.
+            I0 = np.floor(Ip)
+            di0 = Ip - I0
+            i0 = I0.astype(int) + NF2
+            self._grids[key] = (s, ds, i0, di0)
+        return self._grids[key]
+
+    def grid_interp(self, n_points, filter_order, y):
+        """
+        linear interpolation of the function y given on the grid(n_points, filter_order) to the particles
+
+        :param n_points: number of sampling points
+        :param filter_order: filter order
+        :param y: function values on the grid
+        :return: array of the function values at the particles positions
+        """
+        s, ds, i0, di0 = self.grid(n_points, filter_order)
+        return y[i0] * (1 - di0) + y[i0 + 1] * di0
+
+    def moment_factor(self, moment):
+        """
+        factor f of the moment charge q*f, None for q
+        """
+        if moment == "00":
+            return None
+        if moment not in ("10", "01", "11", "20_02"):
+            raise ValueError("LongitudinalProfile: unknown moment " + str(moment))
+        # the coordinates of the lost particles can be infinite or nan, their charges are zero
+        with np.errstate(over="ignore", invalid="ignore"):
+            if moment == "10":
+                f = self.x
+            elif moment == "01":
+                f = self.y
+            elif moment == "11":
+                f = self.x * self.y
+            else:
+                f = self.x * self.x - self.y * self.y
+        return f if self.lost is None else np.where(self.lost, 0., f)
+
+    def currents(self, n_points, filter_order, mean_vel, moments=("00",)):
+        """
+        generalized currents with the linear charge deposition on the grid, see s2current().
+        The currents of all requested moments, which are not in the cache yet, are calculated together
+        with the common grid indices and weights.
+
+        :param n_points: number of sampling points
+        :param filter_order: filter order
+        :param mean_vel: mean velocity
+        :param moments: list of the moments, e.g. ["00", "10", "01"]
+        :return: dict {moment: I}, I - array (n_points + 2*floor(filter_order/2), 2),
+                 I[:, 0] - grid, I[:, 1] - current
+        """
+        new_moments = [m for m in moments if (n_points, filter_order, mean_vel, m) not in self._currents]
+        if len(new_moments) > 0:
+            s, ds, i0, di0 = self.grid(n_points, filter_order)
+            n = len(s)
+            w1 = (1 - di0) * self.q_array
+            w2 = di0 * self.q_array
+            for moment in new_moments:
+                f = self.moment_factor(moment)
+                if f is None:
+                    Ro = np.bincount(i0, weights=w1, minlength=n)
+                    Ro += np.bincount(i0 + 1, weights=w2, minlength=n)
+                else:
+                    Ro = np.bincount(i0, weights=w1 * f, minlength=n)
+                    Ro += np.bincount(i0 + 1, weights=w2 * f, minlength=n)
+                if self.comm is not None:
+                    Ro = self.comm.allreduce(Ro)
+                if filter_order > 0:
+                    triang_filter(Ro, filter_order)
+                I = np.zeros([n, 2])
+                I[:, 0] = s
+                I[:, 1] = Ro * mean_vel / ds
+                self._currents[(n_points, filter_order, mean_vel, moment)] = I
+        return dict([(m, np.copy(self._currents[(n_points, filter_order, mean_vel, m)])) for m in moments])
+
+    def current(self, n_points, filter_order, mean_vel, moment="00"):
+        """
+        generalized current, see LongitudinalProfile.currents()
+
+        :param n_points: number of sampling points
+        :param filter_order: filter order
+        :param mean_vel: mean velocity
+        :param moment: "00", "10", "01", "11" or "20_02"
+        :return: I - array (n_points + 2*floor(filter_order/2), 2), I[:, 0] - grid, I[:, 1] - current
+        """
+        return self.currents(n_points, filter_order, mean_vel, moments=[moment])[moment]
 
 
 def save_particle_array(filename, p_array):
+    """
+    save ParticleArray, the files *.ocb are written in the native binary format (see beam_mmap.py),
+    otherwise np.savez_compressed() is used. The lost particles are not saved.
+
+    :param filename: file name
+    :param p_array: ParticleArray
+    :return: None
+    """
+    from ocelot.cpbd.beam_mmap import BINARY_EXT, save_particle_array_bin
+    p_array = p_array.without_lost()
+    if filename.endswith(BINARY_EXT):
+        save_particle_array_bin(filename, p_array)
+        return
     np.savez_compressed(filename, rparticles=p_array.rparticles,
                         q_array=p_array.q_array,
                         E=p_array.E, s=p_array.s)
 
 def load_particle_array(filename):
+    """
+    load ParticleArray, the files *.ocb (native binary format) are memory-mapped copy on write
+
+    :param filename: file name
+    :return: ParticleArray
+    """
+    from ocelot.cpbd.beam_mmap import BINARY_EXT, load_particle_array_bin
+    if filename.endswith(BINARY_EXT):
+        return load_particle_array_bin(filename)
     p_array = ParticleArray()
     with np.load(filename) as data:
         for key in data.keys():
@@ -532,98 +911,254 @@ def recalculate_ref_particle(p_array):
     return p_array
 
 
-def get_envelope(p_array, tws_i=Twiss()):
-    tws = Twiss()
-    p = p_array.p()
-    dx = tws_i.Dx*p
-    dy = tws_i.Dy*p
-    dpx = tws_i.Dxp*p
-    dpy = tws_i.Dyp*p
-    x = p_array.x() - dx
-    px = p_array.px() - dpx
-
-    y = p_array.y() - dy
-    py = p_array.py() - dpy
-    if ne_flag:
-        px = ne.evaluate('px * (1. - 0.5 * px * px - 0.5 * py * py)')
-        py = ne.evaluate('py * (1. - 0.5 * px * px - 0.5 * py * py)')
-    else:
-        px = px*(1.-0.5*px*px - 0.5*py*py)
-        py = py*(1.-0.5*px*px - 0.5*py*py)
-    tws.x = np.mean(x)
-    tws.y = np.mean(y)
-    tws.px =np.mean(px)
-    tws.py =np.mean(py)
-
-    if ne_flag:
-        tw_x = tws.x
-        tw_y = tws.y
-        tw_px = tws.px
-        tw_py = tws.py
-        tws.xx =  np.mean(ne.evaluate('(x - tw_x) * (x - tw_x)'))
-        tws.xpx = np.mean(ne.evaluate('(x - tw_x) * (px - tw_px)'))
-        tws.pxpx =np.mean(ne.evaluate('(px - tw_px) * (px - tw_px)'))
-        tws.yy =  np.mean(ne.evaluate('(y - tw_y) * (y - tw_y)'))
-        tws.ypy = np.mean(ne.evaluate('(y - tw_y) * (py - tw_py)'))
-        tws.pypy =np.mean(ne.evaluate('(py - tw_py) * (py - tw_py)'))
+def envelope_coordinates(Y, tws_i):
+    # in place: dispersion correction and px, py -> x', y' (as in get_envelope) of the block Y (6, k)
+    p = Y[5]
+    for i, D in ((0, tws_i.Dx), (1, tws_i.Dxp), (2, tws_i.Dy), (3, tws_i.Dyp)):
+        if D != 0.:
+            Y[i] -= D * p
+    px = Y[1]
+    py = Y[3]
+    for u in (px, py):
+        t = px * px
+        t += py * py
+        t *= -0.5
+        t += 1.
+        u *= t
+
+
+MOMENTS_EXECUTORS = {}      # thread pools of beam_moments() {number of threads: ThreadPoolExecutor}
+
+
+def moments_executor(n_threads):
+    # the thread pool is created once and reused by all calls
+    if n_threads not in MOMENTS_EXECUTORS:
+        MOMENTS_EXECUTORS[n_threads] = ThreadPoolExecutor(max_workers=n_threads)
+    return MOMENTS_EXECUTORS[n_threads]
+
+
+def partial_moments(X, tws_i=None, block_size=65536, n_threads=None, lost=None):
+    """
+    moments of the particle coordinates in one blocked pass over the array, see beam_moments().
+    The result of the parts of the beam (e.g. of the processes of the distributed tracking) are combined
+    by merge_moments().
+
+    :param X: array (6, n), e.g. p_array.rparticles (can be memory-mapped)
+    :param tws_i: None - moments of X, Twiss - moments of the coordinates of get_envelope(), see beam_moments()
+    :param block_size: number of particles in the block
+    :param n_threads: number of threads, if None os.cpu_count()
+    :param lost: None or bool array (n) - the particles which are excluded
+    :return: (n, mean, S) - number of the particles, mean vector, sum of the outer products of the deviations
+             from the mean, None if there are no particles
+    """
+    n = X.shape[1]
+    if n == 0 or (lost is not None and np.all(lost)):
+        return None
+    bounds = [(i0, min(i0 + block_size, n)) for i0 in range(0, n, block_size)]
+
+    def block_moments(b):
+        if lost is None:
+            Y = np.array(X[:, b[0]:b[1]], dtype=np.float64)
+        else:
+            Y = np.array(X[:, b[0]:b[1]][:, ~lost[b[0]:b[1]]], dtype=np.float64)
+            if Y.shape[1] == 0:
+                return None
+        if tws_i is not None:
+            envelope_coordinates(Y, tws_i)
+        m = Y.sum(axis=1) / Y.shape[1]
+        Y -= m[:, np.newaxis]
+        return Y.shape[1], m, np.dot(Y, Y.T)
+
+    if n_threads is None:
+        n_threads = os.cpu_count()
+    n_threads = max(1, min(n_threads, len(bounds)))
+    if n_threads > 1 and len(bounds) >= 4:
+        blocks = list(moments_executor(n_threads).map(block_moments, bounds))
     else:
-        tws.xx = np.mean((x - tws.x)*(x - tws.x))
-        tws.xpx = np.mean((x-tws.x)*(px-tws.px))
-        tws.pxpx = np.mean((px-tws.px)*(px-tws.px))
-        tws.yy = np.mean((y-tws.y)*(y-tws.y))
-        tws.ypy = np.mean((y-tws.y)*(py-tws.py))
-        tws.pypy = np.mean((py-tws.py)*(py-tws.py))
-    tws.p = np.mean( p_array.p())
-    tws.E = np.copy(p_array.E)
-    #tws.de = p_array.de
+        blocks = [block_moments(b) for b in bounds]
+    return merge_moments(blocks)
+
+
+def merge_moments(parts):
+    """
+    moments of the union of the parts of the beam, the parts are combined pairwise (Chan et al.)
+
+    :param parts: list of (n, mean, S) or None (empty part), see partial_moments()
+    :return: (n, mean, S) or None if all parts are empty
+    """
+    blocks = [b for b in parts if b is not None]
+    if len(blocks) == 0:
+        return None
+    while len(blocks) > 1:
+        pairs = []
+        for (na, ma, Sa), (nb, mb, Sb) in zip(blocks[0::2], blocks[1::2]):
+            nab = na + nb
+            delta = mb - ma
+            pairs.append((nab, ma + delta * (nb / nab), Sa + Sb + np.outer(delta, delta) * (na * nb / nab)))
+        if len(blocks) % 2:
+            pairs.append(blocks[-1])
+        blocks = pairs
+    return blocks[0]
+
+
+def beam_moments(X, tws_i=None, block_size=65536, n_threads=None, lost=None):
+    """
+    mean vector and covariance matrix of the particle coordinates in one blocked pass over the array.
+    The moments of the blocks are combined pairwise (Chan et al.), the blocks are processed by n_threads threads
+    if there are at least 4 blocks. The moments of an empty beam are NaN.
+
+    :param X: array (6, n), e.g. p_array.rparticles (can be memory-mapped)
+    :param tws_i: None - moments of X, Twiss - moments of the coordinates of get_envelope(): the dispersion of
+                  tws_i is subtracted and px, py are replaced by x' = px*(1 - px^2/2 - py^2/2), y' (the same)
+    :param block_size: number of particles in the block
+    :param n_threads: number of threads, if None os.cpu_count()
+    :param lost: None or bool array (n) - the particles which are excluded (the mask is applied block by block,
+                 X is not copied)
+    :return: mean - array (6), cov - array (6, 6)
+    """
+    moments = partial_moments(X, tws_i=tws_i, block_size=block_size, n_threads=n_threads, lost=lost)
+    if moments is None:
+        return np.ones(6) * np.nan, np.ones((6, 6)) * np.nan
+    n, mean, S = moments
+    return mean, S / n
+
+
+def envelope_twiss(mean, cov, E, auto_disp=False):
+    """
+    Twiss of get_envelope() from the moments of the envelope coordinates
+
+    :param mean: array (6) - mean vector
+    :param cov: array (6, 6) - covariance matrix
+    :param E: energy of the beam
+    :param auto_disp: if True the dispersion of the beam is subtracted, see get_envelope()
+    :return: Twiss
+    """
+    tws = Twiss()
+    tws.x, tws.px, tws.y, tws.py, tws.p = mean[0], mean[1], mean[2], mean[3], mean[5]
+    if auto_disp and cov[5, 5] > 0:
+        D = cov[:4, 5] / cov[5, 5]
+        A = np.eye(6)
+        A[:4, 5] = -D
+        cov = np.dot(np.dot(A, cov), A.T)
+        tws.Dx, tws.Dxp, tws.Dy, tws.Dyp = D
+    tws.xx = cov[0, 0]
+    tws.xpx = cov[0, 1]
+    tws.pxpx = cov[1, 1]
+    tws.yy = cov[2, 2]
+    tws.ypy = cov[2, 3]
+    tws.pypy = cov[3, 3]
+    tws.E = np.copy(E)
 
     tws.emit_x = np.sqrt(tws.xx*tws.pxpx-tws.xpx**2)
     tws.emit_y = np.sqrt(tws.yy*tws.pypy-tws.ypy**2)
-    #print tws.emit_x, np.sqrt(tws.xx*tws.pxpx-tws.xpx**2), tws.emit_y, np.sqrt(tws.yy*tws.pypy-tws.ypy**2)
     tws.beta_x = tws.xx/tws.emit_x
     tws.beta_y = tws.yy/tws.emit_y
     tws.alpha_x = -tws.xpx/tws.emit_x
     tws.alpha_y = -tws.ypy/tws.emit_y
     return tws
 
+
+def get_envelope(p_array, tws_i=Twiss(), auto_disp=False, block_size=65536, n_threads=None):
+    """
+    beam parameters from the particle distribution, the moments are calculated by beam_moments() in one pass
+
+    :param p_array: ParticleArray, the lost particles are ignored
+    :param tws_i: Twiss with the dispersion which is subtracted
+    :param auto_disp: if True the dispersion of the beam (correlation with p) is subtracted in addition,
+                      emittances and Twiss parameters are dispersion corrected, tws.Dx, Dxp, Dy, Dyp are the
+                      dispersion of the beam
+    :param block_size: number of particles in the block
+    :param n_threads: number of threads, if None os.cpu_count()
+    :return: Twiss
+    """
+    mean, cov = beam_moments(p_array.rparticles, tws_i=tws_i, block_size=block_size, n_threads=n_threads,
+                             lost=getattr(p_array, "lost", None))
+    return envelope_twiss(mean, cov, p_array.E, auto_disp=auto_disp)
+
 def get_current(p_array, charge=None, num_bins = 200):
     """
     Function calculates beam current from particleArray
     :param p_array: particleArray
     :param charge: - None, charge of the one macro-particle.
-                    If None, charge of the first macro-particle is used
+                    If None, the charges of the macro-particles (q_array) are used
     :param num_bins: number of bins
     :return s, I -  (np.array, np.array) - beam positions [m] and currents in [A]
     """
-    if charge == None:
-        charge = p_array.q_array[0]
+    p_array = p_array.without_lost()
     z = p_array.tau()
-    hist, bin_edges = np.histogram(z, bins=num_bins)
+    if charge == None:
+        hist, bin_edges = np.histogram(z, bins=num_bins, weights=p_array.q_array)
+        charge = 1.
+    else:
+        hist, bin_edges = np.histogram(z, bins=num_bins)
     delta_Z = max(z) - min(z)
     delta_z = delta_Z/num_bins
     t_bins = delta_z/speed_of_light
-    print( "Imax = ", max(hist)*charge/t_bins)
+    logger.debug("get_current: Imax = " + str(max(hist)*charge/t_bins) + " A")
     hist = np.append(hist, hist[-1])
     return bin_edges, hist*charge/t_bins
 
 
-def gauss_from_twiss(emit, beta, alpha):
-    phi = 2*pi * np.random.rand()
-    u = np.random.rand()
-    a = np.sqrt(-2*np.log( (1-u)) * emit)
-    x = a * np.sqrt(beta) * cos(phi)
-    xp = -a / np.sqrt(beta) * ( sin(phi) + alpha * cos(phi) )
-    return (x, xp)
+def get_generator(rng=None):
+    """
+    numpy random Generator
+
+    :param rng: None - new Generator (random seed), int or SeedSequence - seed, Generator - returned as is.
+                Independent streams for parallel generation: np.random.SeedSequence(seed).spawn(n)
+    :return: np.random.Generator
+    """
+    if isinstance(rng, np.random.Generator):
+        return rng
+    return np.random.default_rng(rng)
+
 
-def waterbag_from_twiss(emit, beta, alpha):
-    phi = 2*pi * np.random.rand()
-    a = np.sqrt(emit) * np.random.rand()
+def twiss_coordinates(emit, beta, alpha, u, v):
+    # x, xp of the normalized coordinates u, v (unit rms)
+    x = np.sqrt(emit * beta) * u
+    xp = np.sqrt(emit / beta) * (v - alpha * u)
+    return x, xp
+
+
+def gauss_from_twiss(emit, beta, alpha, n=None, rng=None):
+    """
+    Gaussian distribution in the phase space (x, xp) with the Twiss parameters
+
+    :param emit: emittance
+    :param beta: beta function
+    :param alpha: alpha function
+    :param n: None - one particle (np.random is used), int - arrays of n particles
+    :param rng: numpy Generator or seed, see get_generator()
+    :return: (x, xp)
+    """
+    if n is None and rng is None:
+        phi = 2*pi * np.random.rand()
+        u = np.random.rand()
+        a = np.sqrt(-2*np.log( (1-u)) * emit)
+        x = a * np.sqrt(beta) * cos(phi)
+        xp = -a / np.sqrt(beta) * ( sin(phi) + alpha * cos(phi) )
+        return (x, xp)
+    rng = get_generator(rng)
+    u = rng.standard_normal(n)
+    v = rng.standard_normal(n)
+    return twiss_coordinates(emit, beta, alpha, u, v)
+
+def waterbag_from_twiss(emit, beta, alpha, n=None, rng=None):
+    if n is None and rng is None:
+        phi = 2*pi * np.random.rand()
+        a = np.sqrt(emit) * np.random.rand()
+    else:
+        rng = get_generator(rng)
+        phi = 2*pi * rng.random(n)
+        a = np.sqrt(emit) * rng.random(n)
     x = a * np.sqrt(beta) * cos(phi)
     xp = -a / np.sqrt(beta) * ( sin(phi) + alpha * cos(phi) )
     return (x, xp)
 
-def ellipse_from_twiss(emit, beta, alpha):
-    phi = 2*pi * np.random.rand()
+def ellipse_from_twiss(emit, beta, alpha, n=None, rng=None):
+    if n is None and rng is None:
+        phi = 2*pi * np.random.rand()
+    else:
+        phi = 2*pi * get_generator(rng).random(n)
     #u = np.random.rand()
     #a = np.sqrt(-2*np.log( (1-u)) * emit)
     a = np.sqrt(emit)
@@ -632,6 +1167,99 @@ def ellipse_from_twiss(emit, beta, alpha):
     return (x, xp)
 
 
+def gauss_6d(cov, n, mean=None, rng=None):
+    """
+    6D Gaussian distribution with the full covariance matrix
+
+    :param cov: covariance matrix (6, 6) of x, px, y, py, tau, p (positive semi-definite)
+    :param n: number of particles
+    :param mean: mean vector (6), if None zeros
+    :param rng: numpy Generator or seed, see get_generator()
+    :return: array (6, n)
+    """
+    cov = np.asarray(cov, dtype=np.float64)
+    try:
+        L = np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        w, v = np.linalg.eigh(cov)
+        L = v * np.sqrt(np.maximum(w, 0.))
+    X = np.dot(L, get_generator(rng).standard_normal((cov.shape[0], n)))
+    if mean is not None:
+        X += np.asarray(mean)[:, np.newaxis]
+    return X
+
+
+def generate_parray(sigma_x=1e-4, sigma_px=2e-5, sigma_y=None, sigma_py=None, sigma_tau=1e-3, sigma_p=1e-4,
+                    chirp=0.01, charge=5e-9, nparticles=200000, energy=0.13, tws=None, shape="gauss",
+                    current_profile=None, emit_scale=None, rng=None):
+    """
+    ParticleArray with the Gaussian transverse distribution and the given longitudinal distribution
+
+    :param sigma_x: rms x [m], used if tws is None
+    :param sigma_px: rms px [rad], used if tws is None
+    :param sigma_y: rms y [m], if None sigma_x
+    :param sigma_py: rms py [rad], if None sigma_px
+    :param sigma_tau: rms tau [m]
+    :param sigma_p: rms uncorrelated energy spread
+    :param chirp: energy chirp, p = chirp * tau / sigma_tau + uncorrelated spread
+    :param charge: bunch charge [C]
+    :param nparticles: number of particles
+    :param energy: energy [GeV]
+    :param tws: Twiss with emit_x, beta_x, alpha_x, emit_y, beta_y, alpha_y (and optionally Dx, Dxp, Dy, Dyp)
+    :param shape: "gauss" or "flattop" (uniform with rms sigma_tau), not used if current_profile is given
+    :param current_profile: (s, I) - arrays of the current profile, tau is sampled from it and sigma_tau is the rms
+                            of the sampled distribution
+    :param emit_scale: function of tau - ratio of the slice emittance to the emittance (the same for x and y)
+    :param rng: numpy Generator or seed, see get_generator()
+    :return: ParticleArray
+    """
+    rng = get_generator(rng)
+    n = nparticles
+    p_array = ParticleArray(n=n)
+    X = p_array.rparticles
+    rng.standard_normal(out=X[:4])
+    if tws is not None:
+        X[0], X[1] = twiss_coordinates(tws.emit_x, tws.beta_x, tws.alpha_x, X[0], X[1])
+        X[2], X[3] = twiss_coordinates(tws.emit_y, tws.beta_y, tws.alpha_y, X[2], X[3])
+    else:
+        X[0] *= sigma_x
+        X[1] *= sigma_px
+        X[2] *= sigma_x if sigma_y is None else sigma_y
+        X[3] *= sigma_px if sigma_py is None else sigma_py
+
+    if current_profile is not None:
+        s, I = current_profile
+        cdf = np.concatenate(([0.], np.cumsum(0.5 * (I[1:] + I[:-1]) * np.diff(s))))
+        X[4] = np.interp(rng.random(n) * cdf[-1], cdf, s)
+        X[4] -= np.mean(X[4])
+        sigma_tau = np.std(X[4])
+    elif shape == "gauss":
+        rng.standard_normal(out=X[4])
+        X[4] *= sigma_tau
+    elif shape == "flattop":
+        rng.random(out=X[4])
+        X[4] -= 0.5
+        X[4] *= np.sqrt(12.) * sigma_tau
+    else:
+        raise ValueError("generate_parray: unknown shape " + str(shape))
+
+    rng.standard_normal(out=X[5])
+    X[5] *= sigma_p
+    X[5] += chirp / sigma_tau * X[4]
+
+    if emit_scale is not None:
+        a = np.sqrt(emit_scale(X[4]))
+        X[:4] *= a
+    if tws is not None:
+        for i, D in ((0, tws.Dx), (1, tws.Dxp), (2, tws.Dy), (3, tws.Dyp)):
+            if D != 0.:
+                X[i] += D * X[5]
+    p_array.q_array = np.ones(n) * charge / n
+    p_array.E = energy
+    p_array.s = 0.
+    return p_array
+
+
 def moments(x, y, cut=0):
     n = len(x)
     #inds = np.arange(n)
@@ -753,6 +1381,7 @@ class BeamTransform:
         self.x_opt = [self.twiss.alpha_x, self.twiss.beta_x, self.twiss.mux]
         self.y_opt = [self.twiss.alpha_y, self.twiss.beta_y, self.twiss.muy]
         self.beam_matching(p_array.rparticles, self.bounds, self.x_opt, self.y_opt)
+        p_array.invalidate_profile()
 
     def beam_matching(self, particles, bounds, x_opt, y_opt):
         pd = np.zeros((int(particles.size / 6), 6))
@@ -860,12 +1489,9 @@ def s_to_cur(A, sigma, q0, v):
     I = np.int_(np.floor(cA))
     #print(I)
     xiA = 1 + I - cA
-    for k in range(len(A)):
-        i = I[k]
-        if i > N-1:
-            i = N-1
-        C[i+0] = C[i+0]+xiA[k]
-        C[i+1] = C[i+1]+(1-xiA[k])
+    I = np.minimum(I, N - 1)
+    C += np.bincount(I, weights=xiA, minlength=N + 1)[:N]
+    C += np.bincount(I + 1, weights=1 - xiA, minlength=N + 1)[:N]
 
     K = np.floor(Nsigma*sigma/s + 0.5)
     G = np.exp(-0.5*(np.arange(-K, K+1)*s/sigma)**2)
@@ -892,34 +1518,25 @@ def slice_analysis(z, x, xs, M, to_sort):
         xs = xs[indx]
         P=[]
     N=len(x)
-    mx = np.zeros(N)
-    mxs= np.zeros(N)
-    mxx = np.zeros(N)
-    mxxs = np.zeros(N)
-    mxsxs = np.zeros(N)
-    emittx = np.zeros(N)
-    m = np.max([np.round(M/2), 1])
+    m = int(np.max([np.round(M/2), 1]))
+    # window of the particle i: n1 ... n2
+    i = np.arange(N)
+    n1 = np.maximum(0, i - m)
+    n2 = np.minimum(N - 1, i + m)
+    dq = n2 - n1 # window size
     xc = np.cumsum(x)
     xsc = np.cumsum(xs)
-    for i in range(N):
-        n1 = int(max(0, i-m))
-        n2 = int(min(N-1, i+m))
-        dq = n2 - n1 # window size
-        mx[i] = (xc[n2] - xc[n1])/dq # average for over window per particle
-        mxs[i] = (xsc[n2] - xsc[n1])/dq
+    mx = (xc[n2] - xc[n1])/dq # average for over window per particle
+    mxs = (xsc[n2] - xsc[n1])/dq
 
     x = x - mx
     xs = xs - mxs
     x2c = np.cumsum(x*x)
     xs2c = np.cumsum(xs*xs)
     xxsc = np.cumsum(x*xs)
-    for i in range(N):
-        n1 = int(max(0, i-m))
-        n2 = int(min(N-1, i+m))
-        dq = n2 - n1
-        mxx[i] = (x2c[n2] - x2c[n1])/dq
-        mxsxs[i] = (xs2c[n2] - xs2c[n1])/dq
-        mxxs[i] = (xxsc[n2] - xxsc[n1])/dq
+    mxx = (x2c[n2] - x2c[n1])/dq
+    mxsxs = (xs2c[n2] - xs2c[n1])/dq
+    mxxs = (xxsc[n2] - xxsc[n1])/dq
 
     emittx = np.sqrt(mxx*mxsxs - mxxs*mxxs)
     return [mx, mxs, mxx, mxxs, mxsxs, emittx]
@@ -930,21 +1547,12 @@ def simple_filter(x, p, iter):
     if iter == 0:
         y = x
         return y
+    i = np.arange(n)
+    i0 = np.maximum(0, i - p)
+    i1 = np.minimum(n - 1, i + p)
     for k in range(iter):
-
-        y = np.zeros(n)
-        for i in range(n):
-            i0 = i - p
-            if i0 < 0:
-                i0 = 0
-            i1 = i + p
-            if i1 > n-1:
-                i1 = n-1
-            s = 0
-            for j in range(i0, i1+1):
-                s = s + x[j]
-            y[i] = s / (i1 - i0 + 1)
-
+        c = np.concatenate(([0.], np.cumsum(x)))
+        y = (c[i1 + 1] - c[i0]) / (i1 - i0 + 1)
         x = y
     return y
 
@@ -957,6 +1565,7 @@ def interp1(x, y, xnew, k=1):
     return ynew
 
 def slice_analysis_transverse(parray, Mslice, Mcur, p, iter):
+    parray = parray.without_lost()
     q1 = np.sum(parray.q_array)
     logger.debug("slice_analysis_transverse: charge = " + str(q1))
     n = np.int_(parray.rparticles.size / 6)
@@ -964,9 +1573,10 @@ def slice_analysis_transverse(parray, Mslice, Mcur, p, iter):
     PD = sortrows(PD, col=4)
 
     z = np.copy(PD[4])
-    mx, mxs, mxx, mxxs, mxsxs, emittx = slice_analysis(z, PD[0], PD[1], Mslice, True)
+    # PD is sorted by z
+    mx, mxs, mxx, mxxs, mxsxs, emittx = slice_analysis(z, PD[0], PD[1], Mslice, False)
 
-    my, mys, myy, myys, mysys, emitty = slice_analysis(z, PD[2], PD[3], Mslice, True)
+    my, mys, myy, myys, mysys, emitty = slice_analysis(z, PD[2], PD[3], Mslice, False)
 
     mm, mm, mm, mm, mm, emitty0 = moments(PD[2], PD[3])
     gamma0 = parray.E / m_e_GeV
@@ -997,6 +1607,7 @@ def slice_analysis_transverse(parray, Mslice, Mcur, p, iter):
 def global_slice_analysis_extended(parray, Mslice, Mcur, p, iter):
     # %[s, I, ex, ey ,me, se, gamma0, emitxn, emityn]=GlobalSliceAnalysis_Extended(PD,q1,Mslice,Mcur,p,iter)
 
+    parray = parray.without_lost()
     q1 = np.sum(parray.q_array)
     #print("charge", q1)
     n = np.int_(parray.rparticles.size/6)
@@ -1004,15 +1615,16 @@ def global_slice_analysis_extended(parray, Mslice, Mcur, p, iter):
     PD = sortrows(PD, col=4)
 
     z = np.copy(PD[4])
-    mx, mxs, mxx, mxxs, mxsxs, emittx = slice_analysis(z, PD[0], PD[1], Mslice, True)
-    
-    my, mys, myy, myys, mysys, emitty = slice_analysis(z, PD[2], PD[3], Mslice, True)
+    # PD is sorted by z
+    mx, mxs, mxx, mxxs, mxsxs, emittx = slice_analysis(z, PD[0], PD[1], Mslice, False)
+
+    my, mys, myy, myys, mysys, emitty = slice_analysis(z, PD[2], PD[3], Mslice, False)
 
     pc_0 = np.sqrt(parray.E**2 - m_e_GeV**2)
     E1 = PD[5]*pc_0 + parray.E
     pc_1 = np.sqrt(E1**2 - m_e_GeV**2)
     #print(pc_1[:10])
-    mE, mEs, mEE, mEEs, mEsEs, emittE = slice_analysis(z, PD[4], pc_1*1e9, Mslice, True)
+    mE, mEs, mEE, mEEs, mEsEs, emittE = slice_analysis(z, PD[4], pc_1*1e9, Mslice, False)
 
     #print(mE, mEs, mEE, mEEs, mEsEs, emittE)
     mE = mEs #mean energy
@@ -1046,19 +1658,112 @@ def global_slice_analysis_extended(parray, Mslice, Mcur, p, iter):
     I = interp1(B[:, 0], B[:, 1], s)
     return [s, I, ex, ey, me, se, gamma0, emitxn, emityn]
 
+class SliceTable:
+    """
+    slice parameters, struct of arrays (one value per slice), see slice_table()
+        s - slice centers [m], ds - slice length [m], q - slice charge [C], I - current [A]
+        x, px, y, py, p - centroids
+        xx, xpx, pxpx, yy, ypy, pypy, pp - central second moments
+        emit_x, emit_y, emit_xn, emit_yn - slice emittances (geometrical and normalized with gamma0)
+        beta_x, alpha_x, beta_y, alpha_y - slice Twiss parameters
+        mismatch_x, mismatch_y - mismatch parameters Bmag of the slices relative to tws_ref
+        sigma_x, sigma_y, sigma_p - rms values, E - mean energy [GeV], sigma_E - rms energy spread [GeV]
+    """
+    def __init__(self, s, ds, q, mean, cov, E, tws_ref=None):
+        """
+        :param s: slice centers
+        :param ds: slice length
+        :param q: slice charges
+        :param mean: array (5, n_slices) - x, px, y, py, p
+        :param cov: array (7, n_slices) - xx, xpx, pxpx, yy, ypy, pypy, pp
+        :param E: reference energy [GeV]
+        :param tws_ref: Twiss, reference for the mismatch parameters
+        """
+        self.s = s
+        self.ds = ds
+        self.q = q
+        self.I = q * speed_of_light / ds
+        self.x, self.px, self.y, self.py, self.p = mean
+        self.xx, self.xpx, self.pxpx, self.yy, self.ypy, self.pypy, self.pp = cov
+        gamma0 = E / m_e_GeV
+        pc_0 = np.sqrt(E ** 2 - m_e_GeV ** 2)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            self.emit_x = np.sqrt(np.maximum(self.xx * self.pxpx - self.xpx ** 2, 0))
+            self.emit_y = np.sqrt(np.maximum(self.yy * self.pypy - self.ypy ** 2, 0))
+            self.emit_xn = self.emit_x * gamma0
+            self.emit_yn = self.emit_y * gamma0
+            self.beta_x = self.xx / self.emit_x
+            self.beta_y = self.yy / self.emit_y
+            self.alpha_x = -self.xpx / self.emit_x
+            self.alpha_y = -self.ypy / self.emit_y
+            self.mismatch_x = np.zeros(len(s))
+            self.mismatch_y = np.zeros(len(s))
+            if tws_ref is not None:
+                self.mismatch_x = bmag(self.beta_x, self.alpha_x, tws_ref.beta_x, tws_ref.alpha_x)
+                self.mismatch_y = bmag(self.beta_y, self.alpha_y, tws_ref.beta_y, tws_ref.alpha_y)
+        self.sigma_x = np.sqrt(np.maximum(self.xx, 0))
+        self.sigma_y = np.sqrt(np.maximum(self.yy, 0))
+        self.sigma_p = np.sqrt(np.maximum(self.pp, 0))
+        self.E = E + self.p * pc_0
+        self.sigma_E = self.sigma_p * pc_0
+
+
+def bmag(beta, alpha, beta0, alpha0):
+    """
+    mismatch parameter Bmag = (beta*gamma0 - 2*alpha*alpha0 + gamma*beta0)/2, 1 - matched
+    """
+    gamma = (1. + alpha ** 2) / beta
+    gamma0 = (1. + alpha0 ** 2) / beta0
+    return 0.5 * (beta * gamma0 - 2. * alpha * alpha0 + gamma * beta0)
+
+
+def slice_table(p_array, n_slices=100, weighted=True, tws_ref=None):
+    """
+    slice parameters of all slices at once. The particles are binned on the equidistant tau grid,
+    the sums over the slices are segmented reductions (np.bincount), the second moments are central (two passes).
+
+    :param p_array: ParticleArray
+    :param n_slices: number of slices
+    :param weighted: if True the moments are weighted by q_array, otherwise all particles have the same weight
+    :param tws_ref: Twiss, reference for the mismatch parameters, if None the projected Twiss (get_envelope())
+    :return: SliceTable
+    """
+    p_array = p_array.without_lost()
+    X = p_array.rparticles
+    tau = X[4]
+    s0 = np.min(tau)
+    ds = (np.max(tau) - s0) / n_slices
+    ind = np.minimum(((tau - s0) / ds).astype(int), n_slices - 1)
+    w = p_array.q_array if weighted else np.ones(X.shape[1])
+    q = np.bincount(ind, weights=p_array.q_array, minlength=n_slices)
+    W = np.bincount(ind, weights=w, minlength=n_slices)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.array([np.bincount(ind, weights=w * X[i], minlength=n_slices) for i in (0, 1, 2, 3, 5)]) / W
+        d = [X[i] - mean[k][ind] for k, i in enumerate((0, 1, 2, 3, 5))]
+        cov = np.array([np.bincount(ind, weights=w * u * v, minlength=n_slices) for u, v in
+                        ((d[0], d[0]), (d[0], d[1]), (d[1], d[1]), (d[2], d[2]), (d[2], d[3]), (d[3], d[3]),
+                         (d[4], d[4]))]) / W
+    if tws_ref is None:
+        tws_ref = get_envelope(p_array)
+    return SliceTable(s0 + (np.arange(n_slices) + 0.5) * ds, ds, q, mean, cov, p_array.E, tws_ref=tws_ref)
+
+
 '''
 beam funcions proposed
 '''
 
 
-def parray2beam(parray, step=1e-7):
+def parray2beam(parray, step=1e-7, smooth=0.):
     '''
     reads ParticleArray()
     returns BeamArray()
     step [m] - long. size ob bin to calculate distribution parameters
+    smooth [m] - rms length of the Gaussian kernel which smooths the slice sums (charge, first and second moments)
+                 before the slice parameters are calculated, 0 - no smoothing
+    All slices are calculated at once: the particles are binned and the slice sums are segmented reductions.
     '''
 
-    part_c = parray.q_array[0] #fix for general case  # charge per particle
+    parray = parray.without_lost()
     t_step = step / speed_of_light
     t = parray.tau() / speed_of_light
     t_min = min(t)
@@ -1066,53 +1771,47 @@ def parray2beam(parray, step=1e-7):
     t_window = t_max - t_min
     npoints = int(t_window / t_step)
     t_step = t_window / npoints
+    n = npoints - 1
     beam = BeamArray()
-    for parm in ['I',
-                 's',
-                 'emit_x',
-                 'emit_y',
-                 'beta_x',
-                 'beta_y',
-                 'alpha_x',
-                 'alpha_y',
-                 'x',
-                 'y',
-                 'xp',
-                 'yp',
-                 'E',
-                 'sigma_E',
-                 ]:
-        setattr(beam, parm, np.zeros((npoints - 1)))
-
-    for i in range(npoints - 1):
-        indices = (t > t_min + t_step * i) * (t < t_min + t_step * (i + 1))
-        beam.s[i] = (t_min + t_step * (i + 0.5)) * speed_of_light
-
-        if np.sum(indices) > 2:
-            e0 = parray.E * 1e9
-            p0 = np.sqrt( (e0**2 - m_e_eV**2) / speed_of_light**2 )
-            p = parray.rparticles[5][indices] # deltaE / average_impulse / speed_of_light
-            dist_e = (p * p0 * speed_of_light + e0)
-            dist_x = parray.rparticles[0][indices]
-            dist_y = parray.rparticles[2][indices]
-            dist_xp = parray.rparticles[1][indices]
-            dist_yp = parray.rparticles[3][indices]
-            
-            beam.I[i] = np.sum(indices) * part_c / t_step
-            beam.E[i] = np.mean(dist_e) * 1e-9
-            beam.sigma_E[i] = np.std(dist_e) * 1e-9
-            beam.x[i] = np.mean(dist_x)
-            beam.y[i] = np.mean(dist_y)
-            g = beam.E[i] / m_e_GeV
-            p = np.sqrt(g**2 - 1)
-            beam.xp[i] = np.mean(dist_xp) #/ p
-            beam.yp[i] = np.mean(dist_yp) #/ p
-            beam.emit_x[i] = np.sqrt(np.mean(dist_x**2) * np.mean(dist_xp**2) - np.mean(dist_x * dist_xp)**2)
-            beam.emit_y[i] = np.sqrt(np.mean(dist_y**2) * np.mean(dist_yp**2) - np.mean(dist_y * dist_yp)**2)
-            beam.beta_x[i] = np.mean(dist_x**2) / beam.emit_x[i]
-            beam.beta_y[i] = np.mean(dist_y**2) / beam.emit_y[i]
-            beam.alpha_x[i] = -np.mean(dist_x * dist_xp) / beam.emit_x[i]
-            beam.alpha_y[i] = -np.mean(dist_y * dist_yp) / beam.emit_y[i]
+
+    # slice i: t_min + t_step * i < t < t_min + t_step * (i + 1)
+    edges = t_min + t_step * np.arange(npoints)
+    idx = np.searchsorted(edges, t, side="right") - 1
+    inside = (idx < n) & (t > edges[np.minimum(idx, n - 1)]) & (t < edges[np.minimum(idx + 1, n)])
+    idx = idx[inside]
+    X = parray.rparticles[:, inside]
+    x, xp, y, yp, p = X[0], X[1], X[2], X[3], X[5]
+    # count, q, x, y, xp, yp, p, x^2, xp^2, x*xp, y^2, yp^2, y*yp, p^2
+    S = np.array([np.bincount(idx, weights=v, minlength=n) for v in
+                  (np.ones(len(idx)), parray.q_array[inside], x, y, xp, yp, p, x * x, xp * xp, x * xp,
+                   y * y, yp * yp, y * yp, p * p)])
+    count = S[0].copy()
+    if smooth > 0:
+        S = gaussian_filter1d(S, smooth / step, axis=1, mode="constant")
+
+    e0 = parray.E * 1e9
+    p0 = np.sqrt( (e0**2 - m_e_eV**2) / speed_of_light**2 )
+    beam.s = (t_min + t_step * (np.arange(n) + 0.5)) * speed_of_light
+    for parm in ['I', 'emit_x', 'emit_y', 'beta_x', 'beta_y', 'alpha_x', 'alpha_y', 'x', 'y', 'xp', 'yp',
+                 'E', 'sigma_E']:
+        setattr(beam, parm, np.zeros(n))
+    valid = count > 2
+    M = S[2:, valid] / S[0, valid]
+    mx, my, mxp, myp, mp, mxx, mxpxp, mxxp, myy, mypyp, myyp, mpp = M
+    beam.I[valid] = S[1, valid] / t_step
+    beam.E[valid] = (mp * p0 * speed_of_light + e0) * 1e-9
+    beam.sigma_E[valid] = np.sqrt(np.maximum(mpp - mp ** 2, 0)) * p0 * speed_of_light * 1e-9
+    beam.x[valid] = mx
+    beam.y[valid] = my
+    beam.xp[valid] = mxp
+    beam.yp[valid] = myp
+    with np.errstate(divide="ignore", invalid="ignore"):
+        beam.emit_x[valid] = np.sqrt(mxx * mxpxp - mxxp ** 2)
+        beam.emit_y[valid] = np.sqrt(myy * mypyp - myyp ** 2)
+        beam.beta_x[valid] = mxx / beam.emit_x[valid]
+        beam.beta_y[valid] = myy / beam.emit_y[valid]
+        beam.alpha_x[valid] = -mxxp / beam.emit_x[valid]
+        beam.alpha_y[valid] = -myyp / beam.emit_y[valid]
 
     idx = np.where(np.logical_or.reduce((beam.I == 0, beam.E == 0, beam.beta_x > np.mean(beam.beta_x) * 100, beam.beta_y > np.mean(beam.beta_y) * 100)))
     del beam[idx]
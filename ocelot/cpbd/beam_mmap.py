@@ -0,0 +1,540 @@
+"""
+Out-of-core ParticleArray: the coordinates and the charges are memory-mapped .npy files, the tracking through
+the transfer maps and the diagnostics are done chunk by chunk with bounded memory.
+
+Layout of the beam directory:
+    rparticles.npy - array (6, n)
+    q_array.npy - array (n)
+    header.json - {"E": ..., "s": ...}
+
+Native binary beam file (*.ocb):
+    8 bytes - magic b"OCELOTB1"
+    8 bytes - length of the JSON header (little endian uint64)
+    JSON header - n, E, s, charge, units, compression, ..., padded with spaces to the multiple of 64 bytes
+    data - rparticles as column-major 6 x n block of little endian float64 (x, px, y, py, tau, p of the particle 0,
+           of the particle 1, ...) and then n charges. The first k particles are the first bytes of the block.
+           Compressed files store the data as independently compressed chunks of chunk_size particles.
+"""
+
+import os
+import sys
+import json
+import tempfile
+import zlib
+import zipfile
+import numpy as np
+from ocelot.cpbd.beam import ParticleArray, Twiss, SliceTable, get_envelope
+from ocelot.cpbd.optics import get_map
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import blosc
+    blosc_flag = True
+except:
+    blosc_flag = False
+
+try:
+    import lz4.frame
+    lz4_flag = True
+except:
+    lz4_flag = False
+
+CHUNK_SIZE = 1000000    # default number of particles in the chunk
+
+BINARY_EXT = ".ocb"     # extension of the native binary beam file
+BINARY_MAGIC = b"OCELOTB1"
+BINARY_COLUMNS = ["x", "px", "y", "py", "tau", "p"]
+BINARY_UNITS = {"x": "m", "px": "rad", "y": "m", "py": "rad", "tau": "m", "p": "1", "q": "C", "E": "GeV", "s": "m"}
+
+
+def create_mapped_particle_array(path, n, E=0., s=0.):
+    """
+    new memory-mapped ParticleArray of n particles (zeros)
+
+    :param path: beam directory
+    :param n: number of particles
+    :param E: reference energy in [GeV]
+    :param s: position in [m]
+    :return: ParticleArray
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    p_array = ParticleArray()
+    p_array.rparticles = np.lib.format.open_memmap(os.path.join(path, "rparticles.npy"), mode="w+",
+                                                   dtype=np.float64, shape=(6, n))
+    p_array.q_array = np.lib.format.open_memmap(os.path.join(path, "q_array.npy"), mode="w+",
+                                                dtype=np.float64, shape=(n,))
+    p_array.E = E
+    p_array.s = s
+    write_mapped_header(path, p_array)
+    return p_array
+
+
+def open_mapped_particle_array(path, mode="r+"):
+    """
+    open the memory-mapped ParticleArray
+
+    :param path: beam directory
+    :param mode: "r+" - changes are written to the files, "r" - read only, "c" - copy on write
+    :return: ParticleArray
+    """
+    p_array = ParticleArray()
+    p_array.rparticles = np.load(os.path.join(path, "rparticles.npy"), mmap_mode=mode)
+    p_array.q_array = np.load(os.path.join(path, "q_array.npy"), mmap_mode=mode)
+    with open(os.path.join(path, "header.json")) as f:
+        header = json.load(f)
+    p_array.E = header["E"]
+    p_array.s = header["s"]
+    return p_array
+
+
+def write_mapped_header(path, p_array):
+    """
+    write E and s of the ParticleArray and flush the memory-mapped arrays
+
+    :param path: beam directory
+    :param p_array: memory-mapped ParticleArray
+    :return: None
+    """
+    for arr in (p_array.rparticles, p_array.q_array):
+        if isinstance(arr, np.memmap):
+            arr.flush()
+    with open(os.path.join(path, "header.json"), "w") as f:
+        json.dump({"E": float(p_array.E), "s": float(p_array.s)}, f)
+
+
+def npz_to_mapped(npz_file, path, chunk_size=CHUNK_SIZE):
+    """
+    convert the file of save_particle_array() to the memory-mapped beam without loading of the whole beam.
+    The compressed arrays are decompressed as a stream.
+
+    :param npz_file: file of save_particle_array()
+    :param path: beam directory
+    :param chunk_size: number of values which are decompressed at once
+    :return: ParticleArray
+    """
+    with zipfile.ZipFile(npz_file) as zf:
+        def open_npy(name):
+            f = zf.open(name + ".npy")
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            elif version == (2, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            else:
+                f.close()
+                raise ValueError("npz_to_mapped: unsupported version " + str(version) + " of " + name + ".npy")
+            return f, shape, fortran_order, dtype
+
+        f, shape, fortran_order, dtype = open_npy("rparticles")
+        with zf.open("E.npy") as fe:
+            E = float(np.lib.format.read_array(fe))
+        with zf.open("s.npy") as fs:
+            s = float(np.lib.format.read_array(fs))
+        p_array = create_mapped_particle_array(path, shape[1], E=E, s=s)
+        flat = p_array.rparticles.reshape(-1, order="F" if fortran_order else "C")
+        read_stream(f, flat, dtype, chunk_size)
+        f.close()
+        f, shape, fortran_order, dtype = open_npy("q_array")
+        read_stream(f, p_array.q_array, dtype, chunk_size)
+        f.close()
+    write_mapped_header(path, p_array)
+    return p_array
+
+
+def read_stream(f, out, dtype, chunk_size):
+    # read len(out) values of dtype from the file object to the (memory-mapped) array by chunks
+    n = len(out)
+    for i0 in range(0, n, chunk_size):
+        i1 = min(i0 + chunk_size, n)
+        out[i0:i1] = np.frombuffer(f.read((i1 - i0) * dtype.itemsize), dtype=dtype)
+
+
+def chunk_view(p_array, i0, i1):
+    """
+    ParticleArray with the views of the particles i0...i1-1, the changes of the chunk are the changes of the beam
+
+    :param p_array: ParticleArray
+    :param i0: first particle
+    :param i1: last particle + 1
+    :return: ParticleArray
+    """
+    chunk = ParticleArray()
+    chunk.rparticles = p_array.rparticles[:, i0:i1]
+    chunk.q_array = p_array.q_array[i0:i1]
+    chunk.E = p_array.E
+    chunk.s = p_array.s
+    return chunk
+
+
+def chunk_bounds(n, chunk_size=CHUNK_SIZE):
+    """
+    :return: list of (i0, i1) bounds of the chunks
+    """
+    return [(i0, min(i0 + chunk_size, n)) for i0 in range(0, n, chunk_size)]
+
+
+def get_envelope_chunked(p_array, tws_i=Twiss(), chunk_size=CHUNK_SIZE):
+    """
+    get_envelope() with the blocks of chunk_size particles (one pass over the beam)
+
+    :param p_array: ParticleArray
+    :param tws_i: Twiss with the dispersion
+    :param chunk_size: number of particles in the chunk
+    :return: Twiss
+    """
+    return get_envelope(p_array, tws_i=tws_i, block_size=chunk_size)
+
+
+def slice_moments_chunked(p_array, n_slices=100, chunk_size=CHUNK_SIZE, tws_ref=None):
+    """
+    slice_table() chunk by chunk (two passes over the beam). The charge weighted sums of every slice are
+    accumulated over the chunks, the second moments are obtained from the raw sums.
+
+    :param p_array: ParticleArray
+    :param n_slices: number of slices
+    :param chunk_size: number of particles in the chunk
+    :param tws_ref: Twiss, reference for the mismatch parameters, if None get_envelope_chunked()
+    :return: SliceTable
+    """
+    n = p_array.rparticles.shape[1]
+    bounds = chunk_bounds(n, chunk_size)
+    s0, s1 = np.inf, -np.inf
+    for i0, i1 in bounds:
+        tau = p_array.rparticles[4, i0:i1]
+        s0, s1 = min(s0, np.min(tau)), max(s1, np.max(tau))
+    ds = (s1 - s0) / n_slices
+    # q, q*x, q*px, q*y, q*py, q*p, q*x^2, q*x*px, q*px^2, q*y^2, q*y*py, q*py^2, q*p^2
+    S = np.zeros((13, n_slices))
+    for i0, i1 in bounds:
+        X = p_array.rparticles[:, i0:i1]
+        q = p_array.q_array[i0:i1]
+        ind = np.minimum(((X[4] - s0) / ds).astype(int), n_slices - 1)
+        x, px, y, py, p = X[0], X[1], X[2], X[3], X[5]
+        for k, v in enumerate((None, x, px, y, py, p, x * x, x * px, px * px, y * y, y * py, py * py, p * p)):
+            S[k] += np.bincount(ind, weights=q if v is None else q * v, minlength=n_slices)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        M = S[1:] / S[0]
+    x, px, y, py, p = M[:5]
+    cov = np.array([M[5] - x * x, M[6] - x * px, M[7] - px * px, M[8] - y * y, M[9] - y * py, M[10] - py * py,
+                    M[11] - p * p])
+    if tws_ref is None:
+        tws_ref = get_envelope_chunked(p_array, chunk_size=chunk_size)
+    return SliceTable(s0 + (np.arange(n_slices) + 0.5) * ds, ds, S[0], M[:5], cov, p_array.E, tws_ref=tws_ref)
+
+
+def tracking_step_chunked(lat, p_array, dz, navi, chunk_size=CHUNK_SIZE):
+    """
+    tracking_step() chunk by chunk: all transfer maps of the step are applied to one chunk before the next one
+
+    :param lat: Magnetic Lattice
+    :param p_array: ParticleArray
+    :param dz: step in [m]
+    :param navi: Navigator
+    :param chunk_size: number of particles in the chunk
+    :return: None
+    """
+    if navi.z0 + dz > lat.totalLen:
+        dz = lat.totalLen - navi.z0
+
+    t_maps = get_map(lat, dz, navi)
+    for i0, i1 in chunk_bounds(p_array.rparticles.shape[1], chunk_size):
+        X = p_array.rparticles[:, i0:i1]
+        E = p_array.E
+        for tm in t_maps:
+            tm.map(X, energy=E)
+            E += tm.delta_e
+    for tm in t_maps:
+        p_array.E += tm.delta_e
+        p_array.s += tm.length
+    p_array.invalidate_profile()
+
+
+def track_chunked(lattice, p_array, navi, chunk_size=CHUNK_SIZE, print_progress=True, calc_tws=True):
+    """
+    track() chunk by chunk for the memory-mapped (or any large) ParticleArray.
+    The physics processes need the whole beam and are applied to the whole ParticleArray.
+
+    :param lattice: Magnetic Lattice
+    :param p_array: ParticleArray
+    :param navi: Navigator
+    :param chunk_size: number of particles in the chunk
+    :return: twiss list, ParticleArray
+    """
+    tws_track = [get_envelope_chunked(p_array, chunk_size=chunk_size) if calc_tws else Twiss()]
+    L = 0.
+    warned = False
+    while np.abs(navi.z0 - lattice.totalLen) > 1e-10:
+        if navi.kill_process:
+            print("Killing tracking ... ")
+            return tws_track, p_array
+        dz, proc_list = navi.get_next()
+
+        tracking_step_chunked(lat=lattice, p_array=p_array, dz=dz, navi=navi, chunk_size=chunk_size)
+
+        if len(proc_list) > 0 and not warned:
+            logger.warning("track_chunked: physics processes are applied to the whole beam in memory")
+            warned = True
+        for p in proc_list:
+            p.z0 = navi.z0
+            p.apply(p_array, dz)
+        tw = get_envelope_chunked(p_array, chunk_size=chunk_size) if calc_tws else Twiss()
+        L += dz
+        tw.s += L
+        tws_track.append(tw)
+
+        if print_progress:
+            poc_names = [p.__class__.__name__ for p in proc_list]
+            sys.stdout.write("\r" + "z = " + str(navi.z0) + " / " + str(lattice.totalLen) + " : applied: " + ", ".join(poc_names))
+            sys.stdout.flush()
+
+    return tws_track, p_array
+
+
+def compress_chunk(data, compression):
+    # data - bytes of float64 values
+    if compression == "blosc":
+        return blosc.compress(data, typesize=8, cname="lz4", shuffle=blosc.SHUFFLE)
+    elif compression == "lz4":
+        return lz4.frame.compress(data)
+    return zlib.compress(data, 1)
+
+
+def decompress_chunk(data, compression):
+    if compression == "blosc":
+        if not blosc_flag:
+            raise ImportError("beam_mmap: the file is compressed by blosc, the module BLOSC is not installed")
+        return blosc.decompress(data)
+    elif compression == "lz4":
+        if not lz4_flag:
+            raise ImportError("beam_mmap: the file is compressed by lz4, the module LZ4 is not installed")
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+
+def save_particle_array_bin(filename, p_array, compression=None, chunk_size=65536):
+    """
+    save ParticleArray to the native binary beam file (see the module description)
+
+    :param filename: file name, usually *.ocb
+    :param p_array: ParticleArray
+    :param compression: None - raw data, memory-mappable, "blosc" or "lz4" - fast compression if the module is
+                        installed (otherwise the raw data is written), "zlib" - compression by the standard library
+    :param chunk_size: number of particles in the compressed chunk
+    :return: None
+    """
+    if (compression == "blosc" and not blosc_flag) or (compression == "lz4" and not lz4_flag):
+        logger.warning("save_particle_array_bin: module " + compression.upper() + " is not installed, "
+                       "the data is not compressed")
+        compression = None
+    if compression not in (None, "blosc", "lz4", "zlib"):
+        raise ValueError("save_particle_array_bin: unknown compression " + str(compression))
+    n = p_array.rparticles.shape[1]
+    bounds = chunk_bounds(n, chunk_size)
+
+    def blocks():
+        # raw little endian bytes of the data in the file order
+        for i0, i1 in bounds:
+            yield np.ascontiguousarray(p_array.rparticles[:, i0:i1].T, dtype="<f8").tobytes()
+        for i0, i1 in bounds:
+            yield np.ascontiguousarray(p_array.q_array[i0:i1], dtype="<f8").tobytes()
+
+    header = {"version": 1, "n": n, "E": float(p_array.E), "s": float(p_array.s),
+              "charge": float(np.sum(p_array.q_array)), "columns": BINARY_COLUMNS, "units": BINARY_UNITS,
+              "dtype": "<f8", "order": "F", "compression": compression}
+    chunks = None
+    if compression is not None:
+        chunks = [compress_chunk(b, compression) for b in blocks()]
+        header["chunk_size"] = chunk_size
+        header["chunk_sizes"] = [len(c) for c in chunks]
+    with open(filename, "wb") as f:
+        f.write(encode_beam_header(header))
+        for b in (blocks() if chunks is None else chunks):
+            f.write(b)
+
+
+def encode_beam_header(header, length=None, reserve=0):
+    """
+    magic, length and JSON header of the native binary beam file
+
+    :param header: dict
+    :param length: length of the JSON header in bytes (to rewrite the header in place), if None - the JSON is
+                   padded to the multiple of 64 bytes of the file position
+    :param reserve: number of additional spaces, the header can grow later by reserve bytes
+    :return: bytes
+    """
+    head = json.dumps(header).encode("utf-8") + b" " * reserve
+    if length is None:
+        head += b" " * (-(len(BINARY_MAGIC) + 8 + len(head)) % 64)
+    elif len(head) > length:
+        raise ValueError("encode_beam_header: the header does not fit to " + str(length) + " bytes")
+    else:
+        head += b" " * (length - len(head))
+    return BINARY_MAGIC + np.uint64(len(head)).astype("<u8").tobytes() + head
+
+
+class BinaryBeamWriter:
+    """
+    streaming writer of the native binary beam file without compression, the particles are appended chunk by chunk
+    and the total number of particles is not needed in advance. The coordinates are written directly to the file,
+    the charges to the temporary file in the same directory which is appended by close().
+
+    with BinaryBeamWriter("beam.ocb", E=0.13) as writer:
+        for rparticles, q_array in chunks:
+            writer.write(rparticles, q_array)
+    """
+    def __init__(self, filename, E=0., s=0.):
+        """
+        :param filename: file name, usually *.ocb
+        :param E: reference energy [GeV]
+        :param s: position of the beam [m]
+        """
+        self.filename = filename
+        self.E = E
+        self.s = s
+        self.n = 0
+        self.charge = 0.
+        self.f = open(filename, "wb")
+        self.q_file = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(filename)))
+        head = encode_beam_header(self.header(), reserve=256)
+        self.length = len(head) - len(BINARY_MAGIC) - 8
+        self.f.write(head)
+
+    def header(self):
+        return {"version": 1, "n": self.n, "E": float(self.E), "s": float(self.s), "charge": float(self.charge),
+                "columns": BINARY_COLUMNS, "units": BINARY_UNITS, "dtype": "<f8", "order": "F", "compression": None}
+
+    def write(self, rparticles, q_array):
+        """
+        append the particles
+
+        :param rparticles: array (6, k)
+        :param q_array: array (k)
+        :return: None
+        """
+        self.f.write(np.ascontiguousarray(np.transpose(rparticles), dtype="<f8").tobytes())
+        self.q_file.write(np.ascontiguousarray(q_array, dtype="<f8").tobytes())
+        self.n += len(q_array)
+        self.charge += float(np.sum(q_array))
+
+    def close(self):
+        """
+        append the charges and write the final header
+
+        :return: None
+        """
+        if self.f is None:
+            return
+        self.q_file.seek(0)
+        block = self.q_file.read(1 << 24)
+        while block:
+            self.f.write(block)
+            block = self.q_file.read(1 << 24)
+        self.q_file.close()
+        self.f.seek(0)
+        self.f.write(encode_beam_header(self.header(), length=self.length))
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_beam_header(filename):
+    """
+    header of the native binary beam file
+
+    :param filename: file name
+    :return: dict, "offset" is the position of the data in the file
+    """
+    with open(filename, "rb") as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError("read_beam_header: " + filename + " is not the ocelot binary beam file")
+        length = int(np.frombuffer(f.read(8), dtype="<u8")[0])
+        header = json.loads(f.read(length).decode("utf-8"))
+    header["offset"] = len(BINARY_MAGIC) + 8 + length
+    return header
+
+
+def read_compressed_chunks(filename, header, n):
+    # rparticles (6, n) and q_array (n) of the first n particles of the compressed file
+    chunk_size = header["chunk_size"]
+    sizes = header["chunk_sizes"]
+    n_chunks = len(sizes) // 2
+    positions = header["offset"] + np.concatenate(([0], np.cumsum(sizes)))
+    k = (n + chunk_size - 1) // chunk_size
+    rparticles = np.empty((6, n))
+    q_array = np.empty(n)
+    with open(filename, "rb") as f:
+        for j in range(k):
+            i0, i1 = j * chunk_size, min((j + 1) * chunk_size, n)
+            f.seek(positions[j])
+            block = np.frombuffer(decompress_chunk(f.read(sizes[j]), header["compression"]), dtype="<f8")
+            rparticles[:, i0:i1] = block.reshape(-1, 6)[:i1 - i0].T
+            f.seek(positions[n_chunks + j])
+            block = np.frombuffer(decompress_chunk(f.read(sizes[n_chunks + j]), header["compression"]), dtype="<f8")
+            q_array[i0:i1] = block[:i1 - i0]
+    return rparticles, q_array
+
+
+def load_particle_array_bin(filename, n=None, mmap=True, mode="c"):
+    """
+    load ParticleArray from the native binary beam file
+
+    :param filename: file name
+    :param n: number of particles to load (the first n particles), if None all particles
+    :param mmap: True - the arrays are memory-mapped (only for the files without compression), the loading is
+                 instant, rparticles is column-major (Fortran order); False - the arrays are read to memory
+    :param mode: mode of the memory map, "c" - copy on write (the file is not changed), "r" - read only,
+                 "r+" - the changes are written to the file
+    :return: ParticleArray
+    """
+    header = read_beam_header(filename)
+    N = header["n"]
+    n = N if n is None else min(n, N)
+    p_array = ParticleArray()
+    if header["compression"] is not None:
+        p_array.rparticles, p_array.q_array = read_compressed_chunks(filename, header, n)
+    elif mmap:
+        p_array.rparticles = np.memmap(filename, dtype="<f8", mode=mode, offset=header["offset"],
+                                       shape=(6, n), order="F")
+        p_array.q_array = np.memmap(filename, dtype="<f8", mode=mode, offset=header["offset"] + 48 * N,
+                                    shape=(n,))
+    else:
+        with open(filename, "rb") as f:
+            f.seek(header["offset"])
+            X = np.fromfile(f, dtype="<f8", count=6 * n)
+            f.seek(header["offset"] + 48 * N)
+            p_array.q_array = np.fromfile(f, dtype="<f8", count=n).astype(np.float64)
+        p_array.rparticles = np.ascontiguousarray(X.reshape(n, 6).T, dtype=np.float64)
+    p_array.E = header["E"]
+    p_array.s = header["s"]
+    return p_array
+
+
+def read_particle_columns(filename, columns, n=None):
+    """
+    read the selected coordinates of the particles from the native binary beam file
+
+    :param filename: file name
+    :param columns: list of names ("x", "px", "y", "py", "tau", "p", "q") or of indices 0...5
+    :param n: number of particles (the first n particles), if None all particles
+    :return: array (len(columns), n)
+    """
+    header = read_beam_header(filename)
+    N = header["n"]
+    n = N if n is None else min(n, N)
+    columns = [BINARY_COLUMNS.index(c) if c in BINARY_COLUMNS else (6 if c == "q" else c) for c in columns]
+    if header["compression"] is not None:
+        rparticles, q_array = read_compressed_chunks(filename, header, n)
+        return np.array([q_array if c == 6 else rparticles[c] for c in columns])
+    X = np.memmap(filename, dtype="<f8", mode="r", offset=header["offset"], shape=(6, n), order="F")
+    q = np.memmap(filename, dtype="<f8", mode="r", offset=header["offset"] + 48 * N, shape=(n,))
+    res = np.array([q if c == 6 else X[c] for c in columns])
+    del X, q
+    return res
@@ -0,0 +1,158 @@
+"""
+Checkpoints of track(): the beam, the state of the Navigator and of the physics processes and the twiss list
+are saved periodically by the background writer (ocelot.cpbd.async_io.AsyncWriter). The tracking is resumed from the last checkpoint with the same
+lattice and the same Navigator (created by the same script). The checkpoint file is removed when the tracking
+is finished, the resuming is enabled explicitly by resume=True.
+"""
+
+import os
+import pickle
+import threading
+import numpy as np
+from ocelot.cpbd.async_io import AsyncWriter
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TrackCheckpoint:
+    """
+    Periodic checkpoints of track()
+    Attributes:
+        filename - checkpoint file, it is replaced atomically by every new checkpoint
+        n_steps = 10 - number of tracking steps between checkpoints
+        resume = False - resume the tracking from the checkpoint file if it exists
+    Example:
+        checkpoint = TrackCheckpoint("s2e.chk", n_steps=20, resume=True)
+        tws, p_array = track(lat, p_array, navi, checkpoint=checkpoint)
+    """
+    def __init__(self, filename, n_steps=10, resume=False):
+        self.filename = filename
+        self.n_steps = n_steps
+        self.resume = resume
+        self.counter = 0
+        self._pending = None        # newest snapshot which is not written yet
+        self._lock = threading.Lock()
+        self.writer = AsyncWriter(maxsize=2)
+
+    def snapshot(self, p_array, navi, tws_track, L):
+        """
+        copy of the tracking state
+
+        :param p_array: ParticleArray
+        :param navi: Navigator
+        :param tws_track: list of Twiss
+        :param L: tracked length
+        :return: dict
+        """
+        procs = navi.process_table.proc_list
+        return {"rparticles": np.copy(p_array.rparticles), "q_array": np.copy(p_array.q_array),
+                "E": p_array.E, "s": p_array.s,
+                "lost": None if p_array.lost is None else np.copy(p_array.lost),
+                "ids": None if p_array.ids is None else np.copy(p_array.ids), "losses": list(p_array.losses),
+                "z0": navi.z0, "n_elem": navi.n_elem, "sum_lengths": navi.sum_lengths,
+                "proc_state": [(p.counter, p.step) for p in procs],
+                "beam_state": navi.beam_state,
+                "steps": [(z, dz, [procs.index(p) for p in ps]) for z, dz, ps in navi.steps],
+                "tws_track": list(tws_track), "L": L,
+                "lattice": (navi.lat.totalLen, len(navi.lat.sequence)),
+                "random_state": np.random.get_state()}
+
+    def restore(self, p_array, navi):
+        """
+        restore the state of the beam and of the Navigator from the checkpoint file
+
+        :param p_array: ParticleArray, is changed in place
+        :param navi: Navigator of the same lattice with the same physics processes
+        :return: tws_track, L or None if the checkpoint file does not exist
+        """
+        if not os.path.isfile(self.filename):
+            return None
+        with open(self.filename, "rb") as f:
+            state = pickle.load(f)
+        procs = navi.process_table.proc_list
+        if len(procs) != len(state["proc_state"]):
+            raise ValueError("TrackCheckpoint: the physics processes of the Navigator differ from the checkpoint")
+        lattice = state.get("lattice")
+        if lattice is not None and (abs(lattice[0] - navi.lat.totalLen) > 1e-10 or
+                                    lattice[1] != len(navi.lat.sequence)):
+            raise ValueError("TrackCheckpoint: the lattice differs from the checkpoint (length " + str(lattice[0]) +
+                             " m, " + str(lattice[1]) + " elements)")
+        p_array.rparticles = state["rparticles"]
+        p_array.q_array = state["q_array"]
+        p_array.E = state["E"]
+        p_array.s = state["s"]
+        p_array.lost = state.get("lost")
+        p_array.ids = state.get("ids")
+        p_array.losses = state.get("losses", [])
+        p_array.invalidate_profile()
+        navi.z0 = state["z0"]
+        navi.n_elem = state["n_elem"]
+        navi.sum_lengths = state["sum_lengths"]
+        for p, (counter, step) in zip(procs, state["proc_state"]):
+            p.counter = counter
+            p.step = step
+        navi.beam_state = state["beam_state"]
+        navi.steps = [(z, dz, [procs[i] for i in ind]) for z, dz, ind in state["steps"]]
+        np.random.set_state(state["random_state"])
+        logger.info("TrackCheckpoint: tracking is resumed from " + self.filename + " at z = " + str(navi.z0))
+        return state["tws_track"], state["L"]
+
+    def step(self, p_array, navi, tws_track, L):
+        """
+        the method is called by track() after each step, every n_steps the checkpoint is saved
+
+        :return: None
+        """
+        self.counter += 1
+        if self.counter >= self.n_steps:
+            self.counter = 0
+            self.save(p_array, navi, tws_track, L)
+
+    def save(self, p_array, navi, tws_track, L):
+        """
+        checkpoint of the current state. The state is copied and written by the background thread,
+        if the previous checkpoint is not written yet it is replaced by the new one.
+
+        :return: None
+        """
+        state = self.snapshot(p_array, navi, tws_track, L)
+        with self._lock:
+            queued = self._pending is not None
+            self._pending = state
+        if not queued:
+            self.writer.submit(self._write_pending)
+
+    def _write_pending(self):
+        with self._lock:
+            state = self._pending
+            self._pending = None
+        if state is not None:
+            self.write(state)
+
+    def write(self, state):
+        tmp = self.filename + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.filename)
+        logger.debug("TrackCheckpoint: checkpoint at z = " + str(state["z0"]) + " is written")
+
+    def close(self):
+        """
+        wait until the last checkpoint is written
+
+        :return: None
+        """
+        self.writer.flush()
+
+    def finish(self):
+        """
+        the method is called by track() at the normal end of the tracking: waits for the writer and removes
+        the checkpoint file, the next run starts from the beginning
+
+        :return: None
+        """
+        self.close()
+        self.counter = 0
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
@@ -94,3 +94,86 @@ def xxstg_2_xp_mad(xxstg, xp, gamref):
         xp[5] = u2 * gamma * beta * m_e_eV
     return xp
 
+
+
+def xxstg_2_xp_mad_inplace(xxstg, xp, gamref, tmp):
+    """
+    from mad format, the same as xxstg_2_xp_mad() but without temporary arrays.
+    The expressions of xxstg_2_xp_mad() are simplified using gamma*beta = sqrt(gamma**2 - 1)
+
+    :param xxstg: MAD coordinates, array (6, N)
+    :param xp: output, array (6, N) of the positions [m] and momenta [eV/c]
+    :param gamref: reference gamma
+    :param tmp: work array (3, N)
+    :return: xp
+    """
+    pref2m = np.sqrt(gamref ** 2 - 1)       # pref/m_e_eV
+    pref = m_e_eV * pref2m
+    betaref = np.sqrt(1 - gamref ** -2)
+    gamma = tmp[0]
+    pz2pref = tmp[1]
+    np.multiply(xxstg[5], betaref * gamref, out=gamma)
+    gamma += gamref
+    # pz/pref = sqrt((gamma**2 - 1)/(pref/m_e_eV)**2 - px**2 - py**2)
+    np.multiply(gamma, gamma, out=pz2pref)
+    pz2pref -= 1
+    pz2pref /= pref2m ** 2
+    np.multiply(xxstg[1], xxstg[1], out=tmp[2])
+    pz2pref -= tmp[2]
+    np.multiply(xxstg[3], xxstg[3], out=tmp[2])
+    pz2pref -= tmp[2]
+    np.sqrt(pz2pref, out=pz2pref)
+    # c*dt*beta/|p| * pref = pref/m_e_eV*tau/gamma
+    cdt = gamma
+    np.divide(xxstg[4], gamma, out=cdt)
+    cdt *= pref2m
+    np.multiply(xxstg[1], cdt, out=xp[0])
+    np.subtract(xxstg[0], xp[0], out=xp[0])
+    np.multiply(xxstg[3], cdt, out=xp[1])
+    np.subtract(xxstg[2], xp[1], out=xp[1])
+    np.multiply(pz2pref, cdt, out=xp[2])
+    np.negative(xp[2], out=xp[2])
+    np.multiply(xxstg[1], pref, out=xp[3])
+    np.multiply(xxstg[3], pref, out=xp[4])
+    np.multiply(pz2pref, pref, out=xp[5])
+    return xp
+
+
+def xp_2_xxstg_mad_inplace(xp, xxstg, gamref, tmp):
+    """
+    to mad format, the same as xp_2_xxstg_mad() but without temporary arrays.
+    The expressions of xp_2_xxstg_mad() are simplified using beta/|p| = 1/(gamma*m_e_eV)
+
+    :param xp: array (6, N) of the positions [m] and momenta [eV/c]
+    :param xxstg: output, MAD coordinates, array (6, N)
+    :param gamref: reference gamma
+    :param tmp: work array (3, N)
+    :return: xxstg
+    """
+    pref = m_e_eV * np.sqrt(gamref ** 2 - 1)
+    betaref = np.sqrt(1 - gamref ** -2)
+    gamma = tmp[0]
+    xp2pz = tmp[1]
+    # gamma = sqrt(1 + |p|**2/m_e_eV**2)
+    np.multiply(xp[3], xp[3], out=gamma)
+    np.multiply(xp[4], xp[4], out=tmp[2])
+    gamma += tmp[2]
+    np.multiply(xp[5], xp[5], out=tmp[2])
+    gamma += tmp[2]
+    gamma /= m_e_eV ** 2
+    gamma += 1
+    np.sqrt(gamma, out=gamma)
+    np.divide(xp[2], xp[5], out=xp2pz)
+    np.multiply(xp[3], xp2pz, out=xxstg[0])
+    np.subtract(xp[0], xxstg[0], out=xxstg[0])
+    np.multiply(xp[4], xp2pz, out=xxstg[2])
+    np.subtract(xp[1], xxstg[2], out=xxstg[2])
+    # c*dt = -xp[2]/(beta*u2) = -xp[2]/pz*gamma*m_e_eV
+    np.multiply(xp2pz, gamma, out=xxstg[4])
+    xxstg[4] *= -m_e_eV
+    np.divide(xp[3], pref, out=xxstg[1])
+    np.divide(xp[4], pref, out=xxstg[3])
+    np.divide(gamma, gamref, out=xxstg[5])
+    xxstg[5] -= 1
+    xxstg[5] /= betaref
+    return xxstg
@@ -15,6 +15,7 @@ import time
 from scipy.integrate import cumtrapz
 from ocelot.cpbd.physics_proc import PhysProc
 import copy
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import logging
 logger = logging.getLogger(__name__)
 
@@ -88,55 +89,58 @@ def convolution(xu, u, xw, w):
 
 
 def sample_0(i, a, b):
-    y = max(0, min(i + 0.5, b) - max(i - 0.5, a))
+    y = np.maximum(0, np.minimum(i + 0.5, b) - np.maximum(i - 0.5, a))
     return y
 
 
 def sample_1(i, a, b, c):
-    y = 0
-    x1 = max(i - 0.5, a) - a
-    x2 = min(i + 0.5, b) - a
-    if x2 > x1:
-        y = (x2 - x1) * (x1 + x2) / (2 * (b - a))
-
-    x2 = c - max(i - 0.5, b)
-    x1 = c - min(i + 0.5, c)
-    if x2 > x1:
-        y = y + (x2 - x1) * (x1 + x2) / (2 * (b - a))
+    x1 = np.maximum(i - 0.5, a) - a
+    x2 = np.minimum(i + 0.5, b) - a
+    y = np.where(x2 > x1, (x2 - x1) * (x1 + x2) / (2 * (b - a)), 0.)
+
+    x2 = c - np.maximum(i - 0.5, b)
+    x1 = c - np.minimum(i + 0.5, c)
+    y = y + np.where(x2 > x1, (x2 - x1) * (x1 + x2) / (2 * (b - a)), 0.)
     return y
 
 
+def bins2mesh(k1, k2):
+    """
+    flat version of the double loop "for nb in range(N_BIN): for k in range(k1[nb], k2[nb])"
+
+    :param k1: array of the first mesh indices of the bins
+    :param k2: array of the last (excluded) mesh indices of the bins
+    :return: nb, k - arrays of the bin numbers and the mesh indices
+    """
+    counts = np.maximum(k2 - k1, 0)
+    nb = np.repeat(np.arange(len(k1)), counts)
+    k = np.arange(len(nb)) - np.repeat(np.cumsum(counts) - counts, counts) + k1[nb]
+    return nb, k
+
+
 class Smoothing:
     def __init__(self):
         self.print_log = False
-        if nb_flag:
-            logger.debug("Smoothing: NUMBA")
-            self.q_per_step_ip2 = nb.jit()(self.q_per_step_ip2_py)
-        else:
-            logger.debug("Smoothing: Python")
-            self.q_per_step_ip2 = self.q_per_step_ip2_py
+        self.q_per_step_ip2 = self.q_per_step_ip2_py
 
     def q_per_step_ip2_py(self, N_BIN, Q_BIN, BIN0, BIN1, NSIG, RMS, step, Nz, z1):
         Nz = int(Nz)
-        charge_per_step = np.zeros(Nz)
-
-        for nb in range(N_BIN):
-            qbin = Q_BIN[nb]
-            aa = BIN0[nb] - z1
-            bb = BIN1[nb] - z1
-            mitte = 0.5 * (aa + bb)
-            sigma = RMS[nb]
-            aa = mitte - NSIG * sigma
-            bb = mitte + NSIG * sigma
-            a = aa / step + 1
-            k1 = int(min(Nz, max(1, np.floor(a))))
-            b = bb / step + 1
-            k2 = int(min(Nz, max(1, np.ceil(b))))
-            fact = step / (np.sqrt(2 * pi) * sigma)
-            for k in range(k1, k2):
-                xx = (k - 1) * step
-                yy = fact * np.exp(-0.5 * ((xx - mitte) / sigma) ** 2)
-                charge_per_step[int(k - 1)] += yy * qbin
+        aa = BIN0[:N_BIN] - z1
+        bb = BIN1[:N_BIN] - z1
+        mitte = 0.5 * (aa + bb)
+        sigma = RMS[:N_BIN]
+        aa = mitte - NSIG * sigma
+        bb = mitte + NSIG * sigma
+        a = aa / step + 1
+        k1 = np.minimum(Nz, np.maximum(1, np.floor(a))).astype(int)
+        b = bb / step + 1
+        k2 = np.minimum(Nz, np.maximum(1, np.ceil(b))).astype(int)
+        fact = step / (np.sqrt(2 * pi) * sigma)
+
+        nb, k = bins2mesh(k1, k2)
+        xx = (k - 1) * step
+        yy = fact[nb] * np.exp(-0.5 * ((xx - mitte[nb]) / sigma[nb]) ** 2)
+        charge_per_step = np.bincount(k - 1, weights=yy * Q_BIN[nb], minlength=Nz)
         return charge_per_step
 
     def Q2EQUI(self, q, BS_params, SBINB, NBIN):
@@ -168,19 +172,14 @@ class Smoothing:
         I_BIN = K_BIN - (M_BIN - 1) # number of bin intervalls
         # put charges to sub - bins
         Q_BIN = np.zeros(K_BIN)
-        n2 = 0
         if np.size(q) == 1:
-            for k in range(K_BIN):
-                if NBIN[k] > 0:
-                    n1 = n2 + 1
-                    n2 = n2 + NBIN[k]
-                    Q_BIN[k] = q * (n2 - n1 + 1)
+            Q_BIN[:] = q * NBIN[:K_BIN]
         else:
-            for k in range(K_BIN):
-                if NBIN[k] > 0:
-                    n1 = n2 + 1
-                    n2 = n2 + NBIN[k]
-                    Q_BIN[k] = np.sum(q[int(n1-1):int(n2)])
+            # particles are sorted, sub-bin k contains particles n1 ... n1 + NBIN[k] - 1
+            NBIN = np.asarray(NBIN[:K_BIN]).astype(int)
+            n1 = np.cumsum(NBIN) - NBIN
+            full = NBIN > 0
+            Q_BIN[full] = np.add.reduceat(q, n1[full])
 
         # put sub - bins to bins
         qsum = np.append([0], np.cumsum(Q_BIN))
@@ -216,8 +215,7 @@ class Smoothing:
             #RMS = SP * (BIN[1][:] - BIN[0][:])
             MITTE = 0.5 * (BIN[0] + BIN[1])
             RMS = SP * (BIN[1] - BIN[0])
-            for nb in range(N_BIN):
-                RMS[nb] = max(RMS[nb], sigma_min)
+            RMS = np.maximum(RMS, sigma_min)
             z1 = np.min(MITTE - NSIG * RMS)
             z2 = np.max(MITTE + NSIG * RMS)
             step = 0.25 * min(RMS)
@@ -235,36 +233,33 @@ class Smoothing:
             Nz = np.round((z2 - z1) / step)
             step = (z2 - z1) / Nz
 
-        charge_per_step = np.zeros(int(Nz))
         if IP_method == 1:
-            for nb in range(N_BIN):
-                aa = BIN[0][nb] - z1
-                bb = BIN[1][nb] - z1
-                qps = step * Q_BIN(nb) / (bb - aa)
-                a = ((3. * aa - bb) / 2.) / step + 1.
-                k1 = min(Nz, max(1, np.floor(a)))
-                b = ((aa + bb) / 2.) / step + 1.
-                c = ((3. * bb - aa) / 2.) / step + 1.
-                k2 = min(Nz, max(1, np.ceil(c)))
-                for k in range(k1, k2):
-                    w = sample_1(k, a, b, c)
-                    charge_per_step[k-1] += w * qps
+            aa = BIN[0] - z1
+            bb = BIN[1] - z1
+            qps = step * Q_BIN / (bb - aa)
+            a = ((3. * aa - bb) / 2.) / step + 1.
+            k1 = np.minimum(Nz, np.maximum(1, np.floor(a))).astype(int)
+            b = ((aa + bb) / 2.) / step + 1.
+            c = ((3. * bb - aa) / 2.) / step + 1.
+            k2 = np.minimum(Nz, np.maximum(1, np.ceil(c))).astype(int)
+            nb, k = bins2mesh(k1, k2)
+            w = sample_1(k, a[nb], b[nb], c[nb])
+            charge_per_step = np.bincount(k - 1, weights=w * qps[nb], minlength=int(Nz))
 
         elif IP_method == 2:
             charge_per_step = self.q_per_step_ip2(N_BIN, Q_BIN, BIN[0], BIN[1], NSIG, RMS, step, Nz, z1)
             #print(time.time() - t0)
         else:
-            for nb in range(N_BIN):
-                aa = BIN[0][nb] - z1
-                bb = BIN[1][nb] - z1
-                qps = step * Q_BIN[nb] / (bb - aa)
-                a = aa / step + 1
-                k1 = min(Nz, max(1, np.floor(a)))
-                b = bb / step + 1
-                k2 = min(Nz, max(1, np.ceil(b)))
-                for k in range(k1, k2):
-                    w = sample_0(k, a, b)
-                    charge_per_step[k-1] += w * qps
+            aa = BIN[0] - z1
+            bb = BIN[1] - z1
+            qps = step * Q_BIN / (bb - aa)
+            a = aa / step + 1
+            k1 = np.minimum(Nz, np.maximum(1, np.floor(a))).astype(int)
+            b = bb / step + 1
+            k2 = np.minimum(Nz, np.maximum(1, np.ceil(b))).astype(int)
+            nb, k = bins2mesh(k1, k2)
+            w = sample_0(k, a[nb], b[nb])
+            charge_per_step = np.bincount(k - 1, weights=w * qps[nb], minlength=int(Nz))
         return z1, z2, Nz, charge_per_step
 
 
@@ -274,23 +269,22 @@ class SubBinning:
         self.n_bin = n_bin
         self.m_bin = m_bin
         self.print_log = False
-        if nb_flag:
-            logger.debug("SubBinning: NUMBA")
-            self.p_per_subbins = nb.jit(nb.double[:](nb.double[:], nb.double[:], nb.double))(self.p_per_subbins_py)
-        else:
-            logger.debug("SubBinning: Python")
-            self.p_per_subbins = self.p_per_subbins_py
+        self.p_per_subbins = self.p_per_subbins_py
 
     def p_per_subbins_py(self, s, SBINB, K_BIN):
-        NBIN = np.zeros(K_BIN)
-        ib = 0
-        Ns = len(s)
-        for n in range(Ns):
-            while s[n] >= SBINB[ib + 1] and ib < K_BIN - 1:
-                ib = ib + 1
-            NBIN[ib] = NBIN[ib] + 1
-        return NBIN
+        """
+        number of particles per sub-bin
 
+        :param s: sorted longitudinal coordinates of the particles
+        :param SBINB: sub-bin boundaries
+        :param K_BIN: number of sub-bins
+        :return: NBIN
+        """
+        K_BIN = int(K_BIN)
+        # number of particles below the inner boundaries, the last sub-bin takes all particles above SBINB[K_BIN-1]
+        n_below = np.searchsorted(s, SBINB[1:K_BIN], side="left")
+        NBIN = np.diff(np.concatenate(([0], n_below, [len(s)]))).astype(float)
+        return NBIN
 
     def subbin_bound(self, q, s, x_qbin, n_bin, m_bin):
         """
@@ -544,6 +538,19 @@ class K0_fin_anf:
         return w, KS
 
 
+# state of the worker processes of CSR.process_pool
+_csr_worker = {}
+
+
+def _csr_pool_init(traj):
+    _csr_worker["csr"] = CSR()
+    _csr_worker["traj"] = traj
+
+
+def _csr_pool_K1(i, NdW, gamma):
+    return _csr_worker["csr"].CSR_K1(i, _csr_worker["traj"], NdW, gamma=gamma)
+
+
 class CSR(PhysProc):
     """
     coherent synchrotron radiation
@@ -552,6 +559,9 @@ class CSR(PhysProc):
         self.sigma_min = 1.e-4  - minimal sigma if gauss filtering applied
         self.traj_step = 0.0002 [m] - trajectory step or, other words, integration step for calculation of the CSR-wake
         self.apply_step = 0.0005 [m] - step of the calculation CSR kick, to calculate average CSR kick
+        self.n_workers = 1 - number of workers for the calculation of the CSR kernels. If > 1 the kernels of
+                            the different observer points are calculated in parallel
+        self.pool_type = "process" - "process" or "thread" pool of the workers
     """
     def __init__(self):
         PhysProc.__init__(self)
@@ -578,6 +588,11 @@ class CSR(PhysProc):
         self.z_csr_start = 0.       # z [m] position of the start_elem
         self.z0 = 0.                # self.z0 = navigator.z0 in track.track()
 
+        # parallel calculation of the CSR kernels
+        self.n_workers = 1          # number of workers, if 1 the kernels are calculated serially
+        self.pool_type = "process"  # "process" or "thread"
+        self.pool = None
+
         self.debug = False
         # another filter
         self.filter_order = 10
@@ -742,6 +757,61 @@ class CSR(PhysProc):
         K1 = np.diff(np.append(np.diff(np.append(KS, 0)), 0))/NdW[1]/four_pi_eps0
         return K1
 
+    def get_pool(self):
+        """
+        returns the pool of workers for the CSR kernels calculation. The pool is created once and is reused
+        for all CSR kicks. The process pool gets a copy of the trajectory at the creation.
+
+        :return: ThreadPoolExecutor or ProcessPoolExecutor
+        """
+        if self.pool is None:
+            if self.pool_type == "thread":
+                self.pool = ThreadPoolExecutor(max_workers=self.n_workers)
+            elif self.pool_type == "process":
+                self.pool = ProcessPoolExecutor(max_workers=self.n_workers, initializer=_csr_pool_init,
+                                                initargs=(self.csr_traj,))
+            else:
+                raise ValueError("CSR.pool_type must be 'process' or 'thread', not " + str(self.pool_type))
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def finish(self):
+        # the worker processes are not kept after the tracking
+        self.close_pool()
+
+    def K1_average(self, itr_ra, NdW, gamma):
+        """
+        average CSR kernel over the observer points itr_ra.
+        The kernels are summed up in the order of itr_ra also for the parallel calculation,
+        so the result does not depend on self.n_workers.
+
+        :param itr_ra: indices of the trajectory points (observer points)
+        :param NdW: list N[0] 0 number of mesh points, N[1] = dW> 0 - increment
+        :param gamma: Lorentz factor
+        :return: K1
+        """
+        n_iter = len(itr_ra)
+        if self.n_workers > 1 and n_iter > 1:
+            pool = self.get_pool()
+            if self.pool_type == "thread":
+                kernels = pool.map(self.CSR_K1, itr_ra, [self.csr_traj] * n_iter, [NdW] * n_iter, [gamma] * n_iter)
+            else:
+                kernels = pool.map(_csr_pool_K1, itr_ra, [NdW] * n_iter, [gamma] * n_iter)
+            kernels = list(kernels)
+        else:
+            kernels = (self.CSR_K1(i, self.csr_traj, NdW, gamma=gamma) for i in itr_ra)
+        K1 = None
+        for kernel in kernels:
+            if K1 is None:
+                K1 = kernel
+            else:
+                K1 += kernel
+        return K1 / n_iter
+
     def prepare(self, lat):
         """
         calculation of trajectory in rectangular coordinates
@@ -776,6 +846,8 @@ class CSR(PhysProc):
                 R_vect = [0, 0, 0.]
 
             self.csr_traj = arcline(self.csr_traj, delta_s, step, R_vect )
+        # the process pool keeps the old trajectory
+        self.close_pool()
         #import matplotlib.pyplot as plt
         #plt.figure(10)
         #plt.plot(self.csr_traj[0,:], self.csr_traj[1,:], "r")
@@ -790,7 +862,8 @@ class CSR(PhysProc):
             return
         s_cur = self.z0 - self.z_csr_start
         z = -p_array.tau()
-        ind_z_sort = np.argsort(z)
+        # z = -tau, particles sorted in tau are sorted in z in the reversed order
+        ind_z_sort = p_array.longitudinal_profile().sort_indx[::-1]
         #SBINB, NBIN = subbin_bound(p_array.q_array, z[ind_z_sort], self.x_qbin, self.n_bin, self.m_bin)
         #B_params = [self.x_qbin, self.n_bin, self.m_bin, self.ip_method, self.sp, self.sigma_min]
         #s1, s2, Ns, lam_ds = Q2EQUI(p_array.q_array[ind_z_sort], B_params, SBINB, NBIN)
@@ -809,14 +882,9 @@ class CSR(PhysProc):
 
         itr_ra = np.unique(-np.round(np.arange(-indx, -indx_prev, h))).astype(np.int)
 
-        nit = 0
-        n_iter = len(itr_ra)
         #start = time.time()
-        K1 = self.CSR_K1(itr_ra[nit], self.csr_traj, Ndw, gamma)
-        for nit in range(1, n_iter):
-            K1 += self.CSR_K1(itr_ra[nit], self.csr_traj, Ndw, gamma=gamma)
+        K1 = self.K1_average(itr_ra, Ndw, gamma)
         #print("K1 = ", time.time() - start)
-        K1 = K1/n_iter
 
 
         lam_K1 = csr_convolution(lam_ds, K1[::-1]) / st * delta_s
@@ -870,7 +938,8 @@ class CSR(PhysProc):
         s2 = max(z)
         bunch_size = s2 - s1
         st = bunch_size / (self.n_mesh + 1)
-        I = s2current(z, p_array.q_array, n_points=self.n_mesh, filter_order=self.filter_order, mean_vel=speed_of_light)
+        I = p_array.longitudinal_profile().current(n_points=self.n_mesh, filter_order=self.filter_order,
+                                                    mean_vel=speed_of_light)
         Ns = len(I[:, 0])
         sa = s1 + st / 2.
         Ndw = [self.n_mesh, st]
@@ -884,14 +953,9 @@ class CSR(PhysProc):
         h = max(1., self.apply_step / self.traj_step)
         itr_ra = np.unique(-np.round(np.arange(-indx, -indx_prev, h))).astype(np.int)
 
-        nit = 0
-        n_iter = len(itr_ra)
         # start = time.time()
-        K1 = self.CSR_K1(itr_ra[nit], self.csr_traj, Ndw, gamma)
-        for nit in range(1, n_iter):
-            K1 += self.CSR_K1(itr_ra[nit], self.csr_traj, Ndw, gamma=gamma)
+        K1 = self.K1_average(itr_ra, Ndw, gamma)
         # print("K1 = ", time.time() - start)
-        K1 = K1 / n_iter
 
 
         lam_K1 = csr_convolution(lam_ds, K1) / st * delta_s
@@ -0,0 +1,182 @@
+"""
+Sampling of the beam diagnostics in track(): the envelope (get_envelope) is calculated only at the selected steps,
+the twiss parameters are stored in the columnar buffer and optionally streamed to the text file.
+"""
+
+from time import time
+import numpy as np
+from ocelot.cpbd.beam import Twiss, get_envelope
+from ocelot.cpbd.elements import Marker
+from ocelot.common.text_io import format_e
+import logging
+
+logger = logging.getLogger(__name__)
+
+TWISS_COLUMNS = ["s", "E", "beta_x", "beta_y", "alpha_x", "alpha_y", "emit_x", "emit_y",
+                 "x", "px", "y", "py", "p"]
+
+
+class TwissSampler:
+    """
+    Sampling of the twiss parameters in track()
+    Attributes:
+        every = None - sample every k-th step
+        ds = None - sample if the distance from the last sample is ds [m] or more
+        markers = None - sample at the first step which reaches the end of the element: list of elements or
+                  True - all Markers of the lattice
+        max_overhead = None - if set, the steps selected by every and ds are skipped while the time of the sampling
+                       is more than max_overhead * (time of the tracking), e.g. 0.05
+        filename = None - the rows are appended to the text file (header "# s E beta_x ...", np.loadtxt() readable)
+        keep_twiss = True - the sampled Twiss objects are returned by track(), otherwise only the first one
+        columns - names of the Twiss attributes in the buffer, the missing attributes are NaN
+        buffer_rows = 1000 - number of rows which are written to the file at once
+    The conditions are combined by OR, without conditions every step is sampled. The first and the last steps are
+    always sampled.
+    Example:
+        sampler = TwissSampler(every=10, markers=True, filename="tws.txt")
+        tws, p_array = track(lat, p_array, navi, sampler=sampler)
+        s, beta_x = sampler.column("s"), sampler.column("beta_x")
+    """
+    def __init__(self, every=None, ds=None, markers=None, max_overhead=None, filename=None, keep_twiss=True,
+                 columns=None, buffer_rows=1000):
+        self.every = every
+        self.ds = ds
+        self.markers = markers
+        self.max_overhead = max_overhead
+        self.filename = filename
+        self.keep_twiss = keep_twiss
+        self.columns = list(TWISS_COLUMNS if columns is None else columns)
+        self.buffer_rows = buffer_rows
+        self.data = np.zeros((0, len(self.columns)))
+        self.n = 0                  # number of the samples
+        self.n_written = 0          # number of the samples in the file
+        self.n_steps = 0
+        self.z_last = 0.            # position of the last sample
+        self.marker_s = np.zeros(0)
+        self.i_marker = 0           # number of the passed markers
+        self.t_start = 0.
+        self.t_sample = 0.          # time of the sampling
+
+    def start(self, lattice, navi, tws_track=()):
+        """
+        reset the sampler, called by track() before the tracking
+
+        :param lattice: MagneticLattice
+        :param navi: Navigator
+        :param tws_track: Twiss list of the restored checkpoint, it is added to the buffer
+        :return: None
+        """
+        self.data = np.zeros((max(self.buffer_rows, len(tws_track)), len(self.columns)))
+        self.n = 0
+        self.n_written = 0
+        self.n_steps = 0
+        self.z_last = navi.z0
+        self.t_start = time()
+        self.t_sample = 0.
+        if self.markers is not None:
+            ends = np.cumsum([e.l for e in lattice.sequence])
+            if self.markers is True:
+                self.marker_s = np.array([z for z, e in zip(ends, lattice.sequence) if isinstance(e, Marker)])
+            else:
+                ids = set(id(e) for e in self.markers)
+                self.marker_s = np.array([z for z, e in zip(ends, lattice.sequence) if id(e) in ids])
+            self.i_marker = np.searchsorted(self.marker_s, navi.z0 + 1e-10, side="right")
+        if self.filename is not None:
+            with open(self.filename, "w") as f:
+                f.write("# " + " ".join(self.columns) + "\n")
+        for tw in tws_track:
+            self.append(tw)
+
+    def check(self, z, last=False):
+        """
+        decide if the step is sampled, called by track() after every step
+
+        :param z: position in the lattice after the step
+        :param last: True for the last step
+        :return: True if the step has to be sampled
+        """
+        self.n_steps += 1
+        if self.every is None and self.ds is None and self.markers is None:
+            return True
+        forced = last
+        if self.markers is not None:
+            i = np.searchsorted(self.marker_s, z + 1e-10, side="right")
+            forced = forced or i > self.i_marker
+            self.i_marker = i
+        hit = (self.every is not None and self.n_steps % self.every == 0) or \
+              (self.ds is not None and z - self.z_last >= self.ds - 1e-10)
+        if hit and self.max_overhead is not None:
+            t_track = time() - self.t_start - self.t_sample
+            hit = self.t_sample <= self.max_overhead * t_track
+        if forced or hit:
+            self.z_last = z
+            return True
+        return False
+
+    def sample(self, p_array, L, calc_tws=True):
+        """
+        calculate the twiss parameters of the beam and add them to the buffer
+
+        :param p_array: ParticleArray
+        :param L: tracked length, it is added to tw.s
+        :param calc_tws: if False the empty Twiss is added
+        :return: Twiss
+        """
+        t = time()
+        tw = get_envelope(p_array) if calc_tws else Twiss()
+        tw.s += L
+        self.append(tw)
+        self.t_sample += time() - t
+        return tw
+
+    def append(self, tw):
+        """
+        add the row of the twiss parameters to the buffer, the full buffer is written to the file
+
+        :param tw: Twiss
+        :return: None
+        """
+        if self.n == len(self.data):
+            self.data = np.concatenate((self.data, np.zeros((max(len(self.data), 1), len(self.columns)))))
+        self.data[self.n] = [getattr(tw, c, np.nan) for c in self.columns]
+        self.n += 1
+        if self.n - self.n_written >= self.buffer_rows:
+            self.flush()
+
+    def flush(self):
+        """
+        write the new rows to the file
+
+        :return: None
+        """
+        if self.filename is not None and self.n > self.n_written:
+            with open(self.filename, "ab") as f:
+                f.write(format_e(self.data[self.n_written:self.n], precision=10))
+        self.n_written = self.n
+
+    def close(self):
+        """
+        called by track() at the end of the tracking
+
+        :return: None
+        """
+        self.flush()
+        t_total = time() - self.t_start
+        if t_total > 0:
+            logger.debug("TwissSampler: " + str(self.n) + " samples of " + str(self.n_steps) + " steps, sampling " +
+                         str(round(100. * self.t_sample / t_total, 1)) + "% of the time")
+
+    def column(self, name):
+        """
+        sampled values of the twiss parameter
+
+        :param name: name of the column, e.g. "s", "beta_x"
+        :return: array
+        """
+        return self.data[:self.n, self.columns.index(name)]
+
+    def to_dict(self):
+        """
+        :return: dict {column name: array}
+        """
+        return dict([(c, self.column(c)) for c in self.columns])
@@ -0,0 +1,298 @@
+"""
+Distributed tracking with collective effects.
+
+The ParticleArray is divided between processes, every process tracks its part of the beam through the transfer maps.
+The physics processes which support the distributed tracking (PhysProc.distributed = True, e.g. SpaceCharge,
+Wake, ResistiveWallWake) reduce the charge grids and the line densities of all processes and
+apply the fields locally. For other physics processes (e.g. CSR, SaveBeam) the beam is gathered
+by the root process, the process is applied and the beam is scattered back.
+
+Two types of the communicators are supported:
+    - mpi4py communicator (MPI.COMM_WORLD), the script is started with mpirun on one or several nodes
+    - PipeComm, the processes are forked on one node by track_distributed(n_proc=...)
+
+Limitations of the scaling: only the transfer maps and the distributed physics processes are parallel. Every gathered
+process moves the whole beam through the root process twice, and PipeComm sends all messages (also the reductions)
+through the root as pickles, so the communication grows with the number of processes and the speedup is bounded by
+the fraction of the time spent in the transfer maps and the distributed processes.
+"""
+
+import sys
+import multiprocessing
+from functools import reduce
+import numpy as np
+from ocelot.cpbd.beam import ParticleArray, Twiss, partial_moments, merge_moments, envelope_twiss
+from ocelot.cpbd.track import tracking_step, finish_processes
+from ocelot.cpbd.async_io import flush_writes
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PipeComm:
+    """
+    Communicator of the processes on one node with the subset of the mpi4py interface which is used in
+    the distributed tracking. All messages go through the root process (rank 0) via multiprocessing pipes.
+    """
+    def __init__(self, rank, size, conns, procs=None):
+        """
+        :param rank: rank of the process
+        :param size: number of the processes
+        :param conns: connections to the processes 1..size-1 for the root process, connection to the root otherwise
+        :param procs: worker processes (only for the root), are used to detect died workers
+        """
+        self.rank = rank
+        self.size = size
+        self.conns = conns
+        self.procs = procs
+
+    def Get_rank(self):
+        return self.rank
+
+    def Get_size(self):
+        return self.size
+
+    def recv(self, conn):
+        while not conn.poll(1.):
+            if self.procs is not None and not all([p.is_alive() for p in self.procs]):
+                raise RuntimeError("PipeComm: worker process died")
+        return conn.recv()
+
+    def gather(self, obj, root=0):
+        if self.rank == 0:
+            return [obj] + [self.recv(conn) for conn in self.conns]
+        self.conns[0].send(obj)
+        return None
+
+    def scatter(self, objs, root=0):
+        if self.rank == 0:
+            for obj, conn in zip(objs[1:], self.conns):
+                conn.send(obj)
+            return objs[0]
+        return self.recv(self.conns[0])
+
+    def bcast(self, obj, root=0):
+        if self.rank == 0:
+            for conn in self.conns:
+                conn.send(obj)
+            return obj
+        return self.recv(self.conns[0])
+
+    def reduce(self, obj, root=0):
+        objs = self.gather(obj)
+        if self.rank == 0:
+            return reduce(lambda a, b: a + b, objs)
+        return None
+
+    def allreduce(self, obj):
+        return self.bcast(self.reduce(obj))
+
+    def allgather(self, obj):
+        return self.bcast(self.gather(obj))
+
+    def Barrier(self):
+        self.allgather(None)
+
+
+def split_indices(n, size):
+    """
+    bounds of the parts of the beam
+
+    :param n: number of particles
+    :param size: number of processes
+    :return: array of size + 1 bounds
+    """
+    return np.linspace(0, n, size + 1).astype(int)
+
+
+def sub_array(p_array, i0, i1):
+    """
+    copy of the part of the ParticleArray
+
+    :param p_array: ParticleArray
+    :param i0: first particle
+    :param i1: last particle + 1
+    :return: ParticleArray
+    """
+    p = ParticleArray()
+    p.rparticles = np.copy(p_array.rparticles[:, i0:i1])
+    p.q_array = np.copy(p_array.q_array[i0:i1])
+    p.E = p_array.E
+    p.s = p_array.s
+    return p
+
+
+def apply_gathered(comm, proc, p_array, dz):
+    """
+    apply the physics process which does not support the distributed tracking:
+    the beam is gathered by the root process, the process is applied and the beam is divided evenly again
+    (the process can change the number of particles and the charges)
+
+    :param comm: communicator
+    :param proc: physics process
+    :param p_array: part of the beam of the process
+    :param dz: step in [m]
+    :return: None
+    """
+    parts = comm.gather((p_array.rparticles, p_array.q_array))
+    if comm.Get_rank() == 0:
+        p_full = ParticleArray()
+        p_full.rparticles = np.hstack([part[0] for part in parts])
+        p_full.q_array = np.hstack([part[1] for part in parts])
+        p_full.E = p_array.E
+        p_full.s = p_array.s
+        proc.apply(p_full, dz)
+        p_full.compact()
+        bounds = split_indices(p_full.rparticles.shape[1], len(parts))
+        parts = [(p_full.rparticles[:, bounds[i]:bounds[i+1]], p_full.q_array[bounds[i]:bounds[i+1]],
+                  p_full.E, p_full.s) for i in range(len(parts))]
+    rparticles, q_array, E, s = comm.scatter(parts)
+    p_array.rparticles = np.array(rparticles)
+    p_array.q_array = np.array(q_array)
+    p_array.E = E
+    p_array.s = s
+    p_array.invalidate_profile()
+
+
+def get_envelope_distributed(comm, p_array, tws_i=Twiss()):
+    """
+    get_envelope() for the beam distributed between processes: the moments of the parts (partial_moments(),
+    the lost particles are excluded) are gathered and combined by merge_moments() as the blocks of get_envelope()
+
+    :param comm: communicator
+    :param p_array: part of the beam of the process
+    :param tws_i: Twiss with the dispersion
+    :return: Twiss
+    """
+    part = partial_moments(p_array.rparticles, tws_i=tws_i, lost=p_array.lost)
+    moments = merge_moments(comm.allgather(part))
+    if moments is None:
+        mean, cov = np.ones(6) * np.nan, np.ones((6, 6)) * np.nan
+    else:
+        n, mean, S = moments
+        cov = S / n
+    return envelope_twiss(mean, cov, p_array.E)
+
+
+def track_part(comm, lattice, p_array, navi, print_progress=True, calc_tws=True):
+    """
+    tracking of the part of the beam, the function is called by all processes
+
+    :param comm: communicator
+    :param lattice: Magnetic Lattice
+    :param p_array: part of the beam of the process
+    :param navi: Navigator
+    :return: twiss list, ParticleArray
+    """
+    rank = comm.Get_rank()
+    p_array.comm = comm
+    tw0 = get_envelope_distributed(comm, p_array) if calc_tws else Twiss()
+    tws_track = [tw0]
+    L = 0.
+    if navi.adaptive:
+        navi.beam_state = navi.beam_quantities(p_array)
+    while np.abs(navi.z0 - lattice.totalLen) > 1e-10:
+        if comm.bcast(navi.kill_process):
+            if rank == 0:
+                print("Killing tracking ... ")
+            break
+        dz, proc_list = navi.get_next()
+
+        tracking_step(lat=lattice, particle_list=p_array, dz=dz, navi=navi)
+
+        for p in proc_list:
+            p.z0 = navi.z0
+            if p.distributed:
+                p.apply(p_array, dz)
+            else:
+                apply_gathered(comm, p, p_array, dz)
+        if navi.adaptive:
+            # the steps are estimated by the root process from its part of the beam
+            navi.update_steps(p_array, dz, proc_list)
+            steps = comm.bcast([(p.step, p.counter) for p in navi.process_table.proc_list])
+            for p, (step, counter) in zip(navi.process_table.proc_list, steps):
+                p.step = step
+                p.counter = counter
+        tw = get_envelope_distributed(comm, p_array) if calc_tws else Twiss()
+        L += dz
+        tw.s += L
+        tws_track.append(tw)
+
+        if print_progress and rank == 0:
+            poc_names = [p.__class__.__name__ for p in proc_list]
+            sys.stdout.write( "\r" + "z = " + str(navi.z0)+" / "+str(lattice.totalLen) + " : applied: " + ", ".join(poc_names)  )
+            sys.stdout.flush()
+    p_array.comm = None
+    p_array.invalidate_profile()
+    finish_processes(navi)
+    return tws_track, p_array
+
+
+def _track_worker(rank, size, conn, lattice, p_array, navi, calc_tws):
+    # worker process of track_distributed() in the fork mode, p_array is the whole beam (copy of the parent memory)
+    comm = PipeComm(rank, size, [conn])
+    bounds = split_indices(p_array.size(), size)
+    p_part = sub_array(p_array, bounds[rank], bounds[rank + 1])
+    del p_array
+    tws_track, p_part = track_part(comm, lattice, p_part, navi, print_progress=False, calc_tws=calc_tws)
+    comm.gather((p_part.rparticles, p_part.q_array, p_part.E, p_part.s))
+
+
+def track_distributed(lattice, p_array, navi, n_proc=None, comm=None, print_progress=True, calc_tws=True):
+    """
+    tracking through the lattice with the beam distributed between processes, see track().
+    The transfer maps are applied by every process to its part of the beam. The physics processes with
+    PhysProc.distributed = True reduce the charge grids and the currents of all processes, the other physics
+    processes are applied by the root process to the gathered beam.
+
+    :param lattice: Magnetic Lattice
+    :param p_array: ParticleArray, is used only by the root process in MPI mode
+    :param navi: Navigator
+    :param n_proc: number of the processes on one node if comm is None, if None multiprocessing.cpu_count()
+    :param comm: mpi4py communicator (e.g. MPI.COMM_WORLD). The function has to be called by all MPI processes.
+                 If None the processes are forked on one node
+    :param print_progress: print the progress
+    :param calc_tws: calculate twiss parameters after each step
+    :return: twiss list, ParticleArray - the whole beam for the root process, the part of the beam otherwise
+    """
+    if comm is None:
+        n_proc = multiprocessing.cpu_count() if n_proc is None else n_proc
+        ctx = multiprocessing.get_context("fork")
+        pipes = [ctx.Pipe() for i in range(1, n_proc)]
+        procs = [ctx.Process(target=_track_worker, args=(i, n_proc, pipes[i - 1][1], lattice, p_array, navi, calc_tws))
+                 for i in range(1, n_proc)]
+        for proc in procs:
+            proc.daemon = True
+            proc.start()
+        comm = PipeComm(0, n_proc, [pipe[0] for pipe in pipes], procs)
+        bounds = split_indices(p_array.size(), n_proc)
+        p_part = sub_array(p_array, bounds[0], bounds[1])
+    else:
+        rank = comm.Get_rank()
+        size = comm.Get_size()
+        parts = None
+        if rank == 0:
+            bounds = split_indices(p_array.size(), size)
+            parts = [sub_array(p_array, bounds[i], bounds[i + 1]) for i in range(size)]
+        p_part = comm.scatter(parts)
+        procs = []
+
+    tws_track, p_part = track_part(comm, lattice, p_part, navi, print_progress=print_progress, calc_tws=calc_tws)
+    parts = comm.gather((p_part.rparticles, p_part.q_array, p_part.E, p_part.s))
+    for proc in procs:
+        proc.join()
+    flush_writes()
+    if comm.Get_rank() != 0:
+        return tws_track, p_part
+    rparticles = np.hstack([part[0] for part in parts])
+    q_array = np.hstack([part[1] for part in parts])
+    if rparticles.shape == p_array.rparticles.shape:
+        p_array.rparticles[:] = rparticles
+        p_array.q_array[:] = q_array
+    else:
+        p_array.rparticles = rparticles
+        p_array.q_array = q_array
+    p_array.E = p_part.E
+    p_array.s = p_part.s
+    p_array.invalidate_profile()
+    return tws_track, p_array
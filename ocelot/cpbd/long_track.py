@@ -0,0 +1,340 @@
+"""
+Fast longitudinal tracking for the parameter scans of the bunch compressors.
+
+The beam starts with zero transverse coordinates, the horizontal and vertical coordinates carry only the
+dispersion generated by the lattice (it is needed for R56 and T566 of the chicanes).
+The transfer maps between the cavities and the physics processes are composed once into one second order map
+(evaluated at the nominal energy with the nominal cavity settings), the cavities are tracked with the analytic
+map of CavityTM vectorized over the scan settings, the collective effects (CSR, wakes) are applied for every setting.
+"""
+
+import numpy as np
+from ocelot.cpbd.beam import ParticleArray, LongitudinalProfile
+from ocelot.cpbd.optics import Navigator, SecondTM, CavityTM, get_elem_slices
+from ocelot.cpbd.r_matrix import rot_mtx
+from ocelot.cpbd.elements import Cavity
+from ocelot.cpbd.csr import CSR
+from ocelot.cpbd.wake3D import Wake, ResistiveWallWake
+from ocelot.common.globals import m_e_GeV, speed_of_light
+import logging
+
+logger = logging.getLogger(__name__)
+
+# physics processes which are applied by the LongitudinalTracker, the others are skipped
+longitudinal_processes = (CSR, Wake, ResistiveWallWake)
+
+# second order terms (i, j, k) which are used by SecondOrderMult
+_T_MASK = np.zeros((6, 6, 6), dtype=bool)
+for i in (0, 1, 4):
+    for j, k in [(0, 0), (0, 1), (0, 5), (1, 1), (1, 5), (5, 5), (2, 2), (2, 3), (3, 3)]:
+        _T_MASK[i, j, k] = True
+for i in (2, 3):
+    for j, k in [(0, 2), (0, 3), (1, 2), (1, 3), (2, 5), (3, 5)]:
+        _T_MASK[i, j, k] = True
+
+
+def second_order_map(tm, energy):
+    """
+    matrices R and T of the transfer map, the second order terms are taken only from SecondTM.
+    Misalignments dx, dy are ignored.
+
+    :param tm: TransferMap
+    :param energy: energy in [GeV]
+    :return: R - array (6, 6), T - array (6, 6, 6) of the quadratic form X1_i = R_ij X_j + T_ijk X_j X_k
+    """
+    R = tm.R(energy)
+    T = np.zeros((6, 6, 6))
+    if isinstance(tm, SecondTM):
+        T[_T_MASK] = tm.t_mat_z_e(tm.length, energy)[_T_MASK]
+        if tm.tilt != 0:
+            rot_ent = rot_mtx(tm.tilt)
+            rot_ext = rot_mtx(-tm.tilt)
+            T = np.einsum("ia,abc,bj,ck->ijk", rot_ext, T, rot_ent, rot_ent)
+    if tm.dx != 0 or tm.dy != 0:
+        logger.debug("second_order_map: offsets dx, dy are ignored")
+    return R, T
+
+
+def compose_maps(R1, T1, R2, T2):
+    """
+    second order map of (R1, T1) followed by (R2, T2), the third and fourth order terms are dropped
+
+    :return: R, T
+    """
+    R = np.dot(R2, R1)
+    T = np.einsum("il,ljk->ijk", R2, T1) + np.einsum("ilm,lj,mk->ijk", T2, R1, R1)
+    return R, T
+
+
+def apply_map(X, R, T, live):
+    """
+    second order map for the particles of all settings
+
+    :param X: array (M, 6, N) - coordinates of N particles for M settings
+    :param R: array (6, 6)
+    :param T: array (6, 6, 6)
+    :param live: boolean array (6) - coordinates which can be non zero
+    :return: X1, live1
+    """
+    cols = np.where(live)[0]
+    X1 = np.matmul(R[:, cols], X[:, cols, :])
+    live1 = np.any(R[:, cols] != 0, axis=1)
+    for n, j in enumerate(cols):
+        for k in cols[n:]:
+            c = T[:, j, k] + T[:, k, j] if j != k else T[:, j, j]
+            rows = np.where(c != 0)[0]
+            if len(rows) == 0:
+                continue
+            prod = X[:, j] * X[:, k]
+            for i in rows:
+                X1[:, i] += c[i] * prod
+            live1[rows] = True
+    return X1, live1
+
+
+def cavity_map(X, E, V, freq, phi, z):
+    """
+    CavityTM.map4cav() (without coupler kicks) vectorized over the settings
+
+    :param X: array (M, 6, N), is changed in place
+    :param E: array (M) - initial energies in [GeV]
+    :param V: array (M) - voltages of the slice in [GV]
+    :param freq: frequency in [Hz]
+    :param phi: array (M) - phases in [deg]
+    :param z: length of the slice in [m]
+    :return: array (M) - final energies
+    """
+    phi = phi * np.pi / 180.
+    cos_phi = np.cos(phi)
+    de = V * cos_phi
+    Ei = E / m_e_GeV
+    Ef = (E + de) / m_e_GeV
+    with np.errstate(divide="ignore", invalid="ignore"):
+        Ep = (Ef - Ei) / z if z != 0 else np.zeros_like(Ei)
+        alpha = np.sqrt(1. / 8.) / cos_phi * np.log(Ef / Ei)
+        alpha = np.where(Ef != Ei, alpha, 0.)
+        sin_alpha = np.sin(alpha)
+        cos_alpha = np.cos(alpha)
+        r11 = cos_alpha - np.sqrt(2.) * cos_phi * sin_alpha
+        r12 = np.where(np.abs(Ep) > 1e-10, np.sqrt(8.) * Ei / Ep * cos_phi * sin_alpha, z)
+        r21 = np.where(sin_alpha != 0, -Ep / Ef * (cos_phi / np.sqrt(2.) + np.sqrt(1. / 8.) / cos_phi) * sin_alpha, 0.)
+        r22 = Ei / Ef * (cos_alpha + np.sqrt(2.) * cos_phi * sin_alpha)
+        beta0 = np.sqrt(1. - 1. / (Ei * Ei))
+        beta1 = np.sqrt(1. - 1. / (Ef * Ef))
+        r56 = np.where((V != 0) & (E != 0) & (Ef != Ei), (beta0 / beta1 - 1) * Ei / (Ef - Ei) * z, 0.)
+        r56 = np.where((V != 0) & (E != 0) & (Ef == Ei), -z / (Ei * Ei - 1.), r56)
+    k = 2. * np.pi * freq / speed_of_light
+    r66 = Ei / Ef
+    r65 = k * np.sin(phi) * V / (Ef * m_e_GeV)
+
+    r11, r12, r21, r22, r56, r65, r66 = [r[:, np.newaxis] for r in (r11, r12, r21, r22, r56, r65, r66)]
+    for i in (0, 2):
+        x = r11 * X[:, i] + r12 * X[:, i + 1]
+        X[:, i + 1] = r21 * X[:, i] + r22 * X[:, i + 1]
+        X[:, i] = x
+    tau = X[:, 4] + r56 * X[:, 5]
+    X[:, 5] = r65 * X[:, 4] + r66 * X[:, 5]
+    X[:, 4] = tau
+
+    E1 = E + de
+    ind = E1 > 0
+    tau = X[ind, 4]
+    f = (V[ind] / E1[ind])[:, np.newaxis]
+    phi = phi[ind][:, np.newaxis]
+    X[ind, 5] += f * (np.cos(-tau * k + phi) - np.cos(phi) - k * tau * np.sin(phi))
+    return E1
+
+
+class LongitudinalTracker:
+    """
+    Fast tracking of (tau, p) phase space through the lattice for many settings of the cavities at once,
+    e.g. for the scans of the phases and the voltages of the bunch compressor linacs.
+
+    The transfer maps are evaluated at the nominal energy of the lattice (cavities with their own v and phi),
+    the dependence of the magnet maps on the energy of the setting (~1/gamma^2) is neglected.
+    The physics processes of the Navigator from longitudinal_processes (CSR, Wake, ResistiveWallWake) are applied
+    to every setting, the other processes (e.g. SpaceCharge) are skipped.
+
+    Example:
+        lt = LongitudinalTracker(lat, navi)
+        phi = np.linspace(-30, -20, 50)
+        rparticles, E = lt.track(p_array, settings={c1: {"phi": phi}})
+        I = lt.currents()
+        h = lt.chirps()
+    """
+    def __init__(self, lattice, navi=None):
+        """
+        :param lattice: MagneticLattice
+        :param navi: Navigator with the physics processes, the navigator is moved to the end of the lattice.
+                     If None, no physics processes
+        """
+        self.lat = lattice
+        self.steps = []         # [("map", element, dl), ("cav", element, dl), ("proc", process, dz, z0)]
+        self.maps = {}          # compiled operations {maps_key(E0): ops}
+        self.rparticles = None  # result of the last track(), array (M, 6, N)
+        self.E = None           # energies of the last track(), array (M)
+        self.q_array = None
+        self.compile_steps(navi if navi is not None else Navigator(lattice))
+
+    def compile_steps(self, navi):
+        """
+        steps of the tracking, see track()
+
+        :param navi: Navigator
+        :return: None
+        """
+        skipped = set()
+        while np.abs(navi.z0 - self.lat.totalLen) > 1e-10:
+            dz, proc_list = navi.get_next()
+            if navi.z0 + dz > self.lat.totalLen:
+                dz = self.lat.totalLen - navi.z0
+            for elem, dl in get_elem_slices(self.lat, dz, navi):
+                if elem.__class__ == Cavity and isinstance(elem.transfer_map, CavityTM):
+                    self.steps.append(("cav", elem, dl))
+                else:
+                    self.steps.append(("map", elem, dl))
+            for p in proc_list:
+                if isinstance(p, longitudinal_processes):
+                    self.steps.append(("proc", p, dz, navi.z0))
+                else:
+                    skipped.add(p.__class__.__name__)
+        for name in skipped:
+            logger.warning("LongitudinalTracker: physics process " + name + " is skipped")
+
+    def maps_key(self, energy):
+        """
+        key of the compiled operations: the initial energy, the transfer maps of the elements (a new map is created
+        by MagneticLattice.update_transfer_maps()) and the parameters of the cavities
+
+        :param energy: initial energy in [GeV]
+        :return: tuple
+        """
+        tms = tuple([step[1].transfer_map for step in self.steps if step[0] != "proc"])
+        cavs = tuple([(step[1].v, step[1].phi, step[1].f) for step in self.steps if step[0] == "cav"])
+        return (energy, tms, cavs)
+
+    def compile_maps(self, energy):
+        """
+        operations of the tracking for the initial energy: the maps between the cavities and the physics processes
+        are composed into one second order map
+
+        :param energy: initial energy in [GeV]
+        :return: list of the operations [("map", R, T), ("cav", element, dl), ("proc", process, dz, z0)]
+        """
+        ops = []
+        R, T = None, None
+        for step in self.steps:
+            if step[0] == "map":
+                elem, dl = step[1:]
+                tm = elem.transfer_map(dl)
+                R2, T2 = second_order_map(tm, energy)
+                R, T = (R2, T2) if R is None else compose_maps(R, T, R2, T2)
+                energy += tm.delta_e
+                continue
+            if R is not None:
+                ops.append(("map", R, T))
+                R, T = None, None
+            if step[0] == "cav":
+                elem, dl = step[1:]
+                energy += elem.transfer_map(dl).delta_e
+            ops.append(step)
+        if R is not None:
+            ops.append(("map", R, T))
+        return ops
+
+    def track(self, p_array, settings=None):
+        """
+        tracking of the longitudinal phase space of the beam for all settings
+
+        :param p_array: ParticleArray, only tau, p and the charges are used
+        :param settings: dict {cavity: {"v": voltages, "phi": phases}}, voltages in [GV], phases in [deg],
+                         arrays (or numbers) of the same length M - number of the settings. The missing cavities
+                         and parameters are taken from the elements
+        :return: rparticles - array (M, 6, N), E - array (M) final energies
+        """
+        settings = {} if settings is None else settings
+        cavities = set([step[1] for step in self.steps if step[0] == "cav"])
+        M = 1
+        for elem, par in settings.items():
+            if elem not in cavities:
+                raise ValueError("LongitudinalTracker: the settings of " + str(elem.id) +
+                                 " can not be applied, only Cavity elements with CavityTM are scanned")
+            for val in par.values():
+                M = max(M, np.size(val))
+
+        key = self.maps_key(p_array.E)
+        if key not in self.maps:
+            self.maps[key] = self.compile_maps(p_array.E)
+
+        X = np.zeros((M, 6, p_array.rparticles.shape[1]))
+        X[:, 4] = p_array.tau()
+        X[:, 5] = p_array.p()
+        live = np.array([False, False, False, False, True, True])
+        E = np.ones(M) * p_array.E
+        pa = ParticleArray()
+        pa.q_array = p_array.q_array
+        for op in self.maps[key]:
+            if op[0] == "map":
+                X, live = apply_map(X, op[1], op[2], live)
+            elif op[0] == "cav":
+                elem, dl = op[1:]
+                par = settings.get(elem, {})
+                v = np.ones(M) * par.get("v", elem.v)
+                phi = np.ones(M) * par.get("phi", elem.phi)
+                V = v * dl / elem.l if elem.l != 0 else v
+                E = cavity_map(X, E, V, elem.f, phi, dl)
+            else:
+                proc, dz, z0 = op[1:]
+                proc.z0 = z0
+                for m in range(M):
+                    pa.rparticles = X[m]
+                    pa.E = E[m]
+                    pa.invalidate_profile()
+                    proc.apply(pa, dz)
+                    X[m] = pa.rparticles
+                live = np.any(X != 0, axis=(0, 2))
+        for proc in set([step[1] for step in self.steps if step[0] == "proc"]):
+            if hasattr(proc, "finish"):
+                proc.finish()
+        self.rparticles = X
+        self.E = E
+        self.q_array = p_array.q_array
+        return X, E
+
+    def particle_array(self, m):
+        """
+        ParticleArray of the setting m after the last track()
+
+        :param m: index of the setting
+        :return: ParticleArray
+        """
+        p_array = ParticleArray()
+        p_array.rparticles = np.copy(self.rparticles[m])
+        p_array.q_array = np.copy(self.q_array)
+        p_array.E = self.E[m]
+        p_array.s = self.lat.totalLen
+        return p_array
+
+    def currents(self, n_points=200, filter_order=4):
+        """
+        current profiles of all settings after the last track()
+
+        :param n_points: number of sampling points
+        :param filter_order: filter order
+        :return: array (M, n_points + 2*floor(filter_order/2), 2), [:, :, 0] - grid in [m], [:, :, 1] - current in [A]
+        """
+        return np.array([LongitudinalProfile(X[4], self.q_array).current(n_points, filter_order, speed_of_light)
+                         for X in self.rparticles])
+
+    def chirps(self):
+        """
+        linear energy chirps dp/dtau of all settings after the last track() (charge weighted linear fit)
+
+        :return: array (M) in [1/m]
+        """
+        w = self.q_array / np.sum(self.q_array)
+        tau = self.rparticles[:, 4]
+        p = self.rparticles[:, 5]
+        dtau = tau - np.dot(tau, w)[:, np.newaxis]
+        dp = p - np.dot(p, w)[:, np.newaxis]
+        return np.dot(dtau * dp, w) / np.dot(dtau * dtau, w)
@@ -0,0 +1,146 @@
+"""
+Tracking of the beam moments (centroid and 6x6 sigma matrix) through the second order maps.
+
+The map of the element X1_i = R_ij X_j + T_ijk X_j X_k is written around the centroid mu, X = mu + d:
+    mu1 = R mu + T(mu, mu) + T_ijk S_jk
+    d1 = J d + T(d, d) - <T(d, d)>,  J_ij = R_ij + (T_ijk + T_ikj) mu_k
+    S1 = J S J^T + J <d T(d, d)^T> + <T(d, d) d^T> J^T + Cov(T(d, d))
+The third and the fourth central moments are needed for the last terms. If they are not given the beam is assumed to
+be gaussian on every element (M3 = 0, M4 from S), otherwise they are propagated with the linear part J of the maps.
+"""
+
+import numpy as np
+from ocelot.cpbd.beam import Twiss
+from ocelot.cpbd.optics import CavityTM
+from ocelot.cpbd.long_track import second_order_map
+from ocelot.common.globals import speed_of_light
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def element_map(elem, energy):
+    """
+    second order map of the element, for the cavity (CavityTM) the energy kick is expanded up to tau^2
+
+    :param elem: element
+    :param energy: initial energy in [GeV]
+    :return: R, T, energy gain in [GeV]
+    """
+    tm = elem.transfer_map
+    R, T = second_order_map(tm, energy)
+    if isinstance(tm, CavityTM) and energy + tm.delta_e > 0:
+        k = 2. * np.pi * tm.f / speed_of_light
+        phi = tm.phi * np.pi / 180.
+        # p += V/E1*(cos(phi - k*tau) - cos(phi) - k*tau*sin(phi)) ~ -V/E1*k^2/2*cos(phi)*tau^2, tau = (R X)_4
+        c = -tm.v / (energy + tm.delta_e) * k ** 2 / 2. * np.cos(phi)
+        T[5] += c * np.outer(R[4], R[4])
+    return R, T, tm.delta_e
+
+
+def gauss_moments(sigma):
+    """
+    third and fourth central moments of the gaussian distribution
+
+    :param sigma: array (6, 6)
+    :return: M3 - array (6, 6, 6), M4 - array (6, 6, 6, 6)
+    """
+    M3 = np.zeros((6, 6, 6))
+    M4 = (np.einsum("ij,kl->ijkl", sigma, sigma) + np.einsum("ik,jl->ijkl", sigma, sigma) +
+          np.einsum("il,jk->ijkl", sigma, sigma))
+    return M3, M4
+
+
+def parray_moments(p_array, high_order=True):
+    """
+    centroid and central moments of the beam
+
+    :param p_array: ParticleArray
+    :param high_order: if True the third and the fourth moments are calculated
+    :return: mean - array (6), sigma - array (6, 6), M3 - array (6, 6, 6) or None, M4 - array (6, 6, 6, 6) or None
+    """
+    X = p_array.rparticles
+    mean = np.mean(X, axis=1)
+    d = X - mean[:, np.newaxis]
+    n = X.shape[1]
+    sigma = np.dot(d, d.T) / n
+    if not high_order:
+        return mean, sigma, None, None
+    dd = np.einsum("in,jn->ijn", d, d).reshape(36, n)
+    M3 = np.dot(dd, d.T).reshape(6, 6, 6) / n
+    M4 = np.dot(dd, dd.T).reshape(6, 6, 6, 6) / n
+    return mean, sigma, M3, M4
+
+
+def moments_to_twiss(mean, sigma, energy):
+    """
+    Twiss object from the moments, the same parameters as get_envelope() (projected emittances)
+
+    :param mean: array (6)
+    :param sigma: array (6, 6)
+    :param energy: energy in [GeV]
+    :return: Twiss
+    """
+    tws = Twiss()
+    tws.x, tws.px, tws.y, tws.py, tws.tau, tws.p = mean
+    tws.xp, tws.yp = tws.px, tws.py
+    tws.xx, tws.xpx, tws.pxpx = sigma[0, 0], sigma[0, 1], sigma[1, 1]
+    tws.yy, tws.ypy, tws.pypy = sigma[2, 2], sigma[2, 3], sigma[3, 3]
+    tws.E = energy
+    tws.emit_x = np.sqrt(max(tws.xx * tws.pxpx - tws.xpx ** 2, 0.))
+    tws.emit_y = np.sqrt(max(tws.yy * tws.pypy - tws.ypy ** 2, 0.))
+    if tws.emit_x > 0:
+        tws.beta_x = tws.xx / tws.emit_x
+        tws.alpha_x = -tws.xpx / tws.emit_x
+        tws.gamma_x = tws.pxpx / tws.emit_x
+    if tws.emit_y > 0:
+        tws.beta_y = tws.yy / tws.emit_y
+        tws.alpha_y = -tws.ypy / tws.emit_y
+        tws.gamma_y = tws.pypy / tws.emit_y
+    if sigma[5, 5] > 0:
+        tws.Dx, tws.Dxp, tws.Dy, tws.Dyp = sigma[:4, 5] / sigma[5, 5]
+    return tws
+
+
+def track_moments(lattice, mean, sigma, energy, M3=None, M4=None):
+    """
+    tracking of the centroid and the sigma matrix through the lattice, element by element
+
+    :param lattice: MagneticLattice
+    :param mean: array (6) - initial centroid
+    :param sigma: array (6, 6) - initial central second moments
+    :param energy: initial energy in [GeV]
+    :param M3: array (6, 6, 6) - initial central third moments. If M3 and M4 are None the gaussian closure is used
+    :param M4: array (6, 6, 6, 6) - initial central fourth moments
+    :return: list of Twiss at the beginning and after each element, array (len(lattice.sequence) + 1, 6, 6) of sigmas
+    """
+    mean = np.array(mean, dtype=float)
+    sigma = np.array(sigma, dtype=float)
+    gauss = M3 is None or M4 is None
+    tws = moments_to_twiss(mean, sigma, energy)
+    tws_list = [tws]
+    sigmas = [sigma]
+    s = 0.
+    for elem in lattice.sequence:
+        R, T, de = element_map(elem, energy)
+        if gauss:
+            M3, M4 = gauss_moments(sigma)
+        J = R + np.einsum("ijk,k->ij", T, mean) + np.einsum("ikj,k->ij", T, mean)
+        Q = np.einsum("ijk,jk->i", T, sigma)
+        # <d T(d, d)^T>, Cov(T(d, d))
+        dQ = np.einsum("bkl,akl->ab", T, M3)
+        QQ = np.einsum("ajk,blm,jklm->ab", T, T, M4, optimize=True) - np.outer(Q, Q)
+        JdQ = np.dot(J, dQ)
+        mean = np.dot(R, mean) + np.einsum("ijk,j,k->i", T, mean, mean) + Q
+        sigma = np.dot(np.dot(J, sigma), J.T) + JdQ + JdQ.T + QQ
+        if not gauss:
+            M3 = np.einsum("ia,jb,kc,abc->ijk", J, J, J, M3, optimize=True)
+            M4 = np.einsum("ia,jb,kc,ld,abcd->ijkl", J, J, J, J, M4, optimize=True)
+        energy += de
+        s += elem.l
+        tws = moments_to_twiss(mean, sigma, energy)
+        tws.s = s
+        tws.id = elem.id
+        tws_list.append(tws)
+        sigmas.append(sigma)
+    return tws_list, np.array(sigmas)
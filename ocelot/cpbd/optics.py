@@ -268,6 +268,7 @@ class TransferMap:
             self.map(prcl_series.rparticles, energy=prcl_series.E)
             prcl_series.E += self.delta_e
             prcl_series.s += self.length
+            prcl_series.invalidate_profile()
 
         elif prcl_series.__class__ == Particle:
             p = prcl_series
@@ -1086,6 +1087,12 @@ class Navigator:
     lattice - MagneticLattice
     Attributes:
         unit_step = 1 [m] - unit step for all physics processes
+        adaptive = False - adaptive stepping. The steps of the physics processes with the bounds
+                    physics_proc.step_min and physics_proc.step_max are changed during tracking according to the
+                    relative changes of the beam (rms sizes, peak current and energy) per unit_step,
+                    see Navigator.update_steps()
+        adaptive_tol = 0.01 - allowed relative change of the beam quantities during one step of a physics process
+        steps = [] - steps done in the adaptive mode [(s, dz, [physics processes])]
     Methods:
         add_physics_proc(physics_proc, elem1, elem2)
             physics_proc - physics process, can be CSR, SpaceCharge or Wake,
@@ -1103,6 +1110,10 @@ class Navigator:
         self.unit_step = 1  # unit step for physics processes
         self.proc_kick_elems = []
         self.kill_process = False # for case when calculations are needed to terminated e.g. from gui
+        self.adaptive = False  # adaptive stepping of the physics processes
+        self.adaptive_tol = 0.01  # allowed relative change of the beam quantities during one process step
+        self.steps = []  # steps done in the adaptive mode [(s, dz, [physics processes])]
+        self.beam_state = None  # beam quantities after the last step, see beam_quantities()
 
     def add_physics_proc(self, physics_proc, elem1, elem2):
         self.process_table.add_physics_proc(physics_proc, elem1, elem2)
@@ -1139,6 +1150,51 @@ class Navigator:
         return dz, processes
 
 
+    def beam_quantities(self, p_array):
+        """
+        beam quantities which are controlled in the adaptive stepping
+
+        :param p_array: ParticleArray
+        :return: array [sigma_x, sigma_y, sigma_tau, peak current, energy]
+        """
+        I = p_array.longitudinal_profile().current(n_points=100, filter_order=4, mean_vel=speed_of_light)
+        p_array = p_array.without_lost()
+        energy = p_array.E*(1. + np.mean(p_array.rparticles[5]))
+        return np.array([np.std(p_array.x()), np.std(p_array.y()), np.std(p_array.tau()),
+                         np.max(np.abs(I[:, 1])), energy])
+
+    def update_steps(self, p_array, dz, processes):
+        """
+        Adaptive stepping. The method is called after each step of tracking.
+        The relative change of the beam quantities (see beam_quantities()) per unit_step is estimated from the
+        last step and the steps of the physics processes with the bounds step_min/step_max are set to keep
+        the change during one process step below adaptive_tol. The step can not grow more than twice per update.
+
+        :param p_array: ParticleArray
+        :param dz: last step in [m]
+        :param processes: physics processes which were applied during the last step
+        :return: None
+        """
+        state = self.beam_quantities(p_array)
+        if self.beam_state is not None and dz > 0:
+            change = np.abs(state - self.beam_state)/np.maximum(np.abs(self.beam_state), 1e-30)
+            rate = np.max(change)/dz*self.unit_step
+            for p in self.get_proc_list():
+                if p.step_min is None or p.step_max is None:
+                    continue
+                step = int(self.adaptive_tol/rate) if rate*p.step_max > self.adaptive_tol else p.step_max
+                step = max(p.step_min, min(step, 2*p.step, p.step_max))
+                if step != p.step:
+                    logger.debug(" Navigator.update_steps: " + p.__class__.__name__ + " step: " + str(p.step) +
+                                 " -> " + str(step) + " at s = " + str(self.z0))
+                    if p in processes:
+                        p.counter = step
+                    else:
+                        p.counter = min(p.counter, step)
+                    p.step = step
+        self.beam_state = state
+        self.steps.append((self.z0, dz, processes))
+
     def get_proc_list(self):
         proc_list = []
         for p in self.process_table.proc_list:
@@ -1202,9 +1258,17 @@ class Navigator:
         return dz, processes
 
 
-def get_map(lattice, dz, navi):
+def get_elem_slices(lattice, dz, navi):
+    """
+    elements (and the lengths of their slices) which are passed during the step dz, moves the navigator
+
+    :param lattice: Magnetic Lattice
+    :param dz: step in [m]
+    :param navi: Navigator
+    :return: list of (element, length of the slice)
+    """
     nelems = len(lattice.sequence)
-    TM = []
+    slices = []
     i = navi.n_elem
     z1 = navi.z0 + dz
     elem = lattice.sequence[i]
@@ -1214,7 +1278,7 @@ def get_map(lattice, dz, navi):
         if i >= nelems - 1:
             break
         dl = L - navi.z0
-        TM.append(elem.transfer_map(dl))
+        slices.append((elem, dl))
         navi.z0 = L
         dz -= dl
         i += 1
@@ -1223,11 +1287,15 @@ def get_map(lattice, dz, navi):
         #if i in navi.proc_kick_elems:
         #    break
     if abs(dz) > 1e-10:
-        TM.append(elem.transfer_map(dz))
+        slices.append((elem, dz))
     navi.z0 += dz
     navi.sum_lengths = L - elem.l
     navi.n_elem = i
-    return TM
+    return slices
+
+
+def get_map(lattice, dz, navi):
+    return [elem.transfer_map(dl) for elem, dl in get_elem_slices(lattice, dz, navi)]
 
 
 def merge_maps(t_maps):
@@ -1,4 +1,5 @@
 from ocelot.cpbd.beam import save_particle_array, load_particle_array
+from ocelot.cpbd.async_io import save_particle_array_async
 import numpy as np
 np.sin
 
@@ -7,16 +8,25 @@ class PhysProc:
     Parent class for all Physics processes
 
     :method prepare(self, lat): - the method is called at the moment of Physics Process addition to Navigator class.
-    :method apply(self, p_array, dz): - the method is called on every step.
+    :method apply(self, p_array, dz): - the method is called on every step. If the process changes x, y, tau or
+                                        the charges in place, it has to call p_array.invalidate_profile()
+    :method finish(self): - the method is called at the end of the tracking, e.g. the pools of the workers are closed
     :attribute step: - number of steps in [Navigator.unit_step] self.step*Navigator.unit_step = [m]
     :attribute indx0: - number of start element in lattice.sequence
     :attribute indx1: - number of stop element in lattice.sequence
+    :attribute step_min, step_max: - bounds of the step for the adaptive stepping (Navigator.adaptive = True),
+                                     if None the step is fixed
+    :attribute distributed: - True if the process can be applied to the part of the beam in the distributed
+                              tracking (see ocelot.cpbd.distributed), otherwise the beam is gathered for the process
     """
     def __init__(self, step=1):
         self.step = step
         self.energy = None
         self.indx0 = None
         self.indx1 = None
+        self.step_min = None
+        self.step_max = None
+        self.distributed = False
 
     def prepare(self, lat):
         """
@@ -37,6 +47,15 @@ class PhysProc:
         """
         pass
 
+    def finish(self):
+        """
+        the method is called at the end of the tracking (also if the tracking is killed), the resources of the process
+        are released. The process can be applied again after it.
+
+        :return:
+        """
+        pass
+
 
 class EmptyProc(PhysProc):
     def __init__(self, step=1):
@@ -47,13 +66,25 @@ class EmptyProc(PhysProc):
 
 
 class SaveBeam(PhysProc):
-    def __init__(self, filename):
+    """
+    Physics Process for saving of the beam
+
+    :attribute filename: file name
+    :attribute async_io: if False (default) the file is written by apply(). If True the beam is copied and is
+                         written by the background thread, track() waits for the writing at the end, outside of
+                         track() the caller has to call ocelot.cpbd.async_io.flush_writes() before reading the file
+    """
+    def __init__(self, filename, async_io=False):
         PhysProc.__init__(self)
         self.energy = None
         self.filename = filename
+        self.async_io = async_io
 
     def apply(self, p_array, dz):
-        save_particle_array(filename=self.filename, p_array=p_array)
+        if self.async_io:
+            save_particle_array_async(filename=self.filename, p_array=p_array)
+        else:
+            save_particle_array(filename=self.filename, p_array=p_array)
 
 
 class SmoothBeam(PhysProc):
@@ -115,4 +146,5 @@ class SmoothBeam(PhysProc):
             Zout2[i] = (S[i + m + 1] - S[i - m]) / (2 * m + 1)
         Zout[inds] = Zout2
         p_array.tau()[:] = Zout[:]
+        p_array.invalidate_profile()
         #return Zout
\ No newline at end of file
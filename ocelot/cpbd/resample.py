@@ -0,0 +1,233 @@
+"""
+Resampling of the macroparticles: merge (downsampling) and split (upsampling) of ParticleArray.
+
+Merge: the particles are ordered along the space filling curve (Z-order) in the normalized 6D phase space,
+the neighbours on the curve are merged to one macroparticle with the total charge at the charge weighted centroid.
+Split: every particle is replaced by children with the equal charges around the parent. With quiet=True the
+offsets of the children are antithetic (+d, -d), the centroid of every parent is kept exactly.
+Optionally the charge weighted mean and the covariance matrix of the result are corrected to the initial ones
+by the linear transformation.
+"""
+
+import numpy as np
+from ocelot.cpbd.beam import ParticleArray, get_generator
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def weighted_moments(X, q):
+    """
+    charge weighted mean and covariance matrix
+
+    :param X: array (6, n)
+    :param q: array (n) charges
+    :return: mean - array (6), cov - array (6, 6)
+    """
+    w = q / np.sum(q)
+    mean = np.dot(X, w)
+    d = X - mean[:, np.newaxis]
+    return mean, np.dot(d * w, d.T)
+
+
+def sqrtm_sym(C, inverse=False):
+    # square root of the symmetric positive semi-definite matrix, the pseudo inverse of it if inverse
+    w, v = np.linalg.eigh(C)
+    w = np.maximum(w, 0.)
+    if inverse:
+        tol = np.max(w) * 1e-12
+        w = np.array([1. / np.sqrt(a) if a > tol else 0. for a in w])
+    else:
+        w = np.sqrt(w)
+    return np.dot(v * w, v.T)
+
+
+def correct_moments(X, q, mean, cov):
+    """
+    linear transformation of the particles (in place) to the given charge weighted mean and covariance matrix
+
+    :param X: array (6, n)
+    :param q: array (n) charges
+    :param mean: array (6) - target mean
+    :param cov: array (6, 6) - target covariance matrix
+    :return: X
+    """
+    m1, C1 = weighted_moments(X, q)
+    # the correlation matrices are transformed, the coordinates have very different scales
+    s = np.sqrt(np.diag(cov))
+    s[s == 0] = 1.
+    D = np.diag(1. / s)
+    A = np.dot(sqrtm_sym(D.dot(cov).dot(D)), sqrtm_sym(D.dot(C1).dot(D), inverse=True))
+    T = np.diag(s).dot(A).dot(D)
+    X[:] = np.dot(T, X - m1[:, np.newaxis]) + mean[:, np.newaxis]
+    return X
+
+
+def zorder_keys(X, bits=10):
+    """
+    keys of the particles along the Z-order curve in the normalized phase space
+
+    :param X: array (6, n)
+    :param bits: bits per coordinate
+    :return: array (n) of uint64
+    """
+    n_dim = X.shape[0]
+    mean = np.mean(X, axis=1)
+    std = np.std(X, axis=1)
+    std[std == 0] = 1.
+    u = (X - mean[:, np.newaxis]) / std[:, np.newaxis]
+    u = np.clip((u + 5.) / 10., 0., 1. - 1e-12)
+    ic = (u * (1 << bits)).astype(np.uint64)
+    keys = np.zeros(X.shape[1], dtype=np.uint64)
+    for b in range(bits):
+        for d in range(n_dim):
+            keys |= ((ic[d] >> np.uint64(b)) & np.uint64(1)) << np.uint64(b * n_dim + d)
+    return keys
+
+
+def merge_particles(p_array, n, method="merge", preserve_moments=True, rng=None):
+    """
+    downsampling of ParticleArray to n macroparticles, the total charge is kept
+
+    :param p_array: ParticleArray
+    :param n: number of macroparticles
+    :param method: "merge" - neighbours on the Z-order curve are merged to one particle with the total charge at
+                   the charge weighted centroid, "random" - random subset, the charges are scaled
+    :param preserve_moments: if True the charge weighted mean and covariance matrix are corrected to the initial ones
+    :param rng: numpy Generator or seed (used by method="random")
+    :return: ParticleArray
+    """
+    X = p_array.rparticles
+    q = p_array.q_array
+    N = X.shape[1]
+    if n >= N:
+        raise ValueError("merge_particles: n must be less than the number of particles " + str(N))
+    p_new = ParticleArray()
+    if method == "merge":
+        order = np.argsort(zorder_keys(X), kind="stable")
+        group = np.empty(N, dtype=int)
+        group[order] = (np.arange(N) * n) // N
+        Q = np.bincount(group, weights=q, minlength=n)
+        p_new.rparticles = np.array([np.bincount(group, weights=q * X[i], minlength=n) for i in range(6)]) / Q
+        p_new.q_array = Q
+    elif method == "random":
+        ind = np.sort(get_generator(rng).choice(N, size=n, replace=False))
+        p_new.rparticles = X[:, ind]
+        p_new.q_array = q[ind] * (np.sum(q) / np.sum(q[ind]))
+    else:
+        raise ValueError("merge_particles: unknown method " + str(method))
+    p_new.E = p_array.E
+    p_new.s = p_array.s
+    if preserve_moments:
+        mean, cov = weighted_moments(X, q)
+        correct_moments(p_new.rparticles, p_new.q_array, mean, cov)
+    return p_new
+
+
+def split_particles(p_array, factor, noise=0.05, quiet=True, preserve_moments=True, rng=None):
+    """
+    upsampling of ParticleArray, every particle is replaced by factor children with the charge q/factor.
+    The offsets of the children are Gaussian with the covariance noise^2 * (covariance of the beam),
+    the deviations of the parents from the beam centroid are scaled by sqrt(1 - noise^2) to keep the covariance.
+
+    :param p_array: ParticleArray
+    :param factor: number of children of the particle, factor = 1 - the copy of the beam
+    :param noise: rms offset of the children in units of the beam rms sizes
+    :param quiet: if True the offsets are antithetic pairs (+d, -d) (and zero for the odd child), the centroid of the
+                  children is the parent
+    :param preserve_moments: if True the charge weighted mean and covariance matrix are corrected to the initial ones
+    :param rng: numpy Generator or seed
+    :return: ParticleArray
+    """
+    if factor < 1:
+        raise ValueError("split_particles: factor must be a positive integer, got " + str(factor))
+    if factor == 1:
+        p_new = ParticleArray()
+        p_new.rparticles = np.copy(p_array.rparticles)
+        p_new.q_array = np.copy(p_array.q_array)
+        p_new.E = p_array.E
+        p_new.s = p_array.s
+        return p_new
+    rng = get_generator(rng)
+    X = p_array.rparticles
+    q = p_array.q_array
+    N = X.shape[1]
+    mean, cov = weighted_moments(X, q)
+    L = sqrtm_sym(cov)
+    parents = mean[:, np.newaxis] + np.sqrt(1. - noise ** 2) * (X - mean[:, np.newaxis])
+
+    if quiet:
+        d = rng.standard_normal((factor // 2, 6, N))
+        offsets = np.concatenate((d, -d) + ((np.zeros((1, 6, N)),) if factor % 2 else ()))
+        # the odd child sits on the parent, the rms of the offsets is restored
+        if factor % 2:
+            offsets *= np.sqrt(factor / (factor - 1.))
+    else:
+        offsets = rng.standard_normal((factor, 6, N))
+    offsets = noise * np.einsum("ij,kjn->kin", L, offsets)
+
+    p_new = ParticleArray()
+    p_new.rparticles = (parents[np.newaxis] + offsets).transpose(1, 2, 0).reshape(6, N * factor)
+    p_new.q_array = np.repeat(q / factor, factor)
+    p_new.E = p_array.E
+    p_new.s = p_array.s
+    if preserve_moments:
+        correct_moments(p_new.rparticles, p_new.q_array, mean, cov)
+    return p_new
+
+
+def resample_particle_array(p_array, n, rng=None, **kwargs):
+    """
+    resampling of ParticleArray to about n macroparticles: merge_particles() if n is less than the number of
+    particles, otherwise split_particles() with factor = round(n / number of particles)
+
+    :param p_array: ParticleArray
+    :param n: number of macroparticles
+    :param rng: numpy Generator or seed
+    :param kwargs: arguments of merge_particles() or split_particles()
+    :return: ParticleArray
+    """
+    N = p_array.rparticles.shape[1]
+    if n < N:
+        return merge_particles(p_array, n, rng=rng, **kwargs)
+    factor = max(int(round(float(n) / N)), 1)
+    return split_particles(p_array, factor, rng=rng, **kwargs)
+
+
+def moments_report(p_array0, p_array1):
+    """
+    comparison of the charge weighted moments of two beams, e.g. before and after resampling
+
+    :param p_array0: ParticleArray - reference
+    :param p_array1: ParticleArray
+    :return: dict: "n" - numbers of particles, "charge" - relative error of the total charge,
+             "mean" - shift of the centroid in units of rms sizes (6), "sigma" - relative errors of the rms sizes (6),
+             "corr" - max error of the correlation coefficients, "emit_x", "emit_y", "emit_z" - relative errors of
+             the projected emittances (x-px, y-py, tau-p), "kurtosis" - relative errors of the 4th moments (6)
+    """
+    X0, q0 = p_array0.rparticles, p_array0.q_array
+    X1, q1 = p_array1.rparticles, p_array1.q_array
+    m0, C0 = weighted_moments(X0, q0)
+    m1, C1 = weighted_moments(X1, q1)
+    s0 = np.sqrt(np.diag(C0))
+    s1 = np.sqrt(np.diag(C1))
+    s0[s0 == 0] = 1.
+    s1[s1 == 0] = 1.
+
+    def emit(C, i):
+        return np.sqrt(max(C[i, i] * C[i + 1, i + 1] - C[i, i + 1] ** 2, 0.))
+
+    def kurtosis(X, q, m, s):
+        w = q / np.sum(q)
+        return np.dot(((X - m[:, np.newaxis]) / s[:, np.newaxis]) ** 4, w)
+
+    report = {"n": (X0.shape[1], X1.shape[1]),
+              "charge": np.sum(q1) / np.sum(q0) - 1.,
+              "mean": (m1 - m0) / s0,
+              "sigma": s1 / s0 - 1.,
+              "corr": np.max(np.abs(C1 / np.outer(s1, s1) - C0 / np.outer(s0, s0))),
+              "kurtosis": kurtosis(X1, q1, m1, s1) / kurtosis(X0, q0, m0, s0) - 1.}
+    for key, i in (("emit_x", 0), ("emit_y", 2), ("emit_z", 4)):
+        e0 = emit(C0, i)
+        report[key] = emit(C1, i) / e0 - 1. if e0 > 0 else 0.
+    return report
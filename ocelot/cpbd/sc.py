@@ -88,6 +88,9 @@ class SpaceCharge(PhysProc):
         self.debug = False
         self.random_mesh = True  # random mesh if True
         self.random_seed = 10    # random seeding number. if None seeding is random
+        self.distributed = True  # supports the distributed tracking, see ocelot.cpbd.distributed
+        self.buffer = None       # work arrays for the coordinate transforms, see get_buffer()
+        self.xyz = None
 
     def prepare(self, lat):
         if self.random_seed != None:
@@ -151,19 +154,39 @@ class SpaceCharge(PhysProc):
         out[:Nx, :Ny, :Nz] = out[:Nx,:Ny,:Nz]/(4*pi*epsilon_0*hx*hy*hz)
         return out[:Nx, :Ny, :Nz]
 
-    def el_field(self, X, Q, gamma, nxyz):
+    def el_field(self, X, Q, gamma, nxyz, comm=None):
+        """
+        :param X: positions of the particles in the velocity direction frame, array (N, 3)
+        :param Q: charges of the particles
+        :param gamma: gamma of the bunch
+        :param nxyz: mesh size
+        :param comm: communicator if the particles are distributed between processes (see ocelot.cpbd.distributed).
+                     The charge grid is reduced and the potential is calculated by the root process.
+        :return: electric field at the particles positions, array (N, 3)
+        """
         N = X.shape[0]
         X[:, 2] = X[:, 2]*gamma
-        XX = np.max(X, axis=0)-np.min(X, axis=0)
+        X_max = np.max(X, axis=0)
+        X_min = np.min(X, axis=0)
+        if comm is not None:
+            bounds = np.array(comm.allgather((X_max, X_min)))
+            X_max = np.max(bounds[:, 0], axis=0)
+            X_min = np.min(bounds[:, 1], axis=0)
+        XX = X_max - X_min
         if self.random_mesh:
-            XX = XX*np.random.uniform(low=1, high=1.1)
+            rand = np.random.uniform(low=1, high=1.1) if comm is None or comm.Get_rank() == 0 else None
+            XX = XX*(rand if comm is None else comm.bcast(rand))
         logger.debug( 'mesh steps:' + str(XX))
         # here we use a fast 3D "near-point" interpolation
         # we need a stand-alone module with 1D,2D,3D parricles-to-grid functions
         steps = XX/(nxyz-3)
         X = X/steps
-        X_min = np.min(X, axis=0)
-        X_mid = np.dot(Q, X)/np.sum(Q)
+        X_min = X_min/steps
+        if comm is None:
+            X_mid = np.dot(Q, X)/np.sum(Q)
+        else:
+            QX = comm.allreduce(np.append(np.dot(Q, X), np.sum(Q)))
+            X_mid = QX[:3]/QX[3]
         X_off = np.floor(X_min-X_mid) + X_mid
         X = X - X_off
         nx = nxyz[0]
@@ -173,7 +196,12 @@ class SpaceCharge(PhysProc):
         Xi = np.int_(np.floor(X)+1)
         inds = np.int_(Xi[:, 0]*nzny+Xi[:, 1]*nz+Xi[:, 2])  # 3d -> 1d
         q = np.bincount(inds, Q, nzny*nx).reshape(nxyz)
-        p = self.potential(q, steps)
+        if comm is None:
+            p = self.potential(q, steps)
+        else:
+            q = comm.reduce(q, root=0)
+            p = self.potential(q, steps) if comm.Get_rank() == 0 else None
+            p = comm.bcast(p, root=0)
         Ex = np.zeros(p.shape)
         Ey = np.zeros(p.shape)
         Ez = np.zeros(p.shape)
@@ -187,6 +215,95 @@ class SpaceCharge(PhysProc):
         return Exyz
 
 
+    def get_buffer(self, n):
+        """
+        work arrays of the process, they are reused between the kicks while the number of particles is the same
+
+        :param n: number of particles
+        :return: xp, xyz, tmp - array (6, n) of the positions [m] and momenta [eV/c],
+                 array (n, 3) of the positions in the velocity direction frame and work array (3, n)
+        """
+        if self.buffer is None or self.buffer.shape[1] != n:
+            self.buffer = np.zeros((9, n))
+            self.xyz = np.zeros((n, 3))
+        return self.buffer[0:6], self.xyz, self.buffer[6:9]
+
+    def to_bunch_frame(self, p_array, gamref):
+        """
+        transformation of the MAD coordinates to the positions and momenta and rotation to the velocity
+        direction of the bunch. The work arrays of the process are used, see get_buffer()
+
+        :param p_array: ParticleArray
+        :param gamref: reference gamma
+        :return: xp, xyz, T, Pav - xp[0:3] positions in the lab frame, xp[3:6] momenta in the velocity
+                 direction frame, xyz - positions in the velocity direction frame, T - rotation matrix,
+                 Pav - mean momentum
+        """
+        xp, xyz, tmp = self.get_buffer(p_array.rparticles.shape[1])
+        xxstg_2_xp_mad_inplace(p_array.rparticles, xp, gamref, tmp)
+
+        # coordinate transformation to the velocity direction
+        t3 = np.mean(xp[3:6], axis=1)
+        if p_array.comm is not None:
+            t3 = p_array.comm.allreduce(np.append(np.sum(xp[3:6], axis=1), xp.shape[1]))
+            t3 = t3[:3]/t3[3]
+        Pav = np.linalg.norm(t3)
+        t3 = t3 / Pav
+        ey = np.array([0, 1, 0])
+        t1 = np.cross(ey, t3)
+        t1 = t1 / np.linalg.norm(t1)
+        t2 = np.cross(t3, t1)
+        T = np.c_[t1, t2, t3]
+        np.dot(xp[0:3].T, T, out=xyz)
+        np.dot(T.T, xp[3:6], out=tmp)
+        xp[3:6] = tmp
+        return xp, xyz, T, Pav
+
+    def to_lab_frame(self, p_array, xp, T, gamref):
+        """
+        inverse of to_bunch_frame(): rotation of the momenta back to the lab frame and transformation to the
+        MAD coordinates of p_array
+
+        :param p_array: ParticleArray
+        :param xp: see to_bunch_frame()
+        :param T: rotation matrix
+        :param gamref: reference gamma
+        :return: None
+        """
+        tmp = self.buffer[6:9]
+        np.dot(T, xp[3:6], out=tmp)
+        xp[3:6] = tmp
+        xp_2_xxstg_mad_inplace(xp, p_array.rparticles, gamref, tmp)
+
+    def kick(self, p_array, xp, Exyz, gamma0, cdT):
+        """
+        equations of motion in the lab system, the momenta xp[3:6] in the velocity direction frame are changed
+
+        :param p_array: ParticleArray
+        :param xp: see to_bunch_frame()
+        :param Exyz: electric field in the rest frame of bunch
+        :param gamma0: gamma of the bunch
+        :param cdT: c*dt
+        :return: None
+        """
+        beta0 = np.sqrt(1 - gamma0 ** -2)
+        gamref = p_array.E / m_e_GeV
+        betref = np.sqrt(1 - gamref ** -2)
+        # cdT*(1 - beta0 * betaz), betaz = pz/Energy, Energy = m_e_eV * gamref * (1 + p * betref)
+        k = self.buffer[6]
+        np.multiply(p_array.rparticles[5], betref, out=k)
+        k += 1
+        k *= m_e_eV * gamref
+        np.divide(xp[5], k, out=k)
+        k *= -beta0 * cdT
+        k += cdT
+        dp = self.buffer[7]
+        xp[3] += np.multiply(k, Exyz[:, 0], out=dp)
+        xp[4] += np.multiply(k, Exyz[:, 1], out=dp)
+        #xp[5] = xp[5] + cdT * (Exyz[:, 2] + beta0 * (betax * Exyz[:, 0] + betay * Exyz[:, 1]))
+        k *= gamma0 * gamma0
+        xp[5] += np.multiply(k, Exyz[:, 2], out=dp)
+
     def apply(self, p_array, zstep):
         if zstep == 0:
             logger.debug("SpaceCharge delta_s = 0")
@@ -198,43 +315,19 @@ class SpaceCharge(PhysProc):
 
         # MAD coordinates!!!
         # Lorentz transformation with V-axis and gamma_av
-        xp = np.zeros(p_array.rparticles.shape)
-        xp = xxstg_2_xp_mad(p_array.rparticles, xp, gamref)
-
-        # coordinate transformation to the velocity direction
-        t3 = np.mean(xp[3:6], axis=1)
-        Pav = np.linalg.norm(t3)
-        t3 = t3 / Pav
-        ey = np.array([0, 1, 0])
-        t1 = np.cross(ey, t3)
-        t1 = t1 / np.linalg.norm(t1)
-        t2 = np.cross(t3, t1)
-        T = np.c_[t1, t2, t3]
-        xyz = np.dot(xp[0:3].T, T)
-        xp[3:6] = np.dot(xp[3:6].T, T).T
+        xp, xyz, T, Pav = self.to_bunch_frame(p_array, gamref)
 
         # electric field in the rest frame of bunch
         gamma0 = sqrt((Pav / m_e_eV) ** 2 + 1)
-        beta02 = 1 - gamma0 ** -2
-        beta0 = np.sqrt(beta02)
 
-        Exyz = self.el_field(xyz, p_array.q_array, gamma0, nmesh_xyz)
+        Exyz = self.el_field(xyz, p_array.q_array, gamma0, nmesh_xyz, comm=p_array.comm)
 
         # equations of motion in the lab system
-        gamma = gamref * (1 + p_array.rparticles[5] * betref)
-        Energy = m_e_eV * gamma
-        betax = xp[3] / Energy
-        betay = xp[4] / Energy
-        betaz = xp[5] / Energy
         cdT = zstep / betref
-
-        xp[3] = xp[3] + cdT * (1 - beta0 * betaz) * Exyz[:, 0]
-        xp[4] = xp[4] + cdT * (1 - beta0 * betaz) * Exyz[:, 1]
-        #xp[5] = xp[5] + cdT * (Exyz[:, 2] + beta0 * (betax * Exyz[:, 0] + betay * Exyz[:, 1]))
-        xp[5] = xp[5] + cdT * (1 - beta0 * betaz)*Exyz[:, 2]*gamma0*gamma0
-        T = np.transpose(T)
-        xp[3:6] = np.dot(xp[3:6].T, T).T
-        xp_2_xxstg_mad(xp, p_array.rparticles, gamref)
+        self.kick(p_array, xp, Exyz, gamma0, cdT)
+        self.to_lab_frame(p_array, xp, T, gamref)
+        # x, y and tau are changed in place
+        p_array.invalidate_profile()
 
     def SC_xp_update(self, xp, Q, gamref, dS, nxyz):
         #Lorentz transformation with z-axis and gamref
@@ -256,55 +349,12 @@ class SpaceChargeSimplify(SpaceCharge):
     def __init__(self, step=1):
         SpaceCharge.__init__(self, step=step)
 
-    def apply(self, p_array, zstep):
-        if zstep == 0:
-            logger.debug("SpaceCharge delta_s = 0")
-            return
-        nmesh_xyz = np.array(self.nmesh_xyz)
-        gamref = p_array.E / m_e_GeV
-        betref2 = 1 - gamref ** -2
-        betref = np.sqrt(betref2)
-
-        # MAD coordinates!!!
-        # Lorentz transformation with V-axis and gamma_av
-        xp = np.zeros(p_array.rparticles.shape)
-        xp = xxstg_2_xp_mad(p_array.rparticles, xp, gamref)
-
-        # coordinate transformation to the velocity direction
-        t3 = np.mean(xp[3:6], axis=1)
-        Pav = np.linalg.norm(t3)
-        t3 = t3 / Pav
-        ey = np.array([0, 1, 0])
-        t1 = np.cross(ey, t3)
-        t1 = t1 / np.linalg.norm(t1)
-        t2 = np.cross(t3, t1)
-        T = np.c_[t1, t2, t3]
-        xyz = np.dot(xp[0:3].T, T)
-        xp[3:6] = np.dot(xp[3:6].T, T).T
-
-        # electric field in the rest frame of bunch
-        gamma0 = sqrt((Pav / m_e_eV) ** 2 + 1)
+    def kick(self, p_array, xp, Exyz, gamma0, cdT):
+        # testing SC: betaz = beta0
         beta02 = 1 - gamma0 ** -2
-        beta0 = np.sqrt(beta02)
-
-        Exyz = self.el_field(xyz, p_array.q_array, gamma0, nmesh_xyz)
-
-        # equations of motion in the lab system
-        gamma = gamref * (1 + p_array.rparticles[5] * betref)
-        Energy = m_e_eV * gamma
-        betax = xp[3] / Energy
-        betay = xp[4] / Energy
-        betaz = xp[5] / Energy
-        cdT = zstep / betref
-        # testing SC
-        betaz = beta0 # for testing!
-        k = 0. # for testing !
-        xp[3] = xp[3] + cdT * (1 - beta02) * Exyz[:, 0]
-        xp[4] = xp[4] + cdT * (1 - beta02) * Exyz[:, 1]
-        xp[5] = xp[5] + cdT * (Exyz[:, 2])
-        T = np.transpose(T)
-        xp[3:6] = np.dot(xp[3:6].T, T).T
-        xp_2_xxstg_mad(xp, p_array.rparticles, gamref)
+        xp[3] += cdT * (1 - beta02) * Exyz[:, 0]
+        xp[4] += cdT * (1 - beta02) * Exyz[:, 1]
+        xp[5] += cdT * Exyz[:, 2]
 
 
 """
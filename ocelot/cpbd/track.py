@@ -6,6 +6,7 @@ from ocelot.cpbd.beam import *
 from numpy import delete, array, linspace, sqrt
 from ocelot.cpbd.errors import *
 from ocelot.cpbd.elements import *
+from ocelot.cpbd.async_io import flush_writes
 from time import time
 from scipy.stats import truncnorm
 from copy import copy, deepcopy
@@ -14,6 +15,8 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+PROGRESS_INTERVAL = 0.2     # minimal time between the progress prints of track() [s]
+
 try:
     from scipy.signal import argrelextrema
     extrema_chk = 1
@@ -274,15 +277,21 @@ def track_nturns(lat, nturns, track_list, nsuperperiods=1, save_track=True, prin
     for i in range(nturns):
         if print_progress: print(i)
         for n in range(nsuperperiods):
-            for tm in t_maps:
-                tm.apply(p_array)
-            p_indx = p_array.rm_tails(xlim, ylim, px_lim, py_lim)
-
-            track_list = delete(track_list, p_indx)
-        for n, pxy in enumerate(track_list):
+            # the lost particles are transported until the compaction, their coordinates can overflow
+            with np.errstate(over="ignore", invalid="ignore"):
+                for tm in t_maps:
+                    tm.apply(p_array)
+            p_array.rm_tails(xlim, ylim, px_lim, py_lim, turn=i)
+
+        alive = p_array.alive_indices()
+        ids = alive if p_array.ids is None else p_array.ids[alive]
+        if save_track:
+            coords = p_array.rparticles[:, alive].T
+        for n, k in enumerate(ids):
+            pxy = track_list_const[k]
             pxy.turn = i
             if save_track:
-                pxy.p_list.append(p_array.rparticles[:, n])
+                pxy.p_list.append(coords[n])
     return np.array(track_list_const)
 
 '''
@@ -432,40 +441,267 @@ def tracking_step(lat, particle_list, dz, navi):
     return
 
 
-def track(lattice, p_array, navi, print_progress=True, calc_tws=True):
+def finish_processes(navi):
+    """
+    PhysProc.finish() of all physics processes of the Navigator, is called at the end of the tracking.
+    The processes which are not derived from PhysProc (e.g. BeamTransform) can have no finish()
+
+    :param navi: Navigator
+    :return: None
+    """
+    for p in navi.process_table.proc_list:
+        if hasattr(p, "finish"):
+            p.finish()
+
+
+def track(lattice, p_array, navi, print_progress=True, calc_tws=True, checkpoint=None, sampler=None):
     """
     tracking through the lattice
     :param lattice: Magnetic Lattice
     :param p_array: ParticleArray
     :param navi: Navigator
+    :param print_progress: True - the progress is printed (at most every PROGRESS_INTERVAL seconds), False - quiet,
+                           function f(z, total_length, proc_list) - called after every step
+    :param checkpoint: TrackCheckpoint - periodic checkpoints, the tracking is resumed from the checkpoint file
+                       if it exists and checkpoint.resume is True, the file is removed at the end of the tracking
+    :param sampler: TwissSampler - the twiss parameters are calculated only at the sampled steps and stored in
+                    the sampler (and its file), if None - at every step
     :return: twiss list, ParticleArray
     """
-    tw0 = get_envelope(p_array) if calc_tws else Twiss()# get_envelope(p_array)
-    #print(tw0)
-    tws_track = [tw0]
-    L = 0.
+    restored = checkpoint.restore(p_array, navi) if checkpoint is not None and checkpoint.resume else None
+    if restored is not None:
+        tws_track, L = restored
+        if sampler is not None:
+            sampler.start(lattice, navi, tws_track)
+    else:
+        L = 0.
+        if sampler is not None:
+            sampler.start(lattice, navi)
+            tw0 = sampler.sample(p_array, L, calc_tws=calc_tws)
+        else:
+            tw0 = get_envelope(p_array) if calc_tws else Twiss()# get_envelope(p_array)
+        #print(tw0)
+        tws_track = [tw0]
+        if navi.adaptive:
+            navi.beam_state = navi.beam_quantities(p_array)
+    t_print = 0.
     while np.abs(navi.z0 - lattice.totalLen) > 1e-10:
         if navi.kill_process:
             print("Killing tracking ... ")
+            if checkpoint is not None:
+                checkpoint.save(p_array, navi, tws_track, L)
+                checkpoint.close()
+            if sampler is not None:
+                sampler.close()
+            finish_processes(navi)
+            flush_writes()
             return tws_track, p_array
         dz, proc_list = navi.get_next()
 
         tracking_step(lat=lattice, particle_list=p_array, dz=dz, navi=navi)
 
+        if len(proc_list) > 0 and p_array.lost is not None:
+            # the collective effects need the particles which are not lost
+            p_array.compact()
         for p in proc_list:
             p.z0 = navi.z0
             p.apply(p_array, dz)
-        tw = get_envelope(p_array) if calc_tws else Twiss()
+        if navi.adaptive:
+            navi.update_steps(p_array, dz, proc_list)
+        if sampler is None:
+            tw = get_envelope(p_array) if calc_tws else Twiss()
+            L += dz
+            tw.s += L
+            tws_track.append(tw)
+        else:
+            L += dz
+            if sampler.check(navi.z0, last=np.abs(navi.z0 - lattice.totalLen) <= 1e-10):
+                tw = sampler.sample(p_array, L, calc_tws=calc_tws)
+                if sampler.keep_twiss:
+                    tws_track.append(tw)
+        if checkpoint is not None:
+            checkpoint.step(p_array, navi, tws_track, L)
+
+        if callable(print_progress):
+            print_progress(navi.z0, lattice.totalLen, proc_list)
+        elif print_progress and (time() - t_print > PROGRESS_INTERVAL or np.abs(navi.z0 - lattice.totalLen) <= 1e-10):
+            t_print = time()
+            poc_names = [p.__class__.__name__ for p in proc_list]
+            sys.stdout.write( "\r" + "z = " + str(navi.z0)+" / "+str(lattice.totalLen) + " : applied: " + ", ".join(poc_names)  )
+            sys.stdout.flush()
+
+    if checkpoint is not None:
+        checkpoint.finish()
+    if sampler is not None:
+        sampler.close()
+    # the lost particles are removed from the returned beam, see ParticleArray.lost_particles()
+    p_array.compact()
+    finish_processes(navi)
+    flush_writes()
+    return tws_track, p_array
+
+
+def member_transfer_maps(lattice, member_params):
+    """
+    transfer maps of the elements with the parameters which differ between the members of the batch
+
+    :param lattice: Magnetic Lattice
+    :param member_params: dict {element: {attribute: array (M)}}, e.g. {cav: {"phi": phases}, quad: {"dx": offsets}}
+    :return: dict {element: [transfer map of member 0, ..., transfer map of member M-1]}
+    """
+    member_tms = {}
+    for elem, params in member_params.items():
+        n = max([np.size(val) for val in params.values()])
+        tms = []
+        for m in range(n):
+            e = copy(elem)
+            for attr, val in params.items():
+                setattr(e, attr, val[m] if np.size(val) > 1 else val)
+            tms.append(lattice.method.create_tm(e))
+        member_tms[elem] = tms
+    return member_tms
+
+
+def batch_second_order(X, R, T):
+    """
+    SecondOrderMult.numpy_apply() with the own matrices of each member
+
+    :param X: array (6, M, N) of the batch, is changed in place
+    :param R: array (M, 6, 6)
+    :param T: array (M, 6, 6, 6)
+    :return: None
+    """
+    Xr = np.matmul(R, X.transpose(1, 0, 2)).transpose(1, 0, 2)
+    x, px, y, py, tau, dp = X[0], X[1], X[2], X[3], X[4], X[5]
+    terms = {(0, 0): (x, x), (0, 1): (x, px), (0, 5): (x, dp), (1, 1): (px, px), (1, 5): (px, dp), (5, 5): (dp, dp),
+             (2, 2): (y, y), (2, 3): (y, py), (3, 3): (py, py)}
+    cross = {(0, 2): (x, y), (0, 3): (x, py), (1, 2): (px, y), (1, 3): (px, py), (2, 5): (y, dp), (3, 5): (py, dp)}
+    products = {}
+    for rows, pairs in (((0, 1, 4), terms), ((2, 3), cross)):
+        for i in rows:
+            for (j, k), (a, b) in pairs.items():
+                t = T[:, i, j, k]
+                if not np.any(t):
+                    continue
+                if (j, k) not in products:
+                    products[(j, k)] = a * b
+                Xr[i] += t[:, np.newaxis] * products[(j, k)]
+    X[:] = Xr
+
+
+def apply_batch(tms, batch, elem_length=0.):
+    """
+    apply the transfer maps of the members to the batch.
+    The same map and the same energy for all members - one call for all particles of the batch,
+    TransferMap, SecondTM and CavityTM (without offsets and coupler kicks) - the maps with the own
+    matrices of each member are vectorized over the members, otherwise the maps are applied member by member.
+
+    :param tms: list of M transfer maps
+    :param batch: ParticleArrayBatch
+    :param elem_length: length of the element, is needed for the voltage of the cavity slice
+    :return: None
+    """
+    from ocelot.cpbd.long_track import cavity_map
+    X = batch.rparticles
+    cls = tms[0].__class__
+    same_class = all([tm.__class__ == cls for tm in tms])
+    no_offsets = all([tm.dx == 0 and tm.dy == 0 and tm.tilt == 0 for tm in tms])
+    if all([tm is tms[0] for tm in tms]) and np.all(batch.E == batch.E[0]):
+        tms[0].map(X.reshape(6, -1), energy=batch.E[0])
+    elif same_class and cls == TransferMap:
+        R = np.array([tm.R(E) for tm, E in zip(tms, batch.E)])
+        B = np.array([tm.B(E) for tm, E in zip(tms, batch.E)])
+        X[:] = np.matmul(R, X.transpose(1, 0, 2)).transpose(1, 0, 2) + B.transpose(1, 0, 2)
+    elif same_class and cls == SecondTM and no_offsets:
+        R = np.array([tm.r_z_no_tilt(tm.length, E) for tm, E in zip(tms, batch.E)])
+        T = np.array([tm.t_mat_z_e(tm.length, E) for tm, E in zip(tms, batch.E)])
+        batch_second_order(X, R, T)
+    elif same_class and cls == CavityTM and no_offsets and not any([tm.coupler_kick for tm in tms]) and \
+            all([tm.f == tms[0].f for tm in tms]):
+        V = np.array([tm.v * tm.length / elem_length if elem_length != 0 else tm.v for tm in tms])
+        phi = np.array([tm.phi for tm in tms])
+        cavity_map(X.transpose(1, 0, 2), np.array(batch.E, dtype=float), V, tms[0].f, phi, tms[0].length)
+    else:
+        for m, tm in enumerate(tms):
+            tm.map(X[:, m, :], energy=batch.E[m])
+    batch.E = batch.E + np.array([tm.delta_e for tm in tms])
+    batch.s += tms[0].length
+
+
+def tracking_step_batch(lat, batch, dz, navi, member_tms=None):
+    """
+    tracking_step() of the batch
+
+    :param lat: Magnetic Lattice
+    :param batch: ParticleArrayBatch
+    :param dz: step in [m]
+    :param navi: Navigator
+    :param member_tms: dict {element: [transfer maps of the members]}, see member_transfer_maps()
+    :return: None
+    """
+    member_tms = {} if member_tms is None else member_tms
+    if navi.z0 + dz > lat.totalLen:
+        dz = lat.totalLen - navi.z0
+
+    for elem, dl in get_elem_slices(lat, dz, navi):
+        if elem in member_tms:
+            tms = [tm(dl) for tm in member_tms[elem]]
+        else:
+            tms = [elem.transfer_map(dl)] * batch.n_members()
+        apply_batch(tms, batch, elem_length=elem.l)
+
+
+def track_batch(lattice, batch, navi, member_params=None, print_progress=True, calc_tws=True):
+    """
+    tracking of the batch of beams through the lattice, see track().
+    The transfer maps are applied to all members at once, the physics processes are applied member by member.
+
+    :param lattice: Magnetic Lattice
+    :param batch: ParticleArrayBatch, see particle_array_batch()
+    :param navi: Navigator
+    :param member_params: dict {element: {attribute: array (M)}} - element parameters of the members,
+                          e.g. {cav: {"v": voltages, "phi": phases}, quad: {"k1": k1s, "dx": offsets}}
+    :return: list of M twiss lists, ParticleArrayBatch
+    """
+    member_tms = member_transfer_maps(lattice, member_params) if member_params is not None else {}
+    # the maps are applied to the view (6, M*N) of the coordinates
+    batch.rparticles = np.ascontiguousarray(batch.rparticles)
+    M = batch.n_members()
+    tws_track = [[get_envelope(batch.member_view(m)) if calc_tws else Twiss()] for m in range(M)]
+    L = 0.
+    while np.abs(navi.z0 - lattice.totalLen) > 1e-10:
+        if navi.kill_process:
+            print("Killing tracking ... ")
+            finish_processes(navi)
+            flush_writes()
+            return tws_track, batch
+        dz, proc_list = navi.get_next()
+
+        tracking_step_batch(lat=lattice, batch=batch, dz=dz, navi=navi, member_tms=member_tms)
+
         L += dz
-        tw.s += L
-        tws_track.append(tw)
+        for m in range(M):
+            # the member is copied only for the physics processes, they can replace the arrays of the ParticleArray
+            if len(proc_list) > 0:
+                p_array = batch.member(m)
+                for p in proc_list:
+                    p.z0 = navi.z0
+                    p.apply(p_array, dz)
+                batch.set_member(m, p_array)
+            else:
+                p_array = batch.member_view(m)
+            tw = get_envelope(p_array) if calc_tws else Twiss()
+            tw.s += L
+            tws_track[m].append(tw)
 
         if print_progress:
             poc_names = [p.__class__.__name__ for p in proc_list]
             sys.stdout.write( "\r" + "z = " + str(navi.z0)+" / "+str(lattice.totalLen) + " : applied: " + ", ".join(poc_names)  )
             sys.stdout.flush()
 
-    return tws_track, p_array
+    finish_processes(navi)
+    flush_writes()
+    return tws_track, batch
 
 
 def lattice_track(lat, p):
@@ -5,17 +5,14 @@ Created on 17.05.2016
 
 from ocelot.adaptors import *
 from ocelot.adaptors.astra2ocelot import *
+from ocelot.cpbd.beam import LongitudinalProfile, triang_filter
 from ocelot.cpbd.physics_proc import PhysProc
+from ocelot.cpbd.csr import nextpow2
+from ocelot.utils.reswake import point_pipe_wake, surface_inductance
+import os
 import logging
 logger = logging.getLogger(__name__)
 
-def triang_filter(x, filter_order):
-    Ns = x.shape[0]
-    for i in range(filter_order):
-        x[1:Ns] = (x[1:Ns] + x[0:Ns-1])*0.5
-        x[0:Ns-1] = (x[1:Ns] + x[0:Ns-1])*0.5
-    return x
-
 def Der(x, y):
     #numerical derivative
     n=x.shape[0]
@@ -28,16 +25,13 @@ def Der(x, y):
 def Int1(x, y):
     n = x.shape[0]
     Y = np.zeros(n)
-    for i in range (1,n):
-        Y[i] = Y[i-1]+0.5*(y(i)+y(i-1))*(x(i)-x(i-1))
+    Y[1:n] = np.cumsum(0.5*(y[1:n] + y[0:n-1])*(x[1:n] - x[0:n-1]))
     return Y
 
 def Int1h(h, y):
     n = y.shape[0]
     Y = np.zeros(n)
-    # slow, switch to vector operations to be done
-    for i in range(1,n):
-        Y[i] = Y[i-1] + 0.5*(y[i]+y[i-1])
+    Y[1:n] = np.cumsum(0.5*(y[1:n] + y[0:n-1]))
     Y = Y*h
     return Y
 
@@ -50,41 +44,48 @@ def s2current(s_array, q_array, n_points, filter_order, mean_vel):
     :param n_points: number of sampling points
     :param filter_order: filter order
     :param mean_vel: mean velocity
-    :return:
+    :return: I - array (n_points + 2*floor(filter_order/2), 2), I[:, 0] - grid, I[:, 1] - current
     """
-    s0 = np.min(s_array)
-    s1 = np.max(s_array)
-    NF2 = int(np.floor(filter_order / 2.))
-    n_points = n_points + 2 * NF2
-    Np = s_array.shape[0]
-    ds = (s1 - s0) / (n_points - 2 - 2 * NF2)
-    s = s0 + np.arange(-NF2, n_points - NF2) * ds
-    # here we need a fast 1D linear interpolation of charges on the grid
-    # in sc.py we use a fast 3D "near-point" interpolation
-    # we need a stand-alone module with 1D,2D,3D particles-to-grid functions
-    Ip = (s_array - s0) / ds
-    I0 = np.floor(Ip)
-    dI0 = Ip - I0
-    I0 = I0 + NF2
-    Ro = np.zeros(n_points)
-    # slow, switch to vector operations to be done
-    for i in range(Np):
-        i0 = int(I0[i])
-        di0 = dI0[i]
-        Ro[i0] = Ro[i0] + (1 - di0) * q_array[i]
-        Ro[i0 + 1] = Ro[i0 + 1] + di0 * q_array[i]
-    if filter_order > 0:
-        triang_filter(Ro, filter_order)
-    I = np.zeros([n_points, 2])
-    I[:, 0] = s
-    I[:, 1] = Ro * mean_vel / ds
-    return I
+    # linear deposition of the charges on the grid, see LongitudinalProfile.currents()
+    return LongitudinalProfile(s_array, q_array).current(n_points, filter_order, mean_vel)
+
+
+# wake tables already loaded in the process, {(path, modification time): (T, H)}
+_wake_table_cache = {}
+
+
+def wake_table_binary_file(wake_file):
+    """
+    name of the binary file of the wake table
+
+    :param wake_file: path to the ASCII wake table
+    :return: path to the binary wake table (the same name with extension ".npy")
+    """
+    return os.path.splitext(wake_file)[0] + ".npy"
+
+
+def convert_wake_table(wake_file, npy_file=None):
+    """
+    Converts the ASCII wake table to the binary format (.npy) which is loaded by WakeTable with memory mapping.
+
+    :param wake_file: path to the ASCII wake table
+    :param npy_file: path to the binary wake table. If None the name of wake_file with extension ".npy"
+    :return: path to the binary wake table
+    """
+    if npy_file is None:
+        npy_file = wake_table_binary_file(wake_file)
+    W = np.loadtxt(wake_file)
+    np.save(npy_file, W)
+    return npy_file
 
 
 class WakeTable:
     """
     WakeTable(wake_file) - load and prepare wake table
-    wake_file - path to the wake table
+    wake_file - path to the wake table, ASCII file or binary file (.npy) created by convert_wake_table().
+                If there is an up-to-date binary file with the same name as the ASCII file it is used instead.
+                The tables are loaded once per process, the binary files are memory mapped and
+                the wake functions are read from the disk only when they are used.
     """
     def __init__(self, wake_file):
         self.TH = self.load_wake_table(wake_file)
@@ -94,7 +95,24 @@ class WakeTable:
         :param wake_file: file name
         :return: (T, H): T- table of wakes coefs, H- matrix of the coefs place in T
         """
-        W = np.loadtxt(wake_file)
+        npy_file = wake_table_binary_file(wake_file)
+        if not wake_file.endswith(".npy") and os.path.isfile(npy_file):
+            if os.path.getmtime(npy_file) >= os.path.getmtime(wake_file):
+                wake_file = npy_file
+        key = (os.path.abspath(wake_file), os.path.getmtime(wake_file))
+        if key not in _wake_table_cache:
+            if wake_file.endswith(".npy"):
+                W = np.load(wake_file, mmap_mode="r")
+            else:
+                W = np.loadtxt(wake_file)
+            _wake_table_cache[key] = self.parse_wake_table(W)
+        return _wake_table_cache[key]
+
+    def parse_wake_table(self, W):
+        """
+        :param W: array with the content of the wake file
+        :return: (T, H): T- table of wakes coefs, H- matrix of the coefs place in T
+        """
         # head format %Nt 0 %N0 N1 %R L %C nm
         H = np.zeros([5, 5])
         Nt = int(W[0, 0])
@@ -112,15 +130,14 @@ class WakeTable:
             m = int(nm - n*10)
             H[n, m] = i
             ind = ind + 2
+            # the wake functions are views of W, in case of the memory mapped file they are read on demand
             if N0 > 0:
-                W0 = np.zeros([N0, 2])
-                W0[0:N0, :] = W[ind+1:ind+N0+1, :]
+                W0 = W[ind+1:ind+N0+1, :]
                 ind = ind + N0
             else:
                 W0 = 0
             if N1 > 0:
-                W1 = np.zeros([N1, 2])
-                W1[0:N1, :]=W[ind+1:ind+N1+1, :]
+                W1 = W[ind+1:ind+N1+1, :]
                 ind = ind + N1
             else:
                 W1 = 0
@@ -152,6 +169,10 @@ class Wake(PhysProc):
         self.wake_table = None
         self.factor = 1.
         self.step = step
+        self.distributed = True   # the currents are reduced in the distributed tracking, see LongitudinalProfile
+        # spectra of the wake functions resampled on the current grid, see Wake.wake_spectrum()
+        self.wake_cache = {}
+        self.wake_tables = []     # wake tables of the cache keys, the index in the list is the key of the table
 
     def convolution(self, xu, u, xw, w):
         #convolution of equally spaced functions
@@ -174,6 +195,92 @@ class Wake(PhysProc):
         xW, Wake = self.convolution(xb, bunch, xwi, wake1)
         return xW[0:nb], Wake[0:nb]
 
+    def wake_spectrum(self, key, xb, xw, wake, n_fft):
+        """
+        FFT of the wake function resampled on the grid of the bunch (see wake_convolution()).
+        The spectra are cached for (key, number of grid points, n_fft) and are recalculated if the grid step
+        is changed: the resampled wake w(k*hx) of the tabulated wake function depends on the step, it is not
+        a scaling of the spectrum.
+
+        :param key: key of the wake function in the cache, see table_key()
+        :param xb: grid of the bunch
+        :param xw: coordinates of the wake function
+        :param wake: wake function
+        :param n_fft: length of the FFT
+        :return: rfft of the resampled wake
+        """
+        key = key + (xb.shape[0], n_fft)
+        hx = xb[1] - xb[0]
+        if key not in self.wake_cache or self.wake_cache[key][0] != hx:
+            xwi = xb - xb[0]
+            wake1 = np.interp(xwi, xw, wake, 0, 0)
+            wake1[0] = wake1[0]*0.5
+            self.wake_cache[key] = (hx, np.fft.rfft(wake1, n_fft))
+        return self.wake_cache[key][1]
+
+    def table_key(self, T):
+        """
+        key of the wake table in the cache of the spectra. The table is kept in Wake.wake_tables,
+        so the key is not reused for another table (unlike id(T) of a released object)
+
+        :param T: wake table
+        :return: int
+        """
+        for i, t in enumerate(self.wake_tables):
+            if t is T:
+                return i
+        self.wake_tables.append(T)
+        return len(self.wake_tables) - 1
+
+    def add_wakes(self, I, comps, keys):
+        """
+        wakes of the several components of the wake table for the same generalized current, see add_wake().
+        The convolutions of all components are done by one forward FFT of the current (and its derivative)
+        and one batched inverse FFT.
+
+        :param I: generalized current, I[:, 0] - grid, I[:, 1] - current
+        :param comps: list of the components of the wake table (R, L, Cinv, nm, W0, N0, W1, N1)
+        :param keys: keys of the components in the cache of the wake spectra
+        :return: x, [W_i] - grid and list of the wakes in V
+        """
+        c = speed_of_light
+        x = I[:, 0]
+        bunch = I[:, 1]
+        nb = x.shape[0]
+        hx = x[1] - x[0]
+        n_fft = 2**nextpow2(2*nb - 1)
+        d1_bunch = None
+        if any([L != 0 or N1 > 0 for R, L, Cinv, nm, W0, N0, W1, N1 in comps]):
+            d1_bunch = Der(x, bunch)
+        bunch_fft = None
+        d1_bunch_fft = None
+        spectra = []
+        for key, (R, L, Cinv, nm, W0, N0, W1, N1) in zip(keys, comps):
+            spectrum = np.zeros(n_fft//2 + 1, dtype=complex)
+            if N0 > 0:
+                if bunch_fft is None:
+                    bunch_fft = np.fft.rfft(bunch, n_fft)
+                spectrum -= bunch_fft*self.wake_spectrum((key, 0), x, W0[:, 0], W0[:, 1], n_fft)/c
+            if N1 > 0:
+                if d1_bunch_fft is None:
+                    d1_bunch_fft = np.fft.rfft(d1_bunch, n_fft)
+                spectrum += d1_bunch_fft*self.wake_spectrum((key, 1), x, W1[:, 0], W1[:, 1], n_fft)
+            spectra.append(spectrum)
+        conv = np.fft.irfft(np.array(spectra), n_fft, axis=1)[:, 0:nb]*hx
+
+        wakes = []
+        for n, (R, L, Cinv, nm, W0, N0, W1, N1) in enumerate(comps):
+            W = conv[n]
+            if R != 0:
+                W = W-bunch*R
+            if L != 0:
+                W = W-d1_bunch*L*c
+            if Cinv != 0:
+                int_bunch = Int1(x, bunch)
+                W = W - int_bunch*Cinv/c
+            wakes.append(W)
+        return x, wakes
+
     def add_wake(self, I, T):
         """
         [x, W] = AddWake(I, T)
@@ -184,31 +291,21 @@ class Wake(PhysProc):
         """[x, W] =AddWake (I,T)
             T - wake table in V/C, W in V
             (R,L,Cinv,nm,W0,N0,W1,N1)"""
-        R, L, Cinv, nm, W0, N0, W1, N1 = T
-        c = speed_of_light
-        x = I[:, 0]
-        bunch = I[:, 1]
-        if L != 0 or N1 > 0:
-            d1_bunch=Der(x,bunch)
-        nb=x.shape[0]
-        W=np.zeros(nb)
-        if N0 > 0:
-            x, ww = self.wake_convolution(x, bunch, W0[:, 0], W0[:, 1])
-            W = W-ww[0:nb]/c
-        if N1>0:
-            x, ww = self.wake_convolution(x, d1_bunch, W1[:, 0], W1[:, 1])
-            #W = W - ww[0:nb]
-            W = W + ww[0:nb]
-        if R != 0:
-            W = W-bunch*R
-        if L != 0:
-            W = W-d1_bunch*L*c
-        if Cinv != 0:
-          int_bunch = Int1(x, bunch)
-          W = W - int_bunch*Cinv/c
-        return x, W
-
-    def add_total_wake(self, X, Y, Z, q, TH, Ns, NF):
+        x, wakes = self.add_wakes(I, [T], [(self.table_key(T), )])
+        return x, wakes[0]
+
+    def add_total_wake(self, X, Y, Z, q, TH, Ns, NF, profile=None):
+        """
+        :param X: horizontal coordinates of the particles
+        :param Y: vertical coordinates of the particles
+        :param Z: longitudinal coordinates of the particles
+        :param q: charges of the particles
+        :param TH: wake table (T, H), see WakeTable
+        :param Ns: number of sampling points
+        :param NF: filter order
+        :param profile: LongitudinalProfile of the particles. If None it is created from X, Y, Z, q
+        :return: Px, Py, Pz, I00
+        """
         #function [Px Py Pz I00]=AddTotalWake (P,q,wakeFile,Ns,NF)
         T, H = TH
         c = speed_of_light
@@ -217,90 +314,105 @@ class Wake(PhysProc):
         X2 = X**2
         Y2 = Y**2
         XY = X*Y
+        if profile is None:
+            profile = LongitudinalProfile(Z, q, x=X, y=Y)
         #generalized currents;
-        I00 = s2current(Z, q, Ns, NF, c)
-        Nw=I00.shape[0]
+        moments = ["00"]
         if (H[0,2]>0)or(H[2,3]>0)or(H[2,4]>0):
-            qn=q*Y
-            I01 = s2current(Z,qn,Ns,NF,c)
+            moments.append("01")
         if (H[0, 1] > 0)or(H[1, 3] > 0) or (H[1, 4] > 0):
-            qn=q*X
-            I10 = s2current(Z,qn,Ns,NF,c)
+            moments.append("10")
         if H[1,2]>0:
-            qn=q*XY
-            I11 = s2current(Z,qn,Ns,NF,c)
+            moments.append("11")
         if H[1,1]>0:
-            qn=q*(X2-Y2)
-            I20_02 = s2current(Z, qn, Ns, NF, c)
+            moments.append("20_02")
+        I = profile.currents(Ns, NF, c, moments=moments)
+        I00 = I["00"]
+        I01 = I.get("01")
+        I10 = I.get("10")
+        I11 = I.get("11")
+        I20_02 = I.get("20_02")
+        Nw=I00.shape[0]
+        # the wakes are calculated on the grid of the currents
+        interp = lambda W: profile.grid_interp(Ns, NF, W)
+        # wakes of all components, the components with the same generalized current are calculated together
+        sources = [(I00, [(0, 0), (0, 4), (0, 3), (3, 4), (3, 3)]),
+                   (I10, [(0, 1), (1, 4), (1, 3)]),
+                   (I01, [(0, 2), (2, 4), (2, 3)]),
+                   (I20_02, [(1, 1)]),
+                   (I11, [(1, 2)])]
+        W = {}
+        for Ic, nms in sources:
+            nms = [nm for nm in nms if nm == (0, 0) or H[nm] > 0]
+            if len(nms) > 0:
+                comps = [T[int(H[nm])] for nm in nms]
+                x, wakes = self.add_wakes(Ic, comps, [(self.table_key(T), int(H[nm])) for nm in nms])
+                W.update(zip(nms, wakes))
         #longitudinal wake
         #mn=0
-        x, Wz = self.add_wake (I00, T[int(H[0, 0])])
+        Wz = W[0, 0]
         if H[0, 1] > 0:
-            x, w = self.add_wake(I10, T[int(H[0, 1])])
-            Wz = Wz+w
+            Wz = Wz+W[0, 1]
         if H[0,2]>0:
-            x, w = self.add_wake(I01, T[int(H[0, 2])])
-            Wz = Wz+w
+            Wz = Wz+W[0, 2]
         if H[1,1]>0:
-            x, w = self.add_wake(I20_02, T[int(H[1, 1])])
-            Wz = Wz+w
+            Wz = Wz+W[1, 1]
         if H[1,2]>0:
-            x, w = self.add_wake(I11, T[int(H[1, 2])])
-            Wz = Wz+2*w
-        Pz = np.interp(Z, x, Wz, 0, 0)
+            Wz = Wz+2*W[1, 2]
+        Pz = interp(Wz)
         Py = np.zeros(Np)
         Px = np.zeros(Np)
         #mn=01
-        Wz[0:Nw] = 0
+        Wz = np.zeros(Nw)
         Wy = np.zeros(Nw)
         if H[0, 4] > 0:
-            x, w = self.add_wake(I00, T[int(H[0, 4])])
+            w = W[0, 4]
             Wz=Wz+w
             Wy=Wy+w
         if H[1,4]>0:
-            x, w = self.add_wake(I10, T[int(H[1, 4])])
+            w = W[1, 4]
             Wz = Wz + 2*w
             Wy = Wy + 2*w
         if H[2,4]>0:
-            x, w = self.add_wake(I01, T[int(H[2, 4])])
+            w = W[2, 4]
             Wz = Wz + 2*w
             Wy = Wy + 2*w
-        Pz = Pz + np.interp(Z, x, Wz, 0, 0)*Y
+        Pz = Pz + interp(Wz)*Y
         h = x[1] - x[0]
         Wy = -Int1h(h, Wy)
-        Py = Py + np.interp(Z, x, Wy, 0, 0)
+        Py = Py + interp(Wy)
         #mn=10
-        Wz[0:Nw] = 0
+        Wz = np.zeros(Nw)
         Wx = np.zeros(Nw)
         if H[0, 3] > 0:
-            x, w = self.add_wake(I00, T[int(H[0, 3])])
+            w = W[0, 3]
             Wz = Wz + w
             Wx = Wx + w
         if H[1,3]>0:
-            x, w = self.add_wake(I10, T[int(H[1, 3])])
+            w = W[1, 3]
             Wz = Wz + 2*w
             Wx = Wx + 2*w
         if H[2,3]>0:
-            x, w = self.add_wake(I01, T[int(H[2, 3])])
+            w = W[2, 3]
             Wz = Wz + 2*w
             Wx = Wx + 2*w
         Wx=-Int1h(h,Wx)
-        Pz = Pz + np.interp(Z, x, Wz, 0, 0)*X
-        Px = Px + np.interp(Z, x, Wx, 0, 0)
+        Pz = Pz + interp(Wz)*X
+        Px = Px + interp(Wx)
         #mn=11
         if H[3,4]>0:
-            x, w = self.add_wake(I00, T[int(H[3, 4])])
+            w = W[3, 4]
             Wx=-2*Int1h(h,w)
-            p=np.interp(Z,x,Wx,0,0)
+            p=interp(Wx)
             Px = Px + p*Y
             Py = Py + p*X
-            Pz = Pz + 2*np.interp(Z, x, w, 0, 0)*XY
+            Pz = Pz + 2*interp(w)*XY
         #mn=02,20
         if H[3,3]>0:
-            x, w = self.add_wake(I00, T[int(H[3, 3])])
-            Pz = Pz+np.interp(Z,x,w,0,0)*(X2-Y2)
+            w = W[3, 3]
+            Pz = Pz+interp(w)*(X2-Y2)
             Wx = -2*Int1h(h,w)
-            p = np.interp(Z,x,Wx,0,0)
+            p = interp(Wx)
             Px = Px + p*X
             Py = Py - p*Y
         I00[:,0]=-I00[:,0]
@@ -314,6 +426,8 @@ class Wake(PhysProc):
             logger.info("Wake.wake_table is None! Please specify the WakeTable()")
         else:
             self.TH = self.wake_table.TH
+        self.wake_cache = {}
+        self.wake_tables = []
 
     def apply(self, p_array, dz):
         #print("apply: WAKE")
@@ -323,7 +437,8 @@ class Wake(PhysProc):
         #ziw = zi - dz * 0.5
         #if (1.0 < ziw <= 3.0) or (5.0 < ziw <= 7.0):  # or(10.0<ziw<=12.0):
         ps = p_array.rparticles
-        Px, Py, Pz, I00 = self.add_total_wake(ps[0], ps[2], ps[4], p_array.q_array, self.TH, self.w_sampling, self.filter_order)
+        Px, Py, Pz, I00 = self.add_total_wake(ps[0], ps[2], ps[4], p_array.q_array, self.TH, self.w_sampling,
+                                              self.filter_order, profile=p_array.longitudinal_profile())
         #if (3.0 < ziw <= 5.0):  # or(8.0<ziw<=10.0)or(12.0<ziw<=14.0):
         #    Px, Py, Pz, I00 = self.add_total_wake(Ps[:, 0], Ps[:, 2], Ps[:, 4], p_array.q_array, THh, Ns, NF)
         #print(zi, dz, ziw)
@@ -342,8 +457,86 @@ class WakeKick(Wake):
         #print("Apply WakeKick")
         ps = p_array.rparticles
         Px, Py, Pz, I00 = self.add_total_wake(ps[0], ps[2], ps[4], p_array.q_array, self.TH, self.w_sampling,
-                                              self.filter_order)
+                                              self.filter_order, profile=p_array.longitudinal_profile())
 
         p_array.rparticles[5] = p_array.rparticles[5] + self.factor * Pz / (p_array.E * 1e9)
         p_array.rparticles[3] = p_array.rparticles[3] + self.factor * Py / (p_array.E * 1e9)
-        p_array.rparticles[1] = p_array.rparticles[1] + self.factor * Px / (p_array.E * 1e9)
\ No newline at end of file
+        p_array.rparticles[1] = p_array.rparticles[1] + self.factor * Px / (p_array.E * 1e9)
+
+
+class ResistiveWallWake(PhysProc):
+    """
+    Longitudinal resistive wall wake of the round pipe including the roughness and the oxide layer
+    (see ocelot.utils.reswake.pipe_wake()).
+    The wake of a point charge is calculated from the impedance once for the grid of the beam current and
+    is reused while the grid step changes less than grid_tol. The wake is applied by FFT convolution with the
+    current on the grid of the longitudinal profile of the beam (LongitudinalProfile), so the current
+    is shared with Wake and CSR with the same sampling.
+
+    parameters:
+    -----------
+    radius = 5e-3 - pipe radius [m]
+    conductivity = 3.66e7 - conductivity [1/(Ohm*m)], aluminium
+    tau = 7.1e-15 - relaxation time [s], aluminium
+    roughness = 600e-9 - roughness of the surface [m]
+    d_oxid = 5e-9 - thickness of the oxide layer [m]
+    w_sampling = 500 - number of the sampling points of the current
+    filter_order = 20 - smoothing filter order
+    n_pad = 100000 - number of zero points added to the grid for the impedance -> wake transform
+    grid_tol = 1e-3 - relative change of the grid step for which the point charge wake is recalculated
+    factor = 1. - scaling coefficient
+    """
+    def __init__(self, step=1):
+        PhysProc.__init__(self, step)
+        self.radius = 5e-3              # m
+        self.conductivity = 3.66e7      # 1/(Ohm*m)
+        self.tau = 7.1e-15              # s
+        self.roughness = 600e-9         # m
+        self.d_oxid = 5e-9              # m
+        self.w_sampling = 500
+        self.filter_order = 20
+        self.n_pad = 100000
+        self.grid_tol = 1e-3
+        self.factor = 1.
+        self.distributed = True
+        self.wake_spectrum = None       # (key, spectrum), see get_wake_spectrum()
+
+    def prepare(self, lat):
+        self.wake_spectrum = None
+
+    def get_wake_spectrum(self, ds, nb):
+        """
+        FFT of the point charge wake for the convolution with the current on the grid with nb points.
+        The wake is recalculated if the pipe parameters are changed or the grid step differs more than grid_tol
+
+        :param ds: grid step
+        :param nb: number of the grid points
+        :return: rfft of the wake with the length 2**nextpow2(2*nb - 1)
+        """
+        pipe = (self.radius, self.conductivity, self.tau, self.roughness, self.d_oxid, self.n_pad)
+        if self.wake_spectrum is not None:
+            key, spectrum = self.wake_spectrum
+            if key[0] == pipe and key[2] == nb and abs(ds - key[1]) <= self.grid_tol*key[1]:
+                return spectrum
+        n = 2**nextpow2(nb + self.n_pad)
+        Ind = surface_inductance(self.roughness, self.d_oxid)
+        s, w = point_pipe_wake(ds, n, self.radius, self.conductivity, self.tau, Ind)
+        # the band limited wake is not zero for s < 0, the lags (-nb, nb) are needed for the grid of the current
+        n_fft = 2**nextpow2(2*nb - 1)
+        wake = np.zeros(n_fft)
+        wake[:nb] = w[:nb]
+        wake[n_fft - nb + 1:] = w[n - nb + 1:]
+        spectrum = np.fft.rfft(wake)
+        self.wake_spectrum = ((pipe, ds, nb), spectrum)
+        return spectrum
+
+    def apply(self, p_array, dz):
+        profile = p_array.longitudinal_profile()
+        I = profile.current(self.w_sampling, self.filter_order, speed_of_light)
+        nb = I.shape[0]
+        ds = I[1, 0] - I[0, 0]
+        spectrum = self.get_wake_spectrum(ds, nb)
+        n_fft = 2*(len(spectrum) - 1)
+        W = -np.fft.irfft(np.fft.rfft(I[:, 1], n_fft)*spectrum, n_fft)[:nb]*ds/speed_of_light
+        Pz = profile.grid_interp(self.w_sampling, self.filter_order, W)
+        p_array.rparticles[5] = p_array.rparticles[5] + Pz * dz*self.factor / (p_array.E * 1e9)
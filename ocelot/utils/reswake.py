@@ -4,6 +4,7 @@ writen by I. Zagorodnov, DESY and S.Tomin XFEL, 2015.
 from scipy.integrate import simps
 from numpy import arange, sqrt, append, zeros, conj, dot, linspace
 from numpy.fft import fft, irfft, ifft
+import numpy as np
 from ocelot.common.globals import *
 
 def wake2impedance(s, w):
@@ -46,18 +47,49 @@ def imp_resistiveAC_SI(f, cond, a, tau, L):
     #             tau - the relaxation time in s
     #             L-inductive for dielectric layer
     """
-    n = len(f)
     f2w = 2.*pi
     koef = a*0.5*1j/(speed_of_light*Z0)
-    Z = zeros(n, dtype=complex)
-    for i in range(0, n):
-        w = f[i]*f2w
-        kw = cond/(1. + 1j*w*tau)
-        Zs = sqrt(1j*w*mu_0/kw) + 1j*w*L
-        Z[i] = Zs/(f2w*a*(1. + w*Zs*koef))
+    w = np.asarray(f)*f2w
+    kw = cond/(1. + 1j*w*tau)
+    Zs = sqrt(1j*w*mu_0/kw) + 1j*w*L
+    Z = Zs/(f2w*a*(1. + w*Zs*koef))
     return Z
 
 
+def surface_inductance(roughness, d_oxid, eps_r=2.):
+    """
+    inductance of the surface roughness and of the oxide layer
+
+    :param roughness: roughness of the surface in m
+    :param d_oxid: thickness of the oxide layer in m
+    :param eps_r: relative permittivity of the oxide layer
+    :return: L in H
+    """
+    return mu_0*((eps_r-1.)/eps_r*d_oxid + 0.01035*roughness)
+
+
+def point_pipe_wake(ds, n, a, conductivity, tau, Ind):
+    """
+    longitudinal wake of a point charge in the round pipe (per unit length) on the grid s = ds*arange(n).
+    The wake is calculated from the impedance sampled with the step 1/(n*ds/c) up to the Nyquist frequency,
+    so it is band limited and periodic with the period n*ds: w[n-k] is the wake at s = -k*ds
+    and n*ds has to be much longer than the bunch.
+
+    :param ds: grid step in m
+    :param n: number of the grid points
+    :param a: pipe radius in m
+    :param conductivity: in 1/(Ohm*m)
+    :param tau: the relaxation time in s
+    :param Ind: inductance of the surface, see surface_inductance()
+    :return: s, w - grid and wake in V/C/m, the wake is positive for the energy loss
+    """
+    dt = ds/speed_of_light
+    f = arange(n//2 + 1)/(n*dt)
+    Z = imp_resistiveAC_SI(f, conductivity, a, tau, Ind)
+    w = irfft(Z, n)/dt
+    return arange(n)*ds, w
+
+
 def ResistiveZaZb(xb, bunch, a, conductivity, tau, Ind):
     nb = len(xb)
     ds = xb[1] - xb[0]
@@ -115,8 +147,7 @@ def pipe_wake(z, current, tube_radius, tube_len, conductivity, tau, roughness, d
     yb = append(yb, arange(1, 100001)*0)
 
     # roughness and axid layer are here
-    eps_r = 2.
-    Ind = mu_0*((eps_r-1.)/eps_r*d_oxid + 0.01035*roughness)
+    Ind = surface_inductance(roughness, d_oxid)
 
     # the result is in V
     W = ResistiveZaZb(xb, yb, tube_radius, conductivity, tau, Ind)#*Q*L